@@ -47,6 +47,7 @@ setup(
         "pylint",
         "pytest",
         "mysql-connector",
+        "numpy",
         "requests",
         "tqdm",
         "pyvmomi",
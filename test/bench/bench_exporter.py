@@ -0,0 +1,249 @@
+"""Throughput benchmarks for VMWareExporter.download against a local fake NFC server
+
+Run from the repository root, for example:
+
+    python test/bench/bench_exporter.py --size-mb 1024 --latency 0.05 --loss 0.001
+
+Each strategy runs in a fresh process, which reports its wall time, CPU time and peak RSS
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from pyVmomi import vim
+
+from bench_server import FakeNFCServer
+from bench_vmdk import DISK_KINDS, write_disk
+
+BYTES_IN_MB = 1024 * 1024
+BYTES_IN_GB = 1024 * 1024 * 1024
+MAX_ATTEMPTS = 20  # downloads are retried with resume when the server drops connections
+# name: (disk kinds it applies to, VMWareExporter.download arguments)
+STRATEGIES = {
+    "single": (DISK_KINDS, {"segments": 1, "sparse": False, "manifest": False}),
+    "segments-4": (DISK_KINDS, {"segments": 4, "sparse": False, "manifest": False}),
+    "sparse": (DISK_KINDS, {"segments": 1, "sparse": True, "manifest": False}),
+    "manifest": (DISK_KINDS, {"segments": 4, "sparse": False, "manifest": True}),
+    "convert-raw": (["streamOptimized"], {"convert_to": "raw", "sparse": True}),
+    "convert-qcow2": (["streamOptimized"], {"convert_to": "qcow2", "sparse": True}),
+}
+
+
+class FakeLease:
+    """ An HttpNfcLease that is ready at once and records the calls made to it """
+
+    def __init__(self, device_urls):
+        """ device_urls are the lease's info.deviceUrl entries """
+        self.state = vim.HttpNfcLease.State.ready
+        self.info = SimpleNamespace(deviceUrl=device_urls)
+        self.progress = []
+        self.completed = False
+        self.aborted = 0
+
+    def HttpNfcLeaseProgress(self, percent):  # pylint: disable=invalid-name
+        """ Record a progress update """
+        self.progress.append(percent)
+
+    def HttpNfcLeaseComplete(self):  # pylint: disable=invalid-name
+        """ Record the completion """
+        self.completed = True
+
+    def HttpNfcLeaseAbort(self):  # pylint: disable=invalid-name
+        """ Record an abort """
+        self.aborted += 1
+
+
+class FakeLeaseCollector:
+    """ A PropertyCollector on a FakeLease, reporting its state once """
+
+    def __init__(self, lease):
+        """ Report the state of lease """
+        self.lease = lease
+        self.reported = False
+
+    def WaitForUpdatesEx(self, version, options):  # pylint: disable=invalid-name
+        """ Return the lease state as an update, the first time only """
+        if self.reported:
+            return None
+        self.reported = True
+        change = SimpleNamespace(name="state", op="assign", val=self.lease.state)
+        update = SimpleNamespace(kind="enter", obj=self.lease, changeSet=[change])
+        return SimpleNamespace(
+            version="1", truncated=False, filterSet=[SimpleNamespace(objectSet=[update])]
+        )
+
+    def DestroyPropertyCollector(self):  # pylint: disable=invalid-name
+        """ Nothing to destroy """
+
+
+def get_fake_vm(address, file_name, capacity_bytes):
+    """ Return a fake powered-off VM and VMWareMgr whose export lease serves address/file_name """
+    device_url = SimpleNamespace(url=f"http://*/{file_name}", targetId=file_name, disk=True)
+    lease = FakeLease([device_url])
+    disk = vim.vm.device.VirtualDisk(capacityInBytes=capacity_bytes)
+    vm = SimpleNamespace(
+        runtime=SimpleNamespace(powerState=vim.VirtualMachine.PowerState.poweredOff),
+        config=SimpleNamespace(hardware=SimpleNamespace(device=[disk])),
+        ExportVm=lambda: lease,
+    )
+    stub = SimpleNamespace(cookie='vmware_soap_session="bench"; Path=/')
+    mgr = SimpleNamespace(ip_addr=address, conn=SimpleNamespace(_stub=stub))
+    return vm, mgr, lease
+
+
+def _cpu_seconds(usage):
+    """ Return the user + system CPU seconds of a getrusage result """
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_strategy(address, file_name, capacity_bytes, options, out_dir):
+    """Export one disk from the fake server with the given download options, return metrics
+
+    Meant to run in its own process, so peak RSS belongs to this strategy alone
+    """
+    # Imported here so the baseline RSS includes the exporter's modules
+    import voithos.lib.vmware.exporter as exporter_module
+    import voithos.lib.vmware.lease as lease_module
+    from voithos.lib.vmware.transfer import DiskDownloadFailed
+
+    transfers = []
+
+    class CountedDownload(exporter_module.DiskDownload):
+        """ A DiskDownload that registers itself, to count the bytes of every attempt """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            transfers.append(self)
+
+    exporter_module.DiskDownload = CountedDownload
+    lease_module.create_object_collector = lambda conn, obj, path_set: FakeLeaseCollector(obj)
+    vm, mgr, lease = get_fake_vm(address, file_name, capacity_bytes)
+    baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    attempts = 0
+    error = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        exporter = exporter_module.VMWareExporter(mgr, vm, base_dir=out_dir, interval=0)
+        while attempts < MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                exporter.download(**options)
+                error = None
+                break
+            except DiskDownloadFailed as exc:
+                error = str(exc)
+    elapsed = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = _cpu_seconds(end_usage) - _cpu_seconds(usage)
+    received = sum(tx.bytes_written - tx.resumed_bytes for tx in transfers)
+    return {
+        "seconds": round(elapsed, 3),
+        "received_bytes": received,
+        "mb_per_second": round(received / BYTES_IN_MB / max(elapsed, 1e-6), 1),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_seconds_per_gb": round(cpu / max(received / BYTES_IN_GB, 1e-9), 2),
+        "peak_rss_mb": round(end_usage.ru_maxrss / 1024, 1),
+        "rss_growth_mb": round((end_usage.ru_maxrss - baseline_rss_kb) / 1024, 1),
+        "attempts": attempts,
+        "lease_completed": lease.completed,
+        "error": error,
+    }
+
+
+def _run_in_child(result_queue, *args):
+    """ Process target: run a strategy and send back its metrics """
+    try:
+        result_queue.put(run_strategy(*args))
+    except Exception as exc:  # pylint: disable=broad-except
+        result_queue.put({"error": f"{type(exc).__name__}: {exc}"})
+
+
+def run_benchmarks(
+    size_mb=256,
+    disk_kinds=None,
+    strategies=None,
+    range_support=True,
+    latency=0.0,
+    loss=0.0,
+    work_dir=None,
+):
+    """ Run every applicable strategy against every disk kind, return a list of result dicts """
+    disk_kinds = disk_kinds or DISK_KINDS
+    strategies = strategies or list(STRATEGIES)
+    capacity = size_mb * BYTES_IN_MB
+    if work_dir is None:
+        with tempfile.TemporaryDirectory(prefix="voithos-bench-") as tmp_dir:
+            return run_benchmarks(
+                size_mb, disk_kinds, strategies, range_support, latency, loss, tmp_dir
+            )
+    serve_dir = os.path.join(work_dir, "serve")
+    os.makedirs(serve_dir, exist_ok=True)
+    for kind in disk_kinds:
+        write_disk(kind, os.path.join(serve_dir, f"{kind}.vmdk"), capacity)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with FakeNFCServer(serve_dir, range_support, latency, loss) as server:
+        for kind in disk_kinds:
+            for name in strategies:
+                kinds, options = STRATEGIES[name]
+                if kind not in kinds:
+                    continue
+                out_dir = os.path.join(work_dir, f"{kind}-{name}")
+                os.makedirs(out_dir, exist_ok=True)
+                result_queue = context.Queue()
+                args = (server.address, f"{kind}.vmdk", capacity, options, out_dir)
+                process = context.Process(target=_run_in_child, args=(result_queue,) + args)
+                process.start()
+                result = result_queue.get()
+                process.join()
+                shutil.rmtree(out_dir)
+                results.append(dict(result, disk=kind, strategy=name))
+    return results
+
+
+def print_results(results):
+    """ Print a table of benchmark results """
+    columns = ["disk", "strategy", "mb_per_second", "cpu_seconds_per_gb", "peak_rss_mb"]
+    columns += ["rss_growth_mb", "attempts", "error"]
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(str(result.get(column, "")) for column in columns))
+
+
+def main():
+    """ Parse the command line and run the benchmarks """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="virtual size of each disk")
+    parser.add_argument("--disk", action="append", choices=DISK_KINDS, help="repeatable")
+    parser.add_argument("--strategy", action="append", choices=list(STRATEGIES))
+    parser.add_argument("--no-range", action="store_true", help="serve without Range support")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before responses")
+    parser.add_argument("--loss", type=float, default=0.0, help="drop chance per MB sent")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    args = parser.parse_args()
+    results = run_benchmarks(
+        size_mb=args.size_mb,
+        disk_kinds=args.disk,
+        strategies=args.strategy,
+        range_support=not args.no_range,
+        latency=args.latency,
+        loss=args.loss,
+    )
+    print_results(results)
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    return 1 if any(result.get("error") for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
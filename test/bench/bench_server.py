@@ -0,0 +1,111 @@
+""" Stand-in for the ESXi NFC HTTP endpoint, serving files from a directory """
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_SIZE = 1024 * 1024
+RANGE_HEADER = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class NFCRequestHandler(BaseHTTPRequestHandler):
+    """Serve GETs of files in server.root, with optional Range, latency and connection loss
+
+    server.latency seconds are slept before each response. server.loss is the probability that
+    the connection drops after each CHUNK_SIZE of body, like a flaky link to an ESXi host.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """ Keep benchmark output clean """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Send the whole file, or the requested range when Range is enabled """
+        path = os.path.join(self.server.root, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = RANGE_HEADER.match(self.headers.get("Range", ""))
+        if self.server.range_support and match:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+            end = min(end, size)
+        time.sleep(self.server.latency)
+        if self.server.range_support and match:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        with open(path, "rb") as data_file:
+            data_file.seek(start)
+            position = start
+            while position < end:
+                data = data_file.read(min(CHUNK_SIZE, end - position))
+                if self.server.rng.random() < self.server.loss:
+                    self.close_connection = True
+                    return
+                self.wfile.write(data)
+                position += len(data)
+
+
+class NFCServer(ThreadingHTTPServer):
+    """ A threaded HTTP server that ignores clients hanging up early """
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """ Clients close connections mid-response on purpose, e.g. after probing Range """
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _serve(root, range_support, latency, loss, seed, port_queue):
+    """ Process target: run the server until the process is terminated """
+    server = NFCServer(("127.0.0.1", 0), NFCRequestHandler)
+    server.root = root
+    server.range_support = range_support
+    server.latency = latency
+    server.loss = loss
+    server.rng = random.Random(seed)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeNFCServer:
+    """Run NFCRequestHandler in its own process, so its CPU use is not billed to the client
+
+    Use as a context manager: the address attribute is "127.0.0.1:<port>"
+    """
+
+    def __init__(self, root, range_support=True, latency=0.0, loss=0.0, seed=0):
+        """ Serve the files in root """
+        self.root = root
+        self.range_support = range_support
+        self.latency = latency
+        self.loss = loss
+        self.seed = seed
+        self.address = None
+        self._process = None
+
+    def __enter__(self):
+        """ Start the server process and wait for its port """
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        args = (self.root, self.range_support, self.latency, self.loss, self.seed, port_queue)
+        self._process = context.Process(target=_serve, args=args, daemon=True)
+        self._process.start()
+        self.address = f"127.0.0.1:{port_queue.get(timeout=30)}"
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Stop the server process """
+        self._process.terminate()
+        self._process.join()
@@ -0,0 +1,129 @@
+""" Write synthetic VMDKs of any size for the exporter benchmarks """
+import os
+import random
+import struct
+import zlib
+
+from voithos.lib.util.vmdk import GD_AT_END, SPARSE_HEADER
+
+SECTOR = 512
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR  # 64 KB
+GTES_PER_GT = 512
+DISTINCT_GRAINS = 16  # grain payloads are cycled, so large disks are quick to generate
+DISK_KINDS = ["thin", "thick", "streamOptimized"]
+
+
+def _header(capacity_sectors, gd_offset, overhead, stream=False):
+    """ Return a 512 byte SparseExtentHeader """
+    flags = 0x3 | ((1 << 16) | (1 << 17) if stream else 0)
+    header = SPARSE_HEADER.pack(
+        b"KDMV",
+        3,
+        flags,
+        capacity_sectors,
+        GRAIN_SECTORS,
+        1,
+        1,
+        GTES_PER_GT,
+        0,
+        gd_offset,
+        overhead,
+        0,
+        b"\n \r\n",
+        1 if stream else 0,
+    )
+    return header.ljust(SECTOR, b"\0")
+
+
+def _descriptor(create_type, capacity_sectors, name):
+    """ Return a one sector text descriptor """
+    text = (
+        f'# Disk DescriptorFile\nversion=1\ncreateType="{create_type}"\n'
+        f'RW {capacity_sectors} SPARSE "{name}"\n'
+    )
+    return text.encode().ljust(SECTOR, b"\0")
+
+
+def _payloads(seed):
+    """ Return DISTINCT_GRAINS grains of half random, half repeated bytes (compressible 2:1) """
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(DISTINCT_GRAINS):
+        noise = bytes(rng.getrandbits(8) for _ in range(GRAIN_SIZE // 2))
+        payloads.append(noise + bytes([rng.getrandbits(8)]) * (GRAIN_SIZE // 2))
+    return payloads
+
+
+def write_sparse_vmdk(path, capacity_bytes, data_fraction=1.0, seed=0):
+    """Write a monolithicSparse VMDK with every grain allocated
+
+    data_fraction of the grains hold data and the rest hold zeros, as in a thin disk whose
+    guest wrote zeros over freed blocks. 1.0 is a fully written "thick" disk.
+    """
+    num_grains = -(-capacity_bytes // GRAIN_SIZE)
+    num_gts = -(-num_grains // GTES_PER_GT)
+    gd_sectors = -(-num_gts * 4 // SECTOR)
+    gt_sectors = GTES_PER_GT * 4 // SECTOR
+    gd_offset = 2
+    gt_offset = gd_offset + gd_sectors
+    overhead = gt_offset + num_gts * gt_sectors
+    overhead = -(-overhead // GRAIN_SECTORS) * GRAIN_SECTORS
+    capacity_sectors = num_grains * GRAIN_SECTORS
+    payloads = _payloads(seed)
+    zero_grain = bytes(GRAIN_SIZE)
+    data_every = max(1, round(1 / data_fraction)) if data_fraction else None
+    with open(path, "wb") as vmdk:
+        vmdk.write(_header(capacity_sectors, gd_offset, overhead))
+        vmdk.write(_descriptor("monolithicSparse", capacity_sectors, os.path.basename(path)))
+        gd = [gt_offset + num * gt_sectors for num in range(num_gts)]
+        vmdk.write(struct.pack(f"<{num_gts}I", *gd).ljust(gd_sectors * SECTOR, b"\0"))
+        for gt_num in range(num_gts):
+            first = gt_num * GTES_PER_GT
+            entries = [
+                overhead + grain * GRAIN_SECTORS if grain < num_grains else 0
+                for grain in range(first, first + GTES_PER_GT)
+            ]
+            vmdk.write(struct.pack(f"<{GTES_PER_GT}I", *entries))
+        vmdk.seek(overhead * SECTOR)
+        for grain in range(num_grains):
+            has_data = data_every is not None and grain % data_every == 0
+            vmdk.write(payloads[grain % DISTINCT_GRAINS] if has_data else zero_grain)
+
+
+def write_stream_vmdk(path, capacity_bytes, data_fraction=0.5, seed=0):
+    """Write a streamOptimized VMDK, as an NFC export lease serves it
+
+    data_fraction of the grains hold data, the others are left out of the stream
+    """
+    num_grains = -(-capacity_bytes // GRAIN_SIZE)
+    capacity_sectors = num_grains * GRAIN_SECTORS
+    compressed = [zlib.compress(payload, 1) for payload in _payloads(seed)]
+    data_every = max(1, round(1 / data_fraction)) if data_fraction else None
+    with open(path, "wb") as vmdk:
+        vmdk.write(_header(capacity_sectors, GD_AT_END, 2, stream=True))
+        vmdk.write(_descriptor("streamOptimized", capacity_sectors, os.path.basename(path)))
+        for grain in range(num_grains):
+            if data_every is None or grain % data_every:
+                continue
+            data = compressed[grain % DISTINCT_GRAINS]
+            marker = struct.pack("<QI", grain * GRAIN_SECTORS, len(data)) + data
+            vmdk.write(marker.ljust(-(-len(marker) // SECTOR) * SECTOR, b"\0"))
+        # An empty grain directory, the footer and the end-of-stream marker
+        gd_sector = vmdk.tell() // SECTOR + 1
+        vmdk.write(struct.pack("<QII", 1, 0, 2).ljust(SECTOR, b"\0") + bytes(SECTOR))
+        vmdk.write(struct.pack("<QII", 1, 0, 3).ljust(SECTOR, b"\0"))
+        vmdk.write(_header(capacity_sectors, gd_sector, 2, stream=True))
+        vmdk.write(bytes(SECTOR))
+
+
+def write_disk(kind, path, capacity_bytes, seed=0):
+    """ Write a synthetic disk of one of DISK_KINDS """
+    if kind == "thin":
+        write_sparse_vmdk(path, capacity_bytes, data_fraction=0.1, seed=seed)
+    elif kind == "thick":
+        write_sparse_vmdk(path, capacity_bytes, data_fraction=1.0, seed=seed)
+    elif kind == "streamOptimized":
+        write_stream_vmdk(path, capacity_bytes, seed=seed)
+    else:
+        raise ValueError(f"Unknown disk kind {kind}. Supported: {DISK_KINDS}")
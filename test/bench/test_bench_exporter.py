@@ -0,0 +1,38 @@
+""" Smoke test of the exporter benchmark harness, with tiny disks """
+import os
+
+from bench_exporter import run_benchmarks
+from bench_vmdk import DISK_KINDS, write_disk
+from voithos.lib.util.vmdk import get_vmdk_info
+
+SIZE_MB = 4
+
+
+def test_synthetic_disks(tmp_path):
+    """ Every synthetic disk kind parses as a VMDK of the requested capacity """
+    for kind in DISK_KINDS:
+        path = str(tmp_path / f"{kind}.vmdk")
+        write_disk(kind, path, SIZE_MB * 1024 * 1024)
+        info = get_vmdk_info(path)
+        assert info["format"] == ("monolithicSparse" if kind != "streamOptimized" else kind)
+        assert info["capacity_bytes"] == SIZE_MB * 1024 * 1024
+        assert os.path.getsize(path) > 0
+
+
+def test_benchmark_with_loss():
+    """ Downloads complete through dropped connections and report their metrics """
+    results = run_benchmarks(
+        size_mb=SIZE_MB,
+        disk_kinds=["thick", "streamOptimized"],
+        strategies=["segments-4", "convert-raw"],
+        latency=0.01,
+        loss=0.1,
+    )
+    assert [(result["disk"], result["strategy"]) for result in results] == [
+        ("thick", "segments-4"),
+        ("streamOptimized", "segments-4"),
+        ("streamOptimized", "convert-raw"),
+    ]
+    for result in results:
+        assert result["error"] is None and result["lease_completed"]
+        assert result["mb_per_second"] > 0 and result["peak_rss_mb"] > 0
@@ -0,0 +1,67 @@
+""" Tests for the vmware cli """
+
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+from pyVmomi import vim
+
+import voithos.cli.vmware
+import voithos.lib.vmware.reports
+from voithos.lib.vmware.lease import VMWareExportLeaseNotReady
+
+
+def _get_props(vm):
+    """ Return the REPORT_PROPERTIES of a VM without devices, or nothing for vm-2 """
+    if vm._moId == "vm-2":
+        return {"obj": vm}
+    config = vim.vm.Summary.ConfigSummary(uuid=f"uuid-{vm._moId}", numCpu=1, memorySizeMB=1024)
+    return {"obj": vm, "name": vm._moId, "summary.config": config}
+
+
+class FakeInventory:
+    """ A FederatedInventory of three VMs, each in its own vCenter """
+
+    def __init__(self, *args, **kwargs):
+        self.records = [
+            {"vm": vim.VirtualMachine(f"vm-{num}", object()), "vcenter": f"vc{num}"}
+            for num in range(1, 4)
+        ]
+
+    def find_records_by_name(self, names):
+        return self.records
+
+    def find_record_by_uuid(self, uuid):
+        return self.records[0]
+
+    def get_mgr(self, record):
+        return None
+
+
+@patch("voithos.cli.vmware.FederatedInventory", FakeInventory)
+@patch.object(voithos.lib.vmware.reports, "retrieve_object_properties")
+def test_show_vm_skipped_vm(mock_retrieve):
+    """ A VM that can't be read is skipped, the VMs after it keep their own vCenter """
+    mock_retrieve.side_effect = lambda conn, objs, path_set, batch_size: [
+        _get_props(vm) for vm in objs
+    ]
+    runner = CliRunner()
+    result = runner.invoke(
+        voithos.cli.vmware.show_vm, ["-n", "*", "-f", "jsonl", "-i", "vc1", "--workers", "1"]
+    )
+    assert result.exit_code == 0, result.output
+    lines = [json.loads(line) for line in result.output.splitlines() if line.startswith("{")]
+    assert [(report["name"], report["vcenter"]) for report in lines] == [
+        ("vm-1", "vc1"),
+        ("vm-3", "vc3"),
+    ]
+
+
+@patch("voithos.cli.vmware.FederatedInventory", FakeInventory)
+@patch("voithos.cli.vmware.VMWareExporter")
+def test_download_vm_lease_not_ready(mock_exporter):
+    """ An NFC lease that never gets ready is reported as an error, not a traceback """
+    mock_exporter.side_effect = VMWareExportLeaseNotReady("ERROR - NFC lease failed: busy")
+    result = CliRunner().invoke(voithos.cli.vmware.download_vm, ["uuid-1", "-i", "vc1"])
+    assert result.exit_code == 1
+    assert "NFC lease failed: busy" in result.output
@@ -0,0 +1,71 @@
+""" Unit tests for the disk image writers """
+
+import os
+
+from voithos.lib.util.images import (
+    Qcow2ImageWriter,
+    RawImageWriter,
+    ZERO_BLOCK_SIZE,
+    punch_hole,
+    write_sparse,
+    zero_runs,
+)
+
+
+def _data():
+    """ 4 blocks: data, zeros, zeros, data """
+    block = ZERO_BLOCK_SIZE
+    return bytearray(b"\1" * block + b"\0" * block * 2 + b"\2" * block)
+
+
+def test_zero_runs():
+    """ Consecutive zero blocks are merged into one run """
+    data = _data()
+    block = ZERO_BLOCK_SIZE
+    runs = list(zero_runs(data, len(data)))
+    assert runs == [(0, block, False), (block, block * 3, True), (block * 3, block * 4, False)]
+
+
+def test_write_sparse(tmp_path):
+    """ Zero blocks are skipped, or punched out of existing data """
+    data = _data()
+    path = tmp_path / "disk.raw"
+    path.write_bytes(b"\7" * len(data))
+    fd = os.open(str(path), os.O_WRONLY)
+    try:
+        assert write_sparse(fd, data, len(data), 0, punch=True) == ZERO_BLOCK_SIZE * 2
+    finally:
+        os.close(fd)
+    assert path.read_bytes() == bytes(data)
+
+
+def test_punch_hole(tmp_path):
+    """ A punched region reads back as zeros """
+    path = tmp_path / "disk.raw"
+    path.write_bytes(b"\7" * 8192)
+    fd = os.open(str(path), os.O_WRONLY)
+    try:
+        punch_hole(fd, 4096, 4096)
+    finally:
+        os.close(fd)
+    assert path.read_bytes() == b"\7" * 4096 + b"\0" * 4096
+
+
+def test_raw_writer_counts_allocated(tmp_path):
+    """ The raw writer reports the bytes it really wrote """
+    data = bytes(_data())
+    writer = RawImageWriter(str(tmp_path / "disk.raw"), len(data) * 2)
+    writer.write(len(data), data)
+    writer.close()
+    assert writer.bytes_allocated == ZERO_BLOCK_SIZE * 2
+    assert (tmp_path / "disk.raw").read_bytes() == bytes(len(data)) + data
+
+
+def test_qcow2_writer_skips_zero_clusters(tmp_path):
+    """ All-zero clusters are never allocated in sparse mode """
+    data = bytes(_data())
+    writer = Qcow2ImageWriter(str(tmp_path / "disk.qcow2"), len(data))
+    writer.write(0, data)
+    writer.close()
+    assert writer.bytes_allocated == ZERO_BLOCK_SIZE * 2
+    assert sorted(writer.clusters) == [0, 3]
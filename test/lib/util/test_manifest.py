@@ -0,0 +1,67 @@
+""" Unit tests for integrity manifests """
+import hashlib
+import os
+
+from voithos.lib.util.manifest import IntegrityManifest, merkle_root, verify_file
+
+BLOCK_SIZE = 1024
+
+
+def _write_file(path, size):
+    """ Write size bytes of varied content to path and return them """
+    data = bytes(num % 251 for num in range(size))
+    with open(path, "wb") as data_file:
+        data_file.write(data)
+    return data
+
+
+def test_merkle_root():
+    """ Pairs are hashed together, an odd digest is carried up """
+    digests = [hashlib.sha256(bytes([num])).hexdigest() for num in range(3)]
+    left = hashlib.sha256(bytes.fromhex(digests[0]) + bytes.fromhex(digests[1])).digest()
+    expected = hashlib.sha256(left + bytes.fromhex(digests[2])).hexdigest()
+    assert merkle_root(digests) == expected
+    assert merkle_root(digests[:1]) == digests[0]
+
+
+def test_streams_match_file(tmp_path):
+    """ Hashes from out of order, unaligned streams equal a hash of the whole file """
+    path = str(tmp_path / "disk.vmdk")
+    size = BLOCK_SIZE * 5 + 100
+    data = _write_file(path, size)
+    streamed = IntegrityManifest(path, block_size=BLOCK_SIZE)
+    # Two streams split mid-block, the second fed in small chunks
+    first = streamed.stream(0)
+    first.update(data[:2500])
+    first.close(at_eof=False)
+    second = streamed.stream(2500)
+    for start in range(2500, size, 300):
+        end = start + 300
+        second.update(data[start:end])
+    second.close(at_eof=True)
+    streamed.finish(size)
+    assert streamed.rehashed_blocks == 1  # block 2 spans both streams
+    whole = IntegrityManifest(path, block_size=BLOCK_SIZE)
+    hasher = whole.stream(0, whole_file=True)
+    hasher.update(data)
+    hasher.close(at_eof=True)
+    whole.finish(size)
+    assert whole.rehashed_blocks == 0
+    assert whole.sha256 == hashlib.sha256(data).hexdigest()
+    assert streamed.blocks == whole.blocks and streamed.root == whole.root
+
+
+def test_verify_file(tmp_path):
+    """ A saved manifest verifies its file and finds a changed block """
+    path = str(tmp_path / "disk.vmdk")
+    size = BLOCK_SIZE * 3
+    _write_file(path, size)
+    manifest = IntegrityManifest(path, block_size=BLOCK_SIZE)
+    manifest.finish(size)
+    manifest.save()
+    assert verify_file(path) == []
+    with open(path, "r+b") as data_file:
+        data_file.seek(BLOCK_SIZE + 10)
+        data_file.write(b"x")
+    assert verify_file(path) == [1]
+    assert os.path.isfile(manifest.path)
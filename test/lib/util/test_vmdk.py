@@ -0,0 +1,84 @@
+""" Unit tests for the native VMDK parser """
+
+import struct
+
+from voithos.lib.util.vmdk import GD_AT_END, SPARSE_HEADER, get_vmdk_info, is_vmdk
+
+
+SECTOR = 512
+CAPACITY = 8192  # sectors, 4 MB
+GRAIN = 128  # sectors, 64 KB
+DESCRIPTOR = (
+    '# Disk DescriptorFile\nversion=1\ncreateType="{create_type}"\n'
+    'RW {capacity} SPARSE "disk.vmdk"\n'
+)
+
+
+def _header(gd_offset, compress=0):
+    """ Return a 512 byte SparseExtentHeader """
+    header = SPARSE_HEADER.pack(
+        b"KDMV", 3, 0x30001, CAPACITY, GRAIN, 1, 2, 512, 0, gd_offset, 8, 0, b"\n \r\n", compress
+    )
+    return header.ljust(SECTOR, b"\0")
+
+
+def _write_sparse(path, create_type, stream=False):
+    """Write a small sparse VMDK with grains 0 and 5 allocated
+    Layout: header, descriptor (2 sectors), GD (1 sector), GT (4 sectors), grains
+    """
+    gd_offset = GD_AT_END if stream else 3
+    body = bytearray(_header(gd_offset, compress=1 if stream else 0))
+    descriptor = DESCRIPTOR.format(create_type=create_type, capacity=CAPACITY).encode()
+    body += descriptor.ljust(SECTOR * 2, b"\0")
+    body += struct.pack("<I", 4).ljust(SECTOR, b"\0")
+    grain_table = [0] * 512
+    grain_table[0] = 8
+    grain_table[5] = 8 + GRAIN
+    body += struct.pack("<512I", *grain_table)
+    body += b"\1" * (GRAIN * SECTOR * 2)
+    if stream:
+        body += _header(3, compress=1)  # footer
+        body += b"\0" * SECTOR  # end-of-stream marker
+    path.write_bytes(bytes(body))
+
+
+def test_monolithic_sparse(tmp_path):
+    """ Capacity, grain size and allocation are read from a monolithicSparse header """
+    vmdk = tmp_path / "disk.vmdk"
+    _write_sparse(vmdk, "monolithicSparse")
+    info = get_vmdk_info(str(vmdk))
+    assert info["format"] == "monolithicSparse"
+    assert info["capacity_bytes"] == CAPACITY * SECTOR
+    assert info["grain_size_bytes"] == GRAIN * SECTOR
+    assert info["allocated_grains"] == 2
+    assert not info["compressed"]
+
+
+def test_stream_optimized_footer(tmp_path):
+    """ streamOptimized files are read through the footer's grain directory """
+    vmdk = tmp_path / "disk.vmdk"
+    _write_sparse(vmdk, "streamOptimized", stream=True)
+    info = get_vmdk_info(str(vmdk))
+    assert info["format"] == "streamOptimized"
+    assert info["compressed"]
+    assert info["allocated_grains"] == 2
+
+
+def test_descriptor_file(tmp_path):
+    """ Text descriptors report the sum of their extents """
+    vmdk = tmp_path / "disk.vmdk"
+    vmdk.write_text(
+        '# Disk DescriptorFile\ncreateType="vmfs"\n'
+        'RW 2048 VMFS "disk-flat.vmdk"\nRW 1024 VMFS "disk-flat2.vmdk"\n'
+    )
+    info = get_vmdk_info(str(vmdk))
+    assert info["format"] == "vmfs"
+    assert info["capacity_bytes"] == 3072 * SECTOR
+    assert info["allocated_bytes"] is None
+
+
+def test_not_vmdk(tmp_path):
+    """ Other files are rejected """
+    other = tmp_path / "disk.qcow2"
+    other.write_bytes(b"QFI\xfb" + b"\0" * 1020)
+    assert not is_vmdk(str(other))
@@ -0,0 +1,45 @@
+""" Unit tests for the on-disk inventory cache """
+from voithos.lib.vmware.cache import InventoryCache
+
+
+def _get_state(refreshed_at=0.0, version="1"):
+    """ Return a cache state """
+    return {"refreshed_at": refreshed_at, "collector": "pc-1", "version": version}
+
+
+def test_update_and_records(tmp_path):
+    """ Changes are applied in order and records join the ESXi host names """
+    cache = InventoryCache(str(tmp_path / "cache" / "inventory.db"))
+    assert cache.get_state("vc") is None
+    cache.update(
+        "vc",
+        _get_state(),
+        [
+            ("hosts", "enter", "host-1", {"name": "esxi-1"}),
+            ("vms", "enter", "vm-1", {"name": "a", "host": "host-1", "disk_bytes": 10}),
+            ("vms", "enter", "vm-2", {"name": "b"}),
+            ("vms", "modify", "vm-1", {"power_state": "poweredOn"}),
+            ("vms", "leave", "vm-2", {}),
+        ],
+    )
+    records = cache.get_records("vc")
+    assert [(row["mo_id"], row["host"], row["power_state"]) for row in records] == [
+        ("vm-1", "esxi-1", "poweredOn")
+    ]
+    assert records[0]["name"] == "a" and records[0]["disk_bytes"] == 10
+    assert cache.get_state("vc")["version"] == "1"
+    assert cache.get_records("other") == []
+
+
+def test_reset_and_freshness(tmp_path):
+    """ A reset drops only the objects of its vCenter, freshness follows the TTL """
+    cache = InventoryCache(str(tmp_path / "inventory.db"))
+    for vcenter in ("vc1", "vc2"):
+        cache.update(vcenter, _get_state(), [("vms", "enter", "vm-1", {"name": vcenter})])
+    cache.update("vc1", _get_state(version="2"), [("vms", "enter", "vm-9", {})], reset=True)
+    assert [row["mo_id"] for row in cache.get_records("vc1")] == ["vm-9"]
+    assert [row["name"] for row in cache.get_records("vc2")] == ["vc2"]
+    assert not cache.is_fresh(cache.get_state("vc1"), ttl=60)
+    assert cache.is_fresh(_get_state(refreshed_at=1e12), ttl=60)
+    assert not cache.is_fresh(None)
+    cache.close()
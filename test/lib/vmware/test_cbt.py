@@ -0,0 +1,151 @@
+""" Unit tests for Changed Block Tracking syncs """
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim
+
+import voithos.lib.vmware.cbt as cbt
+from voithos.lib.vmware.cbt import (
+    CbtError,
+    IncrementalSync,
+    load_cbt_state,
+    query_changed_extents,
+    save_cbt_state,
+)
+from voithos.lib.vmware.checkpoint import TransferCheckpoint
+
+MB = 1024 * 1024
+
+
+class FakeVM:
+    """ A powered off VM with CBT on, returning its changed areas in pages of one area """
+
+    def __init__(self, disk, areas):
+        self.runtime = SimpleNamespace(powerState=vim.VirtualMachine.PowerState.poweredOff)
+        self.config = SimpleNamespace(changeTrackingEnabled=True)
+        self.disk = disk
+        self.areas = areas
+        self.queries = []
+
+    def QueryChangedDiskAreas(self, **kwargs):  # pylint: disable=invalid-name
+        offset = kwargs["startOffset"]
+        self.queries.append((offset, kwargs["changeId"]))
+        later = [area for area in self.areas if area[0] >= offset]
+        if not later:
+            return SimpleNamespace(startOffset=offset, length=0, changedArea=[])
+        start, length = later[0]
+        area = SimpleNamespace(start=start, length=length)
+        return SimpleNamespace(
+            startOffset=offset, length=start + length - offset, changedArea=[area]
+        )
+
+
+def _disk(change_id, file_name="[ds1] vm/vm.vmdk"):
+    """ Return a 4 MB VirtualDisk """
+    backing = SimpleNamespace(fileName=file_name, changeId=change_id)
+    return SimpleNamespace(
+        key=2000,
+        capacityInBytes=4 * MB,
+        backing=backing,
+        deviceInfo=SimpleNamespace(label="Hard disk 1"),
+    )
+
+
+@pytest.fixture
+def sync(monkeypatch, tmp_path):
+    """ Return an IncrementalSync of a FakeVM, and the path of its disk image """
+    monkeypatch.setattr(cbt, "get_datacenter", lambda vm: SimpleNamespace(name="dc1"))
+    vm = FakeVM(_disk("52 aa/2"), [(0, MB), (3 * MB, MB // 2)])
+    syncer = IncrementalSync(None, vm, base_dir=str(tmp_path))
+    return syncer, syncer.get_image_path(vm.disk)
+
+
+def test_query_changed_extents_pages():
+    """ Areas are queried page by page until the end of the disk, and merged """
+    vm = FakeVM(_disk("52 aa/2"), [(0, MB), (MB, MB), (3 * MB, MB // 2)])
+    assert query_changed_extents(vm, vm.disk, "52 aa/1") == [(0, 2 * MB), (3 * MB, 7 * MB // 2)]
+    assert [offset for offset, _ in vm.queries] == [0, MB, 2 * MB, 7 * MB // 2]
+
+
+def test_first_sync_is_full(sync):
+    """ Without a previous sync, the whole disk is fetched """
+    syncer, image = sync
+    assert syncer._prepare(syncer.vm.disk, image) == "full"
+    state = load_cbt_state(image)
+    assert state["change_id"] is None and state["pending_change_id"] == "52 aa/2"
+
+
+def test_incremental_then_resume(sync):
+    """ Only the changed extents are left to fetch, an interrupted sync resumes as is """
+    syncer, image = sync
+    with open(image, "wb") as image_file:
+        image_file.truncate(4 * MB)
+    save_cbt_state(
+        image,
+        {
+            "device_key": 2000,
+            "backing_file": "[ds1] vm/vm.vmdk",
+            "capacity_bytes": 4 * MB,
+            "change_id": "52 aa/1",
+            "pending_change_id": None,
+        },
+    )
+    assert syncer._prepare(syncer.vm.disk, image) == "incremental"
+    assert syncer.vm.queries[0] == (0, "52 aa/1")
+    checkpoint = TransferCheckpoint.load(image)
+    assert checkpoint.missing_ranges() == [(0, MB), (3 * MB, 7 * MB // 2)]
+    assert load_cbt_state(image)["pending_change_id"] == "52 aa/2"
+    syncer.vm.queries = []
+    assert syncer._prepare(syncer.vm.disk, image) == "resume"
+    assert not syncer.vm.queries
+    # Another disk behind the same image path is fetched whole, its checkpoint dropped
+    syncer.vm.disk.backing.fileName = "[ds2] vm/vm.vmdk"
+    assert syncer._prepare(syncer.vm.disk, image) == "full"
+    assert TransferCheckpoint.load(image) is None
+
+
+def test_allocated_only_full_sync(sync):
+    """ A full sync with allocated_only leaves only the allocated extents to fetch, in a hole """
+    syncer, image = sync
+    with open(image, "wb") as image_file:
+        image_file.write(b"stale")
+    assert syncer._prepare(syncer.vm.disk, image, allocated_only=True) == "allocated"
+    assert syncer.vm.queries[0] == (0, "*")
+    with open(image, "rb") as image_file:
+        assert image_file.read(5) == bytes(5)
+    assert TransferCheckpoint.load(image).missing_ranges() == [(0, MB), (3 * MB, 7 * MB // 2)]
+
+
+def test_sync_failing_disk_cleans_up(sync, monkeypatch):
+    """ When a disk fails to start, the syncs already started are joined, the writers closed """
+    syncer, _ = sync
+    writer = SimpleNamespace(closed=False)
+    writer.close = lambda: setattr(writer, "closed", True)
+    started = []
+
+    class FakeDownload:
+        """ A DiskDownload that only records it ran """
+
+        def __init__(self, session, url, file_path, buffer_pool, **kwargs):
+            self.file_path = file_path
+
+        def run(self):
+            started.append(self.file_path)
+
+    def prepare(disk, file_path, snapshot=None, allocated_only=False):
+        if disk.key != 2000:
+            raise CbtError("boom")
+        return "full"
+
+    other = _disk("52 bb/1", file_name="[ds1] vm/vm_1.vmdk")
+    other.key = 2001
+    monkeypatch.setattr(cbt, "get_progress_writers", lambda *args, **kwargs: [writer])
+    monkeypatch.setattr(cbt, "get_session_cookies", lambda conn: {})
+    monkeypatch.setattr(cbt, "DiskDownload", FakeDownload)
+    monkeypatch.setattr(syncer, "get_disks", lambda snapshot=None: [syncer.vm.disk, other])
+    monkeypatch.setattr(syncer, "_prepare", prepare)
+    syncer.vmware_mgr = SimpleNamespace(conn=None, ip_addr="10.0.0.1")
+    with pytest.raises(CbtError):
+        syncer.sync()
+    assert started == [syncer.get_image_path(syncer.vm.disk)]
+    assert writer.closed
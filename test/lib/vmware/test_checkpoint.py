@@ -0,0 +1,24 @@
+""" Unit tests for VMware download checkpoints """
+
+from voithos.lib.vmware.checkpoint import TransferCheckpoint, merge_ranges
+
+
+def test_merge_ranges():
+    """ Overlapping and touching ranges are joined """
+    assert merge_ranges([(10, 20), (0, 5), (5, 8), (15, 30)]) == [(0, 8), (10, 30)]
+
+
+def test_checkpoint_round_trip(tmp_path):
+    """ A saved checkpoint reloads with the same ranges and reports the gaps """
+    data_file = tmp_path / "disk-0.vmdk"
+    data_file.write_bytes(b"")
+    checkpoint = TransferCheckpoint(str(data_file), 100)
+    checkpoint.add_range(0, 40)
+    checkpoint.add_range(60, 80)
+    loaded = TransferCheckpoint.load(str(data_file))
+    assert loaded.ranges == [(0, 40), (60, 80)]
+    assert loaded.verified_bytes == 60
+    assert loaded.missing_ranges() == [(40, 60), (80, 100)]
+    assert not loaded.complete
+    loaded.add_range(40, 100)
+    assert loaded.complete
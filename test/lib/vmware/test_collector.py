@@ -0,0 +1,134 @@
+""" Unit tests for bulk PropertyCollector retrieval """
+from types import SimpleNamespace
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.collector import (
+    retrieve_object_properties,
+    retrieve_properties,
+    wait_for_updates,
+)
+
+
+class FakeView(vim.view.ContainerView):
+    """ A ContainerView that records its destruction """
+
+    destroyed = False
+
+    def DestroyView(self):  # pylint: disable=invalid-name
+        self.destroyed = True
+
+
+class FakeCollector:
+    """ A PropertyCollector returning pre-made pages of results """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def _page(self, num):
+        objects = [
+            SimpleNamespace(
+                obj=name,
+                propSet=[SimpleNamespace(name="name", val=name)],
+                missingSet=[] if name != "broken" else [SimpleNamespace(path="config.uuid")],
+            )
+            for name in self.pages[num]
+        ]
+        token = str(num + 1) if num + 1 < len(self.pages) else None
+        return SimpleNamespace(objects=objects, token=token)
+
+    def RetrievePropertiesEx(self, specs, options):  # pylint: disable=invalid-name
+        self.calls.append(("retrieve", options.maxObjects))
+        return self._page(0)
+
+    def ContinueRetrievePropertiesEx(self, token):  # pylint: disable=invalid-name
+        self.calls.append(("continue", token))
+        return self._page(int(token))
+
+
+def test_retrieve_properties_pages():
+    """ Every page is read and the view is destroyed """
+    collector = FakeCollector([["vm-1", "vm-2"], ["broken"], ["vm-3"]])
+    view = FakeView("session[fake]view-1")
+    content = SimpleNamespace(
+        rootFolder="root",
+        propertyCollector=collector,
+        viewManager=SimpleNamespace(CreateContainerView=lambda container, types, recursive: view),
+    )
+    conn = SimpleNamespace(RetrieveContent=lambda: content)
+    results = retrieve_properties(conn, vim.VirtualMachine, ["name"], batch_size=2)
+    assert [result["name"] for result in results] == ["vm-1", "vm-2", "broken", "vm-3"]
+    assert results[0]["obj"] == "vm-1"
+    assert collector.calls == [("retrieve", 2), ("continue", "1"), ("continue", "2")]
+    assert view.destroyed
+
+
+def test_wait_for_updates_truncated():
+    """ Truncated update sets are followed up to the last version, unset properties are None """
+
+    def update(kind, obj, changes):
+        change_set = [SimpleNamespace(name=name, op=op, val=val) for name, op, val in changes]
+        return SimpleNamespace(kind=kind, obj=obj, changeSet=change_set)
+
+    update_sets = {
+        "": SimpleNamespace(
+            version="1",
+            truncated=True,
+            filterSet=[
+                SimpleNamespace(objectSet=[update("enter", "vm-1", [("name", "assign", "a")])])
+            ],
+        ),
+        "1": SimpleNamespace(
+            version="2",
+            truncated=False,
+            filterSet=[
+                SimpleNamespace(
+                    objectSet=[
+                        update("modify", "vm-1", [("config.uuid", "indirectRemove", None)]),
+                        update("leave", "vm-2", []),
+                    ]
+                )
+            ],
+        ),
+        "2": None,
+    }
+    calls = []
+
+    def wait(version, options):
+        calls.append(version)
+        return update_sets[version]
+
+    changes, version = wait_for_updates(SimpleNamespace(WaitForUpdatesEx=wait))
+    assert version == "2" and calls == ["", "1"]
+    assert changes == [
+        ("enter", {"obj": "vm-1", "name": "a"}),
+        ("modify", {"obj": "vm-1", "config.uuid": None}),
+        ("leave", {"obj": "vm-2"}),
+    ]
+    assert wait_for_updates(SimpleNamespace(WaitForUpdatesEx=wait), "2") == ([], "2")
+
+
+def test_retrieve_object_properties_batches():
+    """ Objects are read batch_size at a time and returned in their order """
+    batches = []
+
+    def retrieve(specs, options):
+        objs = [obj_spec.obj for obj_spec in specs[0].objectSet]
+        batches.append([obj._moId for obj in objs])
+        objects = [
+            SimpleNamespace(
+                obj=obj, propSet=[SimpleNamespace(name="name", val=obj._moId)], missingSet=None
+            )
+            for obj in objs
+            if obj._moId != "vm-2"
+        ]
+        return SimpleNamespace(objects=objects, token=None)
+
+    collector = SimpleNamespace(RetrievePropertiesEx=retrieve)
+    conn = SimpleNamespace(RetrieveContent=lambda: SimpleNamespace(propertyCollector=collector))
+    vms = [vim.VirtualMachine(f"vm-{num}") for num in (3, 1, 2)]
+    results = retrieve_object_properties(conn, vms, ["name"], batch_size=2)
+    assert batches == [["vm-3", "vm-1"], ["vm-2"]]
+    assert [result.get("name") for result in results] == ["vm-3", "vm-1", None]
+    assert results[2]["obj"] is vms[2]
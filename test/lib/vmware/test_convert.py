@@ -0,0 +1,106 @@
+""" Unit tests for inline streamOptimized VMDK conversion """
+
+import os
+import struct
+import zlib
+
+from voithos.lib.util.vmdk import GD_AT_END, SPARSE_HEADER
+from voithos.lib.vmware.convert import StreamConverter
+
+
+SECTOR = 512
+GRAIN = 128  # sectors
+
+
+def _header(capacity_sectors, gd_offset):
+    """ Return a streamOptimized header sector """
+    flags = 1 | (1 << 16) | (1 << 17)
+    header = SPARSE_HEADER.pack(
+        b"KDMV", 3, flags, capacity_sectors, GRAIN, 1, 1, 512, 0, gd_offset, 2, 0, b"\n \r\n", 1
+    )
+    return header.ljust(SECTOR, b"\0")
+
+
+def _metadata_marker(sectors, marker_type):
+    """ Return a metadata marker sector """
+    return struct.pack("<QII", sectors, 0, marker_type).ljust(SECTOR, b"\0")
+
+
+def build_stream_vmdk(raw):
+    """ Return a streamOptimized VMDK holding raw, skipping all-zero grains """
+    grain_bytes = GRAIN * SECTOR
+    capacity = -(-len(raw) // SECTOR)
+    out = bytearray(_header(capacity, GD_AT_END))
+    out += b'# Disk DescriptorFile\ncreateType="streamOptimized"\n'.ljust(SECTOR, b"\0")
+    for offset in range(0, len(raw), grain_bytes):
+        end = offset + grain_bytes
+        grain = raw[offset:end]
+        if not grain.strip(b"\0"):
+            continue
+        compressed = zlib.compress(grain)
+        marker = struct.pack("<QI", offset // SECTOR, len(compressed)) + compressed
+        out += marker.ljust(-(-len(marker) // SECTOR) * SECTOR, b"\0")
+    # An empty grain directory, then the footer and end-of-stream markers
+    gd_sector = len(out) // SECTOR + 1
+    out += _metadata_marker(1, 2) + b"\0" * SECTOR
+    out += _metadata_marker(1, 3) + _header(capacity, gd_sector)
+    out += b"\0" * SECTOR
+    return bytes(out)
+
+
+def read_qcow2(path):
+    """ Return the guest contents of a qcow2 image written without compression or backing """
+    with open(path, "rb") as image:
+        data = image.read()
+    assert data[:4] == b"QFI\xfb"
+    cluster_bits, size = struct.unpack_from(">IQ", data, 20)
+    l1_size, l1_offset = struct.unpack_from(">IQ", data, 36)
+    cluster = 1 << cluster_bits
+    mask = (1 << 56) - 1 - (cluster - 1)
+    guest = bytearray(size)
+    for l1_index in range(l1_size):
+        (l2_offset,) = struct.unpack_from(">Q", data, l1_offset + l1_index * 8)
+        if not l2_offset & mask:
+            continue
+        for l2_index in range(cluster // 8):
+            (entry,) = struct.unpack_from(">Q", data, (l2_offset & mask) + l2_index * 8)
+            guest_offset = (l1_index * (cluster // 8) + l2_index) * cluster
+            if entry & mask and guest_offset < size:
+                end = min(guest_offset + cluster, size)
+                host = entry & mask
+                host_end = host + end - guest_offset
+                guest[guest_offset:end] = data[host:host_end]
+    return bytes(guest)
+
+
+def _sample_disk():
+    """ 1 MB of data with a zero gap and a partly written grain """
+    raw = bytearray(os.urandom(1024 * 1024))
+    raw[slice(128 * 1024, 512 * 1024)] = b"\0" * (384 * 1024)
+    raw[slice(600 * 1024, 610 * 1024)] = b"\0" * (10 * 1024)
+    return bytes(raw)
+
+
+def _convert(stream, output_format, path, chunk=777):
+    """ Feed stream to a converter in small uneven chunks """
+    converter = StreamConverter(output_format, str(path), workers=3)
+    for offset in range(0, len(stream), chunk):
+        end = offset + chunk
+        converter.feed(memoryview(stream)[offset:end])
+    converter.close()
+    return converter
+
+
+def test_convert_raw(tmp_path):
+    """ A streamOptimized VMDK fed in chunks becomes the original raw disk """
+    raw = _sample_disk()
+    converter = _convert(build_stream_vmdk(raw), "raw", tmp_path / "disk.raw")
+    assert converter.capacity_bytes == len(raw)
+    assert (tmp_path / "disk.raw").read_bytes() == raw
+
+
+def test_convert_qcow2(tmp_path):
+    """ A streamOptimized VMDK fed in chunks becomes a qcow2 image of the original disk """
+    raw = _sample_disk()
+    _convert(build_stream_vmdk(raw), "qcow2", tmp_path / "disk.qcow2")
+    assert read_qcow2(str(tmp_path / "disk.qcow2")) == raw
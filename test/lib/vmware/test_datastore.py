@@ -0,0 +1,25 @@
+""" Unit tests for datastore HTTP URLs """
+from types import SimpleNamespace
+
+import pytest
+
+from voithos.lib.vmware.datastore import (
+    DatastorePathError,
+    get_disk_url,
+    parse_datastore_path,
+)
+
+
+def test_parse_datastore_path():
+    """ The datastore name and file path are split, bad paths raise """
+    assert parse_datastore_path("[ds 1] vm/vm.vmdk") == ("ds 1", "vm/vm.vmdk")
+    with pytest.raises(DatastorePathError):
+        parse_datastore_path("vm/vm.vmdk")
+
+
+def test_disk_url_points_to_flat_extent():
+    """ A disk is read from its -flat.vmdk, with the path and query quoted """
+    disk = SimpleNamespace(backing=SimpleNamespace(fileName="[ds 1] my vm/my vm_1.vmdk"))
+    assert get_disk_url("10.0.0.1", "DC #1", disk) == (
+        "https://10.0.0.1/folder/my%20vm/my%20vm_1-flat.vmdk?dcPath=DC+%231&dsName=ds+1"
+    )
@@ -0,0 +1,165 @@
+""" Unit tests for the VMware exporter backends """
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim
+
+import voithos.lib.vmware.exporter as exporter_lib
+from voithos.lib.vmware.datastore import DatastorePathError
+from voithos.lib.vmware.exporter import VMWareExporter
+
+
+MB = 1024 * 1024
+
+
+class FakeVM:
+    """ A powered off VM with a disk per file name, which fails if it gets exported """
+
+    def __init__(self, file_names=("[ds1] vm/vm.vmdk", "[ds 2] vm/vm_1.vmdk")):
+        self.runtime = SimpleNamespace(powerState=vim.VirtualMachine.PowerState.poweredOff)
+        disks = []
+        for num, file_name in enumerate(file_names):
+            disk = vim.vm.device.VirtualDisk(key=2000 + num, capacityInBytes=(num + 1) * MB)
+            disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName=file_name)
+            disks.append(disk)
+        self.config = SimpleNamespace(hardware=SimpleNamespace(device=disks))
+
+    def ExportVm(self):  # pylint: disable=invalid-name
+        raise AssertionError("The datastore backend must not take an NFC lease")
+
+
+class FakeDownload:
+    """ A DiskDownload writing as many zeros as the disk of its URL holds """
+
+    created = []
+
+    def __init__(self, session, url, file_path, buffer_pool, **kwargs):
+        self.url = url
+        self.file_path = file_path
+        self.kwargs = kwargs
+        self.sink = kwargs.get("sink")
+        self.manifest = None
+        self.error = None
+        self.total_bytes = (2 if "ds+2" in url else 1) * MB
+        self.bytes_written = self.bytes_allocated = self.resumed_bytes = 0
+        self.elapsed_seconds = 1
+        self.done = False
+        self.created.append(self)
+
+    def run(self):
+        with open(self.file_path, "wb") as image:
+            image.truncate(self.total_bytes)
+        self.bytes_written = self.total_bytes
+        self.done = True
+
+
+@pytest.fixture
+def exporter(monkeypatch, tmp_path):
+    """ Return a datastore backend exporter of a FakeVM, downloading with FakeDownload """
+    monkeypatch.setattr(exporter_lib, "get_datacenter", lambda vm: SimpleNamespace(name="dc1"))
+    monkeypatch.setattr(exporter_lib, "get_session_cookies", lambda conn: {})
+    monkeypatch.setattr(exporter_lib, "DiskDownload", FakeDownload)
+    mgr = SimpleNamespace(conn=None, ip_addr="10.0.0.1")
+    return VMWareExporter(mgr, FakeVM(), base_dir=str(tmp_path), interval=0, backend="datastore")
+
+
+def test_datastore_disk_sources(exporter):
+    """ Each disk is fetched from its flat extent, named after its key, without URL refreshes """
+    assert exporter.lease is None and exporter.lease_disks == []
+    assert exporter.get_disk_sources() == [
+        ("disk-2000.raw", "https://10.0.0.1/folder/vm/vm-flat.vmdk?dcPath=dc1&dsName=ds1", None),
+        (
+            "disk-2001.raw",
+            "https://10.0.0.1/folder/vm/vm_1-flat.vmdk?dcPath=dc1&dsName=ds+2",
+            None,
+        ),
+    ]
+
+
+def test_datastore_same_file_names(exporter, tmp_path):
+    """ Disks of different datastores with the same file name are saved to different files """
+    exporter.vm = FakeVM(["[ds1] web/web.vmdk", "[ds 2] web/web.vmdk"])
+    exporter.download(manifest=False)
+    assert (tmp_path / "disk-2000.raw").stat().st_size == MB
+    assert (tmp_path / "disk-2001.raw").stat().st_size == 2 * MB
+
+
+def test_datastore_snapshot_delta_disk(exporter):
+    """ The delta disks of a snapshotted VM have no flat extent, they are refused up front """
+    disk = exporter.vm.config.hardware.device[0]
+    disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+        fileName="[ds1] vm/vm-000001.vmdk", parent=disk.backing
+    )
+    with pytest.raises(DatastorePathError, match="without snapshots"):
+        exporter.get_disk_sources()
+
+
+def test_download_failing_early_closes_writers(exporter, monkeypatch):
+    """ The progress writers are closed when the download fails before it starts """
+    writer = SimpleNamespace(closed=False)
+    writer.close = lambda: setattr(writer, "closed", True)
+    monkeypatch.setattr(exporter_lib, "get_progress_writers", lambda *args, **kwargs: [writer])
+    exporter.vm = FakeVM(["[ds1] vm/vm.vmdk", "vm/not-on-a-datastore.vmdk"])
+    with pytest.raises(DatastorePathError):
+        exporter.download()
+    assert writer.closed
+
+
+def test_download_closes_writers_once(exporter, monkeypatch):
+    """ The progress monitor closes the writers, the exporter does not close them again """
+    writer = SimpleNamespace(closes=0, write_events=lambda events: None)
+    writer.close = lambda: setattr(writer, "closes", writer.closes + 1)
+    monkeypatch.setattr(exporter_lib, "get_progress_writers", lambda *args, **kwargs: [writer])
+    exporter.download(manifest=False)
+    assert writer.closes == 1
+
+
+def test_datastore_download(exporter, tmp_path):
+    """ The flat extents are downloaded as raw images, their thick size is their length """
+    FakeDownload.created.clear()
+    exporter.download(segments=4, disk_segments={"disk-2001.raw": 2}, manifest=False)
+    assert [dld.kwargs["segments"] for dld in FakeDownload.created] == [4, 2]
+    assert all(dld.kwargs["refresh_url"] is None for dld in FakeDownload.created)
+    assert (tmp_path / "disk-2000.raw").stat().st_size == MB
+    assert (tmp_path / "disk-2001.raw").stat().st_size == 2 * MB
+    with pytest.raises(ValueError):
+        exporter.download(convert_to="qcow2")
+    with pytest.raises(ValueError):
+        exporter.hold_nfc_lease()
+
+
+class FakeLeaseManager:
+    """ An NFC lease manager recording its calls """
+
+    def __init__(self):
+        self.calls = []
+
+    def start(self):
+        self.calls.append("start")
+
+    def abort(self):
+        self.calls.append("abort")
+
+    def complete(self):
+        self.calls.append("complete")
+
+
+def test_download_failing_setup_aborts_lease(exporter, monkeypatch):
+    """ The lease is kept alive once every disk started, a disk failing to start aborts it """
+
+    def create_download(session, url, file_path, buffer_pool, **kwargs):
+        if "ds+2" in url:
+            raise OSError("no space left")
+        return FakeDownload(session, url, file_path, buffer_pool, **kwargs)
+
+    FakeDownload.created.clear()
+    monkeypatch.setattr(exporter_lib, "DiskDownload", create_download)
+    exporter.lease_manager = FakeLeaseManager()
+    with pytest.raises(OSError):
+        exporter.download(manifest=False)
+    assert exporter.lease_manager.calls == ["abort"]
+    assert [dld.done for dld in FakeDownload.created] == [True]
+    monkeypatch.setattr(exporter_lib, "DiskDownload", FakeDownload)
+    exporter.lease_manager = FakeLeaseManager()
+    exporter.download(manifest=False)
+    assert exporter.lease_manager.calls == ["start", "complete"]
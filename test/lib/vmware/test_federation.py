@@ -0,0 +1,44 @@
+""" Unit tests for the multi-vCenter inventory """
+from threading import Barrier
+
+from pyVmomi import vim
+
+import voithos.lib.vmware.federation as federation
+from voithos.lib.vmware.index import InventoryIndex
+
+
+def test_get_ip_addrs(monkeypatch):
+    """ Repeated and comma separated values are merged, VMWARE_IP_ADDR is the default """
+    assert federation.get_ip_addrs(["vc1,vc2", " vc3 ", "vc1"]) == ["vc1", "vc2", "vc3"]
+    monkeypatch.setenv("VMWARE_IP_ADDR", "vc4,vc5")
+    assert federation.get_ip_addrs(()) == ["vc4", "vc5"]
+
+
+class FakeMgr:
+    """ A VMWareMgr with one VM per vCenter, all loaded at the same time """
+
+    barrier = Barrier(3, timeout=10)
+
+    def __init__(self, username, password, ip_addr, cache, refresh, ttl):
+        # Every vCenter must be loading at once for the barrier to let them through
+        self.barrier.wait()
+        vm = vim.VirtualMachine(f"vm-{ip_addr}")
+        self.vm_records = {
+            vm._moId: {"vm": vm, "name": f"web-{ip_addr}", "uuid": ip_addr, "vcenter": ip_addr}
+        }
+        self.index = InventoryIndex(self.vm_records.values())
+
+
+def test_federated_inventory(monkeypatch):
+    """ vCenters load in parallel and their records are searched as one index """
+    monkeypatch.setattr(federation, "VMWareMgr", FakeMgr)
+    inventory = federation.FederatedInventory(["vc1", "vc2", "vc3"], cache=False)
+    assert [record["vcenter"] for record in inventory.find_records_by_name(["web-"])] == [
+        "vc1",
+        "vc2",
+        "vc3",
+    ]
+    record = inventory.find_record_by_uuid("vc2")
+    assert record["vm"]._moId == "vm-vc2"
+    assert inventory.get_mgr(record) is inventory.mgrs["vc2"]
+    assert len(inventory.find_records_by_name(["*"])) == 3
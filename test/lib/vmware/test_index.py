@@ -0,0 +1,30 @@
+""" Unit tests for the inventory indexes """
+import random
+
+from voithos.lib.vmware.index import InventoryIndex
+
+
+def _records(names):
+    """ Return inventory records for names """
+    return [{"name": name, "uuid": f"uuid-{num}"} for num, name in enumerate(names)]
+
+
+def test_search_matches_scan():
+    """ Trigram search returns what a linear substring scan returns, in record order """
+    rng = random.Random(1)
+    names = ["".join(rng.choice("abcd-") for _ in range(rng.randint(0, 12))) for _ in range(500)]
+    records = _records(names) + [{"name": None, "uuid": None}]
+    index = InventoryIndex(records)
+    for patterns in (["ab"], ["abc", "d-a"], ["a", "bcd-"], ["zzz"], ["abcdabcd"]):
+        expected = [
+            rec for rec in records if rec["name"] and any(pat in rec["name"] for pat in patterns)
+        ]
+        assert index.search(patterns) == expected
+
+
+def test_uuid_and_name_maps():
+    """ UUIDs and exact names resolve directly """
+    index = InventoryIndex(_records(["web", "web", "db"]))
+    assert index.get_by_uuid("uuid-2")["name"] == "db"
+    assert index.get_by_uuid("nope") is None
+    assert [rec["uuid"] for rec in index.get_by_name("web")] == ["uuid-0", "uuid-1"]
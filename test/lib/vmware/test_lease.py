@@ -0,0 +1,155 @@
+""" Unit tests for the NFC lease manager """
+from time import sleep
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim
+
+import voithos.lib.vmware.lease as lease_lib
+from voithos.lib.vmware.lease import NfcLeaseError, NfcLeaseManager, VMWareExportLeaseNotReady
+
+
+class FakeLease:
+    """ An NFC lease whose renewals fail once lost is set """
+
+    def __init__(self, num, state="ready"):
+        self.state = state
+        self.lost = False
+        self.calls = []
+        device = SimpleNamespace(targetId="disk-0.vmdk", disk=True, url=f"https://*/nfc/{num}/d0")
+        iso = SimpleNamespace(targetId=None, disk=False, url="https://*/nfc/iso")
+        self.info = SimpleNamespace(deviceUrl=[device, iso])
+
+    def HttpNfcLeaseProgress(self, percent):  # pylint: disable=invalid-name
+        if self.lost:
+            raise vim.fault.Timedout(msg="lease timed out")
+        self.calls.append(("progress", percent))
+
+    def HttpNfcLeaseAbort(self):  # pylint: disable=invalid-name
+        self.calls.append(("abort",))
+
+    def HttpNfcLeaseComplete(self):  # pylint: disable=invalid-name
+        self.calls.append(("complete",))
+
+
+class FakeCollector:
+    """ A PropertyCollector reporting a sequence of lease states, one per wait """
+
+    def __init__(self, states):
+        self.states = list(states)
+        self.waits = []
+        self.destroyed = False
+
+    def WaitForUpdatesEx(self, version, options):  # pylint: disable=invalid-name
+        self.waits.append(options.maxWaitSeconds)
+        if not self.states:
+            return None
+        state, error = self.states.pop(0)
+        change_set = [SimpleNamespace(name="state", op="assign", val=state)]
+        if error is not None:
+            change_set.append(SimpleNamespace(name="error", op="assign", val=error))
+        update = SimpleNamespace(kind="modify", obj="lease", changeSet=change_set)
+        return SimpleNamespace(
+            version=str(len(self.waits)),
+            truncated=False,
+            filterSet=[SimpleNamespace(objectSet=[update])],
+        )
+
+    def DestroyPropertyCollector(self):  # pylint: disable=invalid-name
+        self.destroyed = True
+
+
+class FakeVM:
+    """ A VM handing out a new FakeLease on each export """
+
+    def __init__(self):
+        self.leases = []
+
+    def ExportVm(self):  # pylint: disable=invalid-name
+        self.leases.append(FakeLease(len(self.leases)))
+        return self.leases[-1]
+
+
+@pytest.fixture
+def collectors(monkeypatch):
+    """ Make each lease report initializing, then ready """
+    created = []
+
+    def create(conn, obj, path_set):
+        created.append(FakeCollector([("initializing", None), ("ready", None)]))
+        return created[-1]
+
+    monkeypatch.setattr(lease_lib, "create_object_collector", create)
+    return created
+
+
+def test_acquire_waits_for_ready(collectors):
+    """ The lease is ready after the collector reports it, its disk URLs point to the vCenter """
+    manager = NfcLeaseManager(None, FakeVM(), "10.0.0.1")
+    manager.acquire()
+    assert len(collectors[0].waits) == 2
+    assert collectors[0].destroyed
+    assert manager.urls == {"disk-0.vmdk": "https://10.0.0.1/nfc/0/d0"}
+    assert [dev.targetId for dev in manager.disks] == ["disk-0.vmdk"]
+
+
+def test_acquire_lease_error(monkeypatch):
+    """ A lease in error raises with its fault message """
+    fault = SimpleNamespace(msg="no space")
+    collector = FakeCollector([("error", fault)])
+    monkeypatch.setattr(lease_lib, "create_object_collector", lambda *args: collector)
+    manager = NfcLeaseManager(None, FakeVM(), "10.0.0.1")
+    with pytest.raises(VMWareExportLeaseNotReady, match="no space"):
+        manager.acquire()
+    assert collector.destroyed
+
+
+def test_refresh_url_reacquires_lost_lease(collectors):
+    """ A failed URL of a lost lease is replaced once, by the URL of a new lease """
+    vm = FakeVM()
+    manager = NfcLeaseManager(None, vm, "10.0.0.1", max_reacquire=1)
+    manager.acquire()
+    old_url = manager.urls["disk-0.vmdk"]
+    assert manager.refresh_url(old_url) is None  # The lease is fine
+    vm.leases[0].lost = True
+    new_url = manager.refresh_url(old_url)
+    assert new_url == "https://10.0.0.1/nfc/1/d0"
+    assert ("abort",) in vm.leases[0].calls
+    # Another download failing on the old URL gets the new one without a new export
+    assert manager.refresh_url(old_url) == new_url
+    assert len(vm.leases) == 2
+    vm.leases[1].lost = True
+    with pytest.raises(NfcLeaseError):
+        manager.refresh_url(new_url)
+
+
+def test_keepalive_renews_with_progress(collectors):
+    """ The keepalive thread reports the progress, complete() sends 100% """
+    vm = FakeVM()
+    manager = NfcLeaseManager(None, vm, "10.0.0.1", keepalive_interval=0.01)
+    manager.acquire()
+    manager.set_progress(100)
+    manager.start()
+    while not vm.leases[0].calls:
+        sleep(0.01)
+    manager.complete()
+    calls = vm.leases[0].calls
+    assert calls[0] == ("progress", 99)
+    assert calls[-2:] == [("progress", 100), ("complete",)]
+
+
+def test_keepalive_stops_on_any_fault(collectors):
+    """ Any fault of a renewal re-acquires the lease, the keepalive stops if that fails too """
+    vm = FakeVM()
+    manager = NfcLeaseManager(None, vm, "10.0.0.1", keepalive_interval=0.01)
+    manager.acquire()
+
+    def fail(*args):
+        raise vim.fault.NotAuthenticated(msg="session expired")
+
+    vm.leases[0].HttpNfcLeaseProgress = fail
+    vm.ExportVm = fail
+    manager.start()
+    with pytest.raises(NfcLeaseError, match="session expired"):
+        manager.join()
+    assert manager.reacquired == 1
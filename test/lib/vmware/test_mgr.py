@@ -0,0 +1,188 @@
+""" Unit tests for the VMWareMgr inventory """
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from pyVmomi import vim
+
+import voithos.lib.vmware.mgr as mgr_lib
+from voithos.lib.vmware.cache import InventoryCache
+
+
+def _fake_retrieve(conn, obj_type, path_set):
+    """ Stand in for retrieve_properties with two hosts and three VMs """
+    if obj_type is vim.HostSystem:
+        return [{"obj": vim.HostSystem(f"host-{num}"), "name": f"esxi-{num}"} for num in (1, 2)]
+    return [
+        {
+            "obj": vim.VirtualMachine("vm-1"),
+            "name": "web-01",
+            "config.uuid": "uuid-1",
+            "runtime.powerState": "poweredOff",
+            "runtime.host": vim.HostSystem("host-1"),
+            "config.hardware.device": [],
+        },
+        {
+            "obj": vim.VirtualMachine("vm-2"),
+            "name": "db-01",
+            "config.uuid": "uuid-2",
+            "runtime.powerState": "poweredOn",
+            "runtime.host": vim.HostSystem("host-2"),
+        },
+        {"obj": vim.VirtualMachine("vm-3"), "name": "inaccessible"},
+    ]
+
+
+def _get_mgr(monkeypatch):
+    """ Return a VMWareMgr loaded from _fake_retrieve, without connecting """
+    monkeypatch.setattr(mgr_lib, "retrieve_properties", _fake_retrieve)
+    mgr = mgr_lib.VMWareMgr.__new__(mgr_lib.VMWareMgr)
+    mgr.ip_addr = "vcenter"
+    mgr.load_vms()
+    return mgr
+
+
+def test_load_vms(monkeypatch):
+    """ Records hold the bulk-loaded properties, with the host resolved to its name """
+    mgr = _get_mgr(monkeypatch)
+    assert len(mgr.vms) == 3
+    record = mgr.get_vm_record(vim.VirtualMachine("vm-2"))
+    assert record["name"] == "db-01" and record["host"] == "esxi-2"
+    assert record["disk_bytes"] == 0 and record["vcenter"] == "vcenter"
+    assert mgr.get_vm_record(vim.VirtualMachine("vm-3"))["uuid"] is None
+
+
+def test_find_vms(monkeypatch):
+    """ Lookups are answered from the records """
+    mgr = _get_mgr(monkeypatch)
+    assert mgr.find_vm_by_uuid("uuid-1")._moId == "vm-1"
+    assert mgr.find_vm_by_uuid("missing") is None
+    assert [vm._moId for vm in mgr.find_vms_by_name(["-01"])] == ["vm-1", "vm-2"]
+    assert len(list(mgr.find_vms_by_name(["*"]))) == 3
+
+
+def test_find_vms_by_exact_name(monkeypatch):
+    """ Exact names do not match longer names that contain them """
+    mgr = _get_mgr(monkeypatch)
+    assert [vm._moId for vm in mgr.find_vms_by_exact_name("web-01")] == ["vm-1"]
+    assert mgr.find_vms_by_exact_name("web") == []
+
+
+def _get_cached_mgr(monkeypatch, tmp_path, updates):
+    """ Return a VMWareMgr on an empty cache, whose collector returns each of updates in turn """
+    versions = iter(range(len(updates)))
+    calls = []
+
+    def fake_wait(collector, version=""):
+        calls.append(version)
+        return updates[len(calls) - 1], str(next(versions))
+
+    monkeypatch.setattr(mgr_lib, "wait_for_updates", fake_wait)
+    monkeypatch.setattr(
+        mgr_lib, "create_update_collector", lambda conn, path_sets: SimpleNamespace(_moId="pc-1")
+    )
+    mgr = mgr_lib.VMWareMgr.__new__(mgr_lib.VMWareMgr)
+    mgr.ip_addr = "vcenter"
+    mgr.username = "administrator@vsphere.local"
+    mgr.cache = InventoryCache(str(tmp_path / "inventory.db"))
+    mgr.conn = SimpleNamespace(_stub=SimpleNamespace(cookie="cookie", version="vim.version.v1"))
+    return mgr, calls
+
+
+def test_refresh_cache(monkeypatch, tmp_path):
+    """ The first refresh loads everything, the next ones apply the changes since its version """
+    disk = vim.vm.device.VirtualDisk(capacityInBytes=1024)
+    first = [
+        ("enter", {"obj": vim.HostSystem("host-1"), "name": "esxi-1"}),
+        (
+            "enter",
+            {
+                "obj": vim.VirtualMachine("vm-1"),
+                "name": "web-01",
+                "config.uuid": "uuid-1",
+                "runtime.powerState": "poweredOff",
+                "runtime.host": vim.HostSystem("host-1"),
+                "config.hardware.device": [disk],
+            },
+        ),
+        ("enter", {"obj": vim.VirtualMachine("vm-2"), "name": "db-01"}),
+    ]
+    second = [
+        ("modify", {"obj": vim.VirtualMachine("vm-1"), "runtime.powerState": "poweredOn"}),
+        ("leave", {"obj": vim.VirtualMachine("vm-2")}),
+        ("modify", {"obj": vim.HostSystem("host-1"), "name": "esxi-01"}),
+    ]
+    mgr, calls = _get_cached_mgr(monkeypatch, tmp_path, [first, second])
+    mgr.refresh_cache()
+    assert [row["mo_id"] for row in mgr.cache.get_records(mgr.cache_key)] == ["vm-1", "vm-2"]
+    state = mgr.cache.get_state(mgr.cache_key)
+    assert state["collector"] == "pc-1" and state["version"] == "0"
+    mgr.refresh_cache(state)
+    assert calls == ["", "0"]
+    assert mgr.cache.get_records(mgr.cache_key) == [
+        {
+            "mo_id": "vm-1",
+            "name": "web-01",
+            "uuid": "uuid-1",
+            "power_state": "poweredOn",
+            "host": "esxi-01",
+            "disk_bytes": 1024,
+        }
+    ]
+    assert mgr.cache.get_state(mgr.cache_key)["version"] == "1"
+
+
+def test_load_cached_vms(monkeypatch, tmp_path):
+    """ A fresh cache is used without asking vCenter for changes, unless refreshing """
+    first = [("enter", {"obj": vim.VirtualMachine("vm-1"), "name": "web-01"})]
+    second = [("modify", {"obj": vim.VirtualMachine("vm-1"), "name": "web-02"})]
+    mgr, calls = _get_cached_mgr(monkeypatch, tmp_path, [first, second])
+    monkeypatch.setattr(mgr, "resume_session", lambda cookie, api_version: True)
+    mgr.refresh_cache()
+    mgr.load_cached_vms()
+    assert calls == [""]
+    assert [vm._moId for vm in mgr.find_vms_by_name(["web-01"])] == ["vm-1"]
+    mgr.load_cached_vms(refresh=True)
+    assert calls == ["", "0"]
+    assert mgr.find_vms_by_exact_name("web-02")[0]._moId == "vm-1"
+
+
+def _resume(monkeypatch, user_name, age):
+    """ Resume a cached session of user_name logged in age seconds ago, return the logouts """
+    logouts = []
+    now = datetime(2024, 1, 1)
+    session = SimpleNamespace(userName=user_name, loginTime=now - timedelta(seconds=age))
+    session_mgr = SimpleNamespace(currentSession=session, Logout=lambda: logouts.append(1))
+    content = SimpleNamespace(sessionManager=session_mgr)
+    service = SimpleNamespace(RetrieveContent=lambda: content, CurrentTime=lambda: now)
+    monkeypatch.setattr(mgr_lib, "SoapStubAdapter", lambda **kwargs: SimpleNamespace())
+    monkeypatch.setattr(mgr_lib.vim, "ServiceInstance", lambda mo_id, stub: service)
+    mgr = mgr_lib.VMWareMgr.__new__(mgr_lib.VMWareMgr)
+    mgr.ip_addr = "vcenter"
+    mgr.username = "administrator@vsphere.local"
+    resumed = mgr.resume_session("cookie", "vim.version.v1")
+    assert resumed == (mgr.conn is service)
+    mgr.conn = None  # Nothing to disconnect
+    return resumed, len(logouts)
+
+
+def test_resume_session(monkeypatch):
+    """ Only a recent session of the same user is resumed, the others are logged out """
+    assert _resume(monkeypatch, "VSPHERE.LOCAL\\Administrator", 60) == (True, 0)
+    assert _resume(monkeypatch, "VSPHERE.LOCAL\\readonly", 60) == (False, 1)
+    assert _resume(monkeypatch, "VSPHERE.LOCAL\\Administrator", mgr_lib.SESSION_TTL + 1) == (
+        False,
+        1,
+    )
+
+
+def test_cache_key():
+    """ The cached inventory and session of each user on a vCenter are kept apart """
+    mgr = mgr_lib.VMWareMgr.__new__(mgr_lib.VMWareMgr)
+    mgr.ip_addr = "vcenter"
+    mgr.username = "admin"
+    other = mgr_lib.VMWareMgr.__new__(mgr_lib.VMWareMgr)
+    other.ip_addr = "vcenter"
+    other.username = "readonly"
+    assert mgr.cache_key != other.cache_key
+    assert mgr_lib._is_same_user("VSPHERE.LOCAL\\Admin", "admin")
+    assert not mgr_lib._is_same_user("CORP\\admin", "admin@vsphere.local")
@@ -0,0 +1,81 @@
+""" Unit tests for the capacity planner """
+import json
+
+import pytest
+
+from voithos.lib.vmware.plan import CapacityPlan, PlanInputError, load_flavors
+
+FLAVORS = [
+    {"name": "large", "vcpus": 4, "ram_mb": 8192, "disk_gb": 80},
+    {"name": "small", "vcpus": 1, "ram_mb": 2048, "disk_gb": 20},
+    {"name": "medium", "vcpus": 2, "ram_mb": 4096, "disk_gb": 40},
+]
+
+
+def _row(name, num_cpu, ram_mb, disk_gb, used_gb=0.0, thin_disk_gb=0.0):
+    """ Return a capacity row """
+    return {
+        "vcenter": "vc1",
+        "uuid": name,
+        "name": name,
+        "num_cpu": num_cpu,
+        "ram_mb": ram_mb,
+        "disk_gb": disk_gb,
+        "thin_disk_gb": thin_disk_gb,
+        "used_gb": used_gb,
+    }
+
+
+def test_best_flavors():
+    """ Each VM gets the smallest flavor it fits in, or none """
+    capacity_plan = CapacityPlan(
+        [
+            _row("a", 1, 1024, 10.0),
+            _row("b", 2, 2048, 20.5),
+            _row("c", 4, 8192, 80.0),
+            _row("d", 8, 8192, 10.0),
+        ]
+    )
+    assert capacity_plan.get_best_flavors(FLAVORS).tolist() == [1, 2, 0, -1]
+    assert [row[3] for row in capacity_plan.get_vm_flavors(FLAVORS)] == [
+        "small",
+        "medium",
+        "large",
+        None,
+    ]
+    volume_flavor = [{"name": "boot-from-volume", "vcpus": 8, "ram_mb": 8192, "disk_gb": 0}]
+    assert capacity_plan.get_best_flavors(volume_flavor).tolist() == [0, 0, 0, 0]
+
+
+def test_summarize():
+    """ Totals, thin storage falling back to capacity, and flavor counts """
+    capacity_plan = CapacityPlan(
+        [
+            _row("a", 1, 1024, 60.0, used_gb=30.0, thin_disk_gb=60.0),
+            _row("b", 2, 4096, 40.0),
+        ]
+    )
+    summary = capacity_plan.summarize(FLAVORS)
+    assert summary["vms"] == 2
+    assert summary["totals"] == {"vcpus": 3, "ram_mb": 5120, "disk_gb": 100.0}
+    assert summary["storage"] == {
+        "thick_gb": 100.0,
+        "thin_gb": 70.0,
+        "thin_provisioned_disks_gb": 60.0,
+        "vms_without_guest_usage": 1,
+    }
+    assert summary["percentiles"]["num_cpu"]["max"] == 2.0
+    assert summary["flavors"] == {"large": 1, "medium": 1}
+    assert summary["flavor_totals"] == {"vcpus": 6, "ram_mb": 12288, "disk_gb": 120}
+    assert summary["unfit_vms"] == []
+    assert CapacityPlan([]).summarize()["totals"]["vcpus"] == 0
+
+
+def test_load_flavors(tmp_path):
+    """ The openstack CLI's flavor list format is accepted """
+    path = tmp_path / "flavors.json"
+    path.write_text(json.dumps([{"Name": "m1", "VCPUs": 1, "RAM": 512, "Disk": 1}]))
+    assert load_flavors(str(path)) == [{"name": "m1", "vcpus": 1, "ram_mb": 512, "disk_gb": 1}]
+    path.write_text("{}")
+    with pytest.raises(PlanInputError):
+        load_flavors(str(path))
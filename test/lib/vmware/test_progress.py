@@ -0,0 +1,68 @@
+""" Unit tests for VMware download progress events """
+import io
+import json
+
+from voithos.lib.vmware.progress import (
+    JsonLinesProgressWriter,
+    ProgressMonitor,
+    TextProgressWriter,
+)
+
+
+class FakeTransfer:
+    """ The byte counters of a DiskDownload """
+
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        self.bytes_written = 0
+        self.bytes_allocated = 0
+        self.done = False
+        self.error = None
+
+
+def test_monitor_events():
+    """ Byte counters become disk and total events, idle disks are reported as stalled """
+    busy = FakeTransfer(1000)
+    idle = FakeTransfer(1000)
+    monitor = ProgressMonitor([("busy", busy), ("idle", idle)], 2000, [], stall_seconds=0)
+    busy.bytes_written = busy.bytes_allocated = 500
+    events = monitor.sample()
+    kinds = [event["event"] for event in events]
+    assert kinds == ["disk", "disk", "stall", "total"]
+    assert events[0]["bytes"] == 500 and not events[0]["stalled"]
+    assert events[0]["rate_bps"] > 0 and events[0]["eta_seconds"] is not None
+    assert events[2]["disk"] == "idle"
+    assert events[-1]["percent"] == 25
+    assert events[-1]["stalled"] == 1
+    busy.bytes_written = 1000
+    busy.done = True
+    kinds = [event["event"] for event in monitor.sample()]
+    assert kinds == ["disk", "done", "disk", "total"]
+
+
+def test_json_lines_writer():
+    """ stop() sends a final "finished" event, one JSON object per line """
+    transfer = FakeTransfer(10)
+    transfer.bytes_written = 10
+    transfer.done = True
+    stream = io.StringIO()
+    monitor = ProgressMonitor([("disk", transfer)], 10, [JsonLinesProgressWriter(stream)])
+    monitor.start()
+    monitor.stop()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert events[-1]["event"] == "finished"
+    assert events[-1]["percent"] == 100
+
+
+def test_text_writer_label():
+    """ Every printed line starts with the label of its export """
+    transfer = FakeTransfer(10)
+    transfer.bytes_written = 10
+    transfer.done = True
+    stream = io.StringIO()
+    writer = TextProgressWriter(0, stream=stream, label="web-01")
+    monitor = ProgressMonitor([("disk", transfer)], 10, [writer])
+    monitor.start()
+    monitor.stop()
+    lines = [line for line in stream.getvalue().splitlines() if line]
+    assert lines and all(line.startswith("[web-01] ") for line in lines)
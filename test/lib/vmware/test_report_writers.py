@@ -0,0 +1,59 @@
+""" Unit tests for the streaming VM report writers """
+import csv
+import io
+import json
+
+from voithos.lib.vmware.report_writers import CSV_COLUMNS, WRITERS, get_report_writer
+
+
+def _report(name, vswitch):
+    """ Return a minimal VM report """
+    return {
+        "uuid": f"uuid-{name}",
+        "name": name,
+        "guest_os": "Linux",
+        "num_cpu": 1,
+        "ram": {"total_mb": 1024},
+        "storage": {
+            "num_disks": 1,
+            "disks": [{"capacity_gb": 10.0, "shared": False}],
+            "partitions": {"total_used_gb": 1.234},
+        },
+        "network": {"num_interfaces": 1, "networks": [{"vswitch_name": vswitch}]},
+        "vcenter": "vc1",
+    }
+
+
+def _write_all(report_format, reports, stream):
+    """ Write reports with the writer of report_format """
+    writer = WRITERS[report_format](stream)
+    for report in reports:
+        writer.write(report)
+    writer.close()
+
+
+def test_json_writers():
+    """ json matches json.dumps of the whole list, jsonl writes a line per report """
+    reports = [_report("a", "net"), _report("b", "net")]
+    for reports_in in ([], reports):
+        stream = io.StringIO()
+        _write_all("json", reports_in, stream)
+        assert stream.getvalue() == json.dumps(reports_in) + "\n"
+    stream = io.StringIO()
+    _write_all("jsonl", reports, stream)
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == reports
+
+
+def test_csv_writer_quotes(tmp_path):
+    """ Commas and quotes in values survive a round trip through the csv module """
+    path = str(tmp_path / "vms.csv")
+    writer = get_report_writer("csv", path)
+    writer.write(_report('web, "01"', "VM Network, DMZ"))
+    writer.close()
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == CSV_COLUMNS
+    row = dict(zip(CSV_COLUMNS, rows[1]))
+    assert row["name"] == 'web, "01"' and row["net_list"] == "VM Network, DMZ"
+    assert row["used_storage_gb"] == "1.23" and row["shared_storage"] == "no"
+    assert len(rows) == 2
@@ -0,0 +1,124 @@
+""" Unit tests for the VM reports """
+import random
+from threading import Lock
+from time import sleep
+
+from pyVmomi import vim
+
+import voithos.lib.vmware.reports as reports
+
+GB = 1024 * 1024 * 1024
+
+
+def _get_props(vm):
+    """ Return the REPORT_PROPERTIES of a VM with one disk and one NIC """
+    disk = vim.vm.device.VirtualDisk(
+        capacityInBytes=10 * GB,
+        deviceInfo=vim.Description(label="Hard disk 1"),
+        backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            uuid="disk-uuid", thinProvisioned=True, sharing="sharingNone"
+        ),
+    )
+    nic = vim.vm.device.VirtualVmxnet3(
+        macAddress="00:50:56:00:00:01",
+        deviceInfo=vim.Description(label="Network adapter 1"),
+        backing=vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName="VM Network"),
+        connectable=vim.vm.device.VirtualDevice.ConnectInfo(connected=True),
+        slotInfo=vim.vm.device.VirtualDevice.PciBusSlotInfo(pciSlotNumber=192),
+    )
+    return {
+        "obj": vm,
+        "name": "web-01",
+        "summary.config": vim.vm.Summary.ConfigSummary(
+            uuid="uuid-1",
+            guestFullName="Ubuntu Linux (64-bit)",
+            numCpu=2,
+            memorySizeMB=4096,
+            numVirtualDisks=1,
+            numEthernetCards=1,
+        ),
+        "summary.overallStatus": "green",
+        "runtime.powerState": "poweredOn",
+        "guest.disk": [vim.vm.GuestInfo.DiskInfo(diskPath="/", capacity=8 * GB, freeSpace=6 * GB)],
+        "config.hardware.device": [disk, nic],
+    }
+
+
+def test_build_vm_data():
+    """ Reports are built from the property dicts alone """
+    report = reports.build_vm_data(_get_props(vim.VirtualMachine("vm-1")))
+    assert report["uuid"] == "uuid-1" and report["num_cpu"] == 2
+    assert report["uptime_seconds"] is None and report["create_date"] == "None"
+    assert report["storage"]["partitions"]["total_used_gb"] == 2.0
+    assert report["storage"]["disks"] == [
+        {
+            "label": "Hard disk 1",
+            "uuid": "disk-uuid",
+            "thin_provisioned": True,
+            "shared": False,
+            "capacity_gb": 10.0,
+        }
+    ]
+    assert report["network"]["networks"][0]["vswitch_name"] == "VM Network"
+    assert report["network"]["networks"][0]["pci_slot_num"] == 192
+
+
+def test_get_vms_data(monkeypatch):
+    """ VMs are read in one call per vCenter and batch """
+    calls = []
+
+    def fake_retrieve(conn, objs, path_set, batch_size):
+        calls.append([vm._moId for vm in objs])
+        return [_get_props(vm) for vm in objs]
+
+    monkeypatch.setattr(reports, "retrieve_object_properties", fake_retrieve)
+    stub1, stub2 = object(), object()
+    vms = [
+        vim.VirtualMachine("vm-1", stub1),
+        vim.VirtualMachine("vm-2", stub2),
+        vim.VirtualMachine("vm-3", stub1),
+    ]
+    assert len(reports.get_vms_data(vms, workers=1)) == 3
+    assert calls == [["vm-1", "vm-3"], ["vm-2"]]
+    calls.clear()
+    assert len(reports.get_vms_data(vms, batch_size=2, workers=1)) == 3
+    assert calls == [["vm-1"], ["vm-2"], ["vm-3"]]
+
+
+def test_unreadable_vm_skipped(monkeypatch, capsys):
+    """ A VM whose properties could not be read is skipped with a warning, the others reported """
+
+    def fake_retrieve(conn, objs, path_set, batch_size):
+        return [{"obj": vm} if vm._moId == "vm-2" else _get_props(vm) for vm in objs]
+
+    monkeypatch.setattr(reports, "retrieve_object_properties", fake_retrieve)
+    vms = [vim.VirtualMachine(f"vm-{num}", object()) for num in range(1, 4)]
+    assert len(reports.get_vms_data(vms, workers=1)) == 2
+    assert "vm-2" in capsys.readouterr().err
+    assert reports.get_vm_data(vms[1]) is None
+
+
+def test_iter_vms_data_parallel(monkeypatch):
+    """ Batches are read concurrently, within the read-ahead window, and yielded in order """
+    lock = Lock()
+    state = {"running": 0, "peak": 0, "started": 0}
+
+    def fake_retrieve(conn, objs, path_set, batch_size):
+        with lock:
+            state["started"] += 1
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        sleep(random.uniform(0, 0.01))
+        with lock:
+            state["running"] -= 1
+        return [dict(_get_props(vm), name=vm._moId) for vm in objs]
+
+    monkeypatch.setattr(reports, "retrieve_object_properties", fake_retrieve)
+    vms = [vim.VirtualMachine(f"vm-{num}", object()) for num in range(40)]
+    names = []
+    for _, report in reports.iter_vms_data(vms, batch_size=1, workers=4):
+        # Never more than 2 * workers batches beyond the one being yielded
+        assert state["started"] <= len(names) + 1 + 8
+        names.append(report["name"])
+    assert names == [vm._moId for vm in vms]
+    assert 1 < state["peak"] <= 4
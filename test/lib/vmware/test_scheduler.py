@@ -0,0 +1,51 @@
+""" Unit tests for the multi-VM export scheduler """
+from threading import Lock
+from time import sleep
+
+from voithos.lib.vmware.scheduler import ExportScheduler, order_jobs
+
+
+def _job(name, host, size_bytes):
+    """ Return a job dict like get_export_jobs builds """
+    return {
+        "name": name,
+        "uuid": name,
+        "host": host,
+        "size_bytes": size_bytes,
+        "status": "pending",
+        "error": None,
+        "elapsed_seconds": None,
+    }
+
+
+def test_order_jobs():
+    """ Jobs are sorted by size in either direction, or left alone """
+    jobs = [_job("a", "h1", 2), _job("b", "h1", 3), _job("c", "h1", 1)]
+    assert [job["name"] for job in order_jobs(jobs)] == ["b", "a", "c"]
+    assert [job["name"] for job in order_jobs(jobs, "smallest-first")] == ["c", "a", "b"]
+    assert [job["name"] for job in order_jobs(jobs, "given")] == ["a", "b", "c"]
+
+
+def test_scheduler_limits():
+    """ No more than the global and per-host limits run at once, failures are recorded """
+    jobs = [_job(f"vm{num}", f"h{num % 2}", num) for num in range(8)]
+    running = {"total": 0, "h0": 0, "h1": 0}
+    peaks = {"total": 0, "h0": 0, "h1": 0}
+    lock = Lock()
+
+    def run_job(job):
+        with lock:
+            for key in ("total", job["host"]):
+                running[key] += 1
+                peaks[key] = max(peaks[key], running[key])
+        sleep(0.02)
+        with lock:
+            for key in ("total", job["host"]):
+                running[key] -= 1
+        if job["name"] == "vm3":
+            raise RuntimeError("lease failed")
+
+    results = ExportScheduler(jobs, run_job, max_concurrent=3, max_per_host=1).run()
+    assert peaks == {"total": 2, "h0": 1, "h1": 1}
+    assert [job["status"] for job in results].count("done") == 7
+    assert results[3]["status"] == "failed" and results[3]["error"] == "lease failed"
@@ -0,0 +1,100 @@
+""" Unit tests for the inventory snapshot database """
+import os
+import stat
+
+import pytest
+
+from voithos.lib.vmware.snapshots import SnapshotError, SnapshotStore
+
+
+def _report(uuid, name, power_state="poweredOn", vswitch="VM Network", uptime=10):
+    """ Return a VM report like reports.get_vm_data with one disk and one NIC """
+    return {
+        "uuid": uuid,
+        "name": name,
+        "vcenter": "vc1",
+        "guest_os": "Linux",
+        "power_state": power_state,
+        "status": "green",
+        "create_date": "None",
+        "uptime_seconds": uptime,
+        "num_cpu": 2,
+        "ram": {"total_mb": 2048, "used_mb": 2048},
+        "storage": {
+            "num_disks": 1,
+            "partitions": {"total_used_gb": 1.5, "paritions": []},
+            "disks": [
+                {
+                    "label": "Hard disk 1",
+                    "uuid": f"disk-{uuid}",
+                    "thin_provisioned": True,
+                    "shared": False,
+                    "capacity_gb": 10.0,
+                }
+            ],
+        },
+        "network": {
+            "num_interfaces": 1,
+            "networks": [
+                {
+                    "label": "Network adapter 1",
+                    "nic_type": "VirtualVmxnet3",
+                    "vswitch_name": vswitch,
+                    "connected": True,
+                    "pci_slot_num": 192,
+                }
+            ],
+        },
+    }
+
+
+def test_snapshot_diff(tmp_path):
+    """ Added, removed and changed VMs are found, uptime changes are ignored """
+    store = SnapshotStore(str(tmp_path / "snapshots.db"))
+    day1 = store.create(
+        "day1", [_report("u1", "web"), _report("u2", "db"), _report(None, "broken")]
+    )
+    assert day1["vm_count"] == 2
+    store.create(
+        "day2",
+        iter(
+            [
+                _report("u1", "web", uptime=99),
+                _report("u3", "app"),
+                _report("u2", "db-01", power_state="poweredOff", vswitch="DMZ"),
+            ]
+        ),
+    )
+    diff = store.diff("day1", "day2")
+    assert [vm["uuid"] for vm in diff["added"]] == ["u3"]
+    assert [vm["uuid"] for vm in diff["removed"]] == []
+    assert len(diff["changed"]) == 1
+    changes = diff["changed"][0]["changes"]
+    assert changes["name"] == ["db", "db-01"]
+    assert changes["power_state"] == ["poweredOn", "poweredOff"]
+    assert [nic["vswitch_name"] for nic in changes["nics"][1]] == ["DMZ"]
+    assert "disks" not in changes
+    assert [vm["uuid"] for vm in store.diff("day2", "day1")["removed"]] == ["u3"]
+    assert [snapshot["name"] for snapshot in store.list()] == ["day1", "day2"]
+
+
+def test_snapshot_errors(tmp_path):
+    """ Snapshot names are unique and must exist to be compared """
+    store = SnapshotStore(str(tmp_path / "snapshots.db"))
+    store.create("day1", [])
+    with pytest.raises(SnapshotError):
+        store.create("day1", [])
+    with pytest.raises(SnapshotError):
+        store.diff("day1", "missing")
+    store.close()
+
+
+def test_snapshot_private_and_vm_listed_twice(tmp_path):
+    """ The database is only readable by its owner, a VM listed twice counts its disks once """
+    path = tmp_path / "cache" / "snapshots.db"
+    store = SnapshotStore(str(path))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(path.parent).st_mode) == 0o700
+    store.create("day1", [_report("u1", "web"), _report("u1", "web")])
+    assert [row["disk_gb"] for row in store.get_capacity_rows("day1")] == [10.0]
+    store.close()
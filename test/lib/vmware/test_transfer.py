@@ -0,0 +1,128 @@
+""" Unit tests for the VMware transfer lib """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+import requests
+
+from voithos.lib.vmware.transfer import BufferPool, DiskDownload, get_session, split_ranges
+
+
+MB = 1024 * 1024
+BODY = bytes(range(256)) * 4096  # 1 MB
+
+
+class DiskRequestHandler(BaseHTTPRequestHandler):
+    """ Serve BODY at /disk, half of it at /short before hanging up, and a 404 elsewhere """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """ Keep test output clean """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Send the body of the path, without Range support """
+        if self.path not in ("/disk", "/short"):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        if self.path == "/short":
+            half = len(BODY) // 2
+            self.wfile.write(BODY[:half])
+            self.close_connection = True
+            return
+        self.wfile.write(BODY)
+
+
+@pytest.fixture(name="server_url")
+def fixture_server_url():
+    """ Run a DiskRequestHandler server for the test, return its base URL """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DiskRequestHandler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _download(url, tmp_path):
+    """ Run a single stream download of url into tmp_path/disk, return it """
+    download = DiskDownload(get_session(), url, str(tmp_path / "disk"), BufferPool(1), resume=False)
+    download.run()
+    return download
+
+
+def test_plain_download(server_url, tmp_path):
+    """ The body lands in the file, counted and timed """
+    download = _download(f"{server_url}/disk", tmp_path)
+    assert download.error is None and download.done
+    assert download.total_bytes == download.bytes_written == len(BODY)
+    assert (tmp_path / "disk").read_bytes() == BODY
+
+
+def test_http_error(server_url, tmp_path):
+    """ An HTTP error status fails the download without writing anything """
+    download = _download(f"{server_url}/missing", tmp_path)
+    assert isinstance(download.error, requests.HTTPError)
+    assert download.done and download.bytes_written == 0
+    assert not (tmp_path / "disk").exists()
+
+
+def test_failure_sets_error_and_done(server_url, tmp_path):
+    """ A body cut short is an error, and the download is still marked done for its monitor """
+    download = _download(f"{server_url}/short", tmp_path)
+    assert download.error is not None
+    assert download.done and download.elapsed_seconds >= 0
+    assert download.bytes_written < len(BODY)
+
+
+def test_split_ranges_covers_file():
+    """ split_ranges returns contiguous, aligned ranges covering every byte """
+    total = 1000 * MB + 123
+    ranges = split_ranges(total, 4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == total
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert start % MB == 0
+
+
+def test_split_ranges_small_file():
+    """ Files smaller than the minimum segment size are not split """
+    assert split_ranges(10 * MB, 8) == [(0, 10 * MB)]
+
+
+def test_download_resumes_from_refreshed_url(tmp_path):
+    """ A failed download resumes from the URL returned by refresh_url, until there is none """
+    refreshed = {"https://vc/nfc/1/disk": "https://vc/nfc/2/disk", "https://vc/nfc/2/disk": None}
+    download = DiskDownload(
+        None,
+        "https://vc/nfc/1/disk",
+        str(tmp_path / "disk"),
+        None,
+        resume=False,
+        refresh_url=refreshed.get,
+    )
+    urls = []
+
+    def run():
+        urls.append(download.url)
+        raise ConnectionError("lease expired")
+
+    download._run = run
+    download.run()
+    assert urls == ["https://vc/nfc/1/disk", "https://vc/nfc/2/disk"]
+    assert download.resume
+    assert isinstance(download.error, ConnectionError)
+
+
+def test_no_segments_rejected(tmp_path):
+    """ Zero segments or buffers would leave the download threads waiting forever """
+    with pytest.raises(ValueError):
+        BufferPool(0)
+    with pytest.raises(ValueError):
+        DiskDownload(None, "https://vc/nfc/1/disk", str(tmp_path / "disk"), None, segments=0)
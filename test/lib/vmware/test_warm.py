@@ -0,0 +1,74 @@
+""" Unit tests for warm migrations """
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim
+
+import voithos.lib.vmware.cbt as cbt
+import voithos.lib.vmware.warm as warm
+from voithos.lib.vmware.cbt import CbtError
+from voithos.lib.vmware.warm import WarmMigration, wait_for_power_off
+
+
+def _vm(power_state, change_id):
+    """ Return a VM with CBT on and one disk, also found in its snapshots """
+    disk = vim.vm.device.VirtualDisk(key=2000, capacityInBytes=1024)
+    disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+        fileName="[ds1] vm/vm.vmdk", changeId=change_id
+    )
+    config = SimpleNamespace(changeTrackingEnabled=True, hardware=SimpleNamespace(device=[disk]))
+    return SimpleNamespace(runtime=SimpleNamespace(powerState=power_state), config=config)
+
+
+@pytest.fixture
+def steps(monkeypatch):
+    """ Record the snapshot, power and sync steps of a migration instead of running them """
+    calls = []
+    snapshot = SimpleNamespace(name="snapshot")
+
+    def create_snapshot(vm, quiesce=False):
+        snapshot.config = vm.config
+        calls.append("snapshot")
+        return snapshot
+
+    monkeypatch.setattr(cbt, "get_datacenter", lambda vm: SimpleNamespace(name="dc1"))
+    monkeypatch.setattr(warm, "create_snapshot", create_snapshot)
+    monkeypatch.setattr(warm, "remove_snapshot", lambda snap: calls.append("remove"))
+    monkeypatch.setattr(warm, "power_off", lambda *args, **kwargs: calls.append("power_off"))
+    monkeypatch.setattr(
+        cbt.IncrementalSync,
+        "sync",
+        lambda self, snapshot=None, **kwargs: calls.append(("sync", snapshot and snapshot.name)),
+    )
+    return calls
+
+
+def test_warm_migration_steps(steps):
+    """ The snapshot is copied, removed, then the VM is powered off and synced """
+    vm = _vm(vim.VirtualMachine.PowerState.poweredOn, "52 aa/1")
+    migration = WarmMigration(SimpleNamespace(conn=None), vm)
+    migration.run(segments=2)
+    assert steps == ["snapshot", ("sync", "snapshot"), "remove", "power_off", ("sync", None)]
+    assert migration.downtime_seconds is not None
+
+
+def test_untracked_disks_stop_the_precopy(steps):
+    """ Without changeIds the pre-copy is refused, and its snapshot still removed """
+    vm = _vm(vim.VirtualMachine.PowerState.poweredOn, None)
+    with pytest.raises(CbtError):
+        WarmMigration(SimpleNamespace(conn=None), vm).run()
+    assert steps == ["snapshot", "remove"]
+
+
+def test_wait_for_power_off(monkeypatch):
+    """ Power state updates are awaited until the VM is off """
+    states = ["poweredOn", "poweredOff"]
+
+    def wait(collector, version, max_wait_seconds=0):
+        return [("modify", {"runtime.powerState": states.pop(0)})], version
+
+    collector = SimpleNamespace(DestroyPropertyCollector=lambda: None)
+    monkeypatch.setattr(warm, "create_object_collector", lambda *args: collector)
+    monkeypatch.setattr(warm, "wait_for_updates", wait)
+    assert wait_for_power_off(None, "vm", 60)
+    assert not states
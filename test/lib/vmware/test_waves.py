@@ -0,0 +1,74 @@
+""" Unit tests for the migration wave planner """
+import pytest
+
+from voithos.lib.vmware.waves import (
+    WavePlanError,
+    get_wave,
+    load_wave_plan,
+    plan_waves,
+    save_wave_plan,
+)
+
+
+def _job(name, size_bytes, host="esx1"):
+    """ Return an export job """
+    return {"vcenter": "vc1", "uuid": name, "name": name, "host": host, "size_bytes": size_bytes}
+
+
+def _names(wave):
+    """ Return the VM names of a wave dict """
+    return [vm["name"] for vm in wave["vms"]]
+
+
+def test_waves_fit_the_window():
+    """ VMs are packed largest first into the first wave where they end within the window """
+    jobs = [_job("a", 60), _job("b", 50), _job("c", 40), _job("d", 30), _job("e", 10)]
+    plan = plan_waves(jobs, bandwidth_bps=1, window_seconds=100, max_concurrent=1)
+    assert [_names(wave) for wave in plan["waves"]] == [["a", "c"], ["b", "d", "e"]]
+    assert [wave["estimated_seconds"] for wave in plan["waves"]] == [100.0, 90.0]
+    assert not any(wave["over_window"] for wave in plan["waves"])
+    assert plan["waves"][0]["size_bytes"] == 100
+    assert [vm["estimated_start"] for vm in plan["waves"][1]["vms"]] == [0.0, 50.0, 80.0]
+
+
+def test_waves_respect_per_host_limit():
+    """ VMs of the same host run one after the other with max_per_host=1 """
+    jobs = [_job("a", 60, "esx1"), _job("b", 60, "esx1"), _job("c", 60, "esx2")]
+    plan = plan_waves(jobs, bandwidth_bps=1, window_seconds=100, max_concurrent=4, max_per_host=1)
+    assert [_names(wave) for wave in plan["waves"]] == [["a", "c"], ["b"]]
+    plan = plan_waves(jobs, bandwidth_bps=1, window_seconds=100, max_concurrent=4, max_per_host=2)
+    assert [_names(wave) for wave in plan["waves"]] == [["a", "b", "c"]]
+
+
+def test_oversized_vm_gets_its_own_wave():
+    """ A VM that can't finish within the window is planned alone and flagged """
+    jobs = [_job("big", 500), _job("a", 10)]
+    plan = plan_waves(jobs, bandwidth_bps=1, window_seconds=100, max_concurrent=1)
+    assert [_names(wave) for wave in plan["waves"]] == [["big"], ["a"]]
+    assert [wave["over_window"] for wave in plan["waves"]] == [True, False]
+
+
+def test_invalid_limits():
+    """ Bandwidth, window and limits must be positive """
+    with pytest.raises(ValueError):
+        plan_waves([], bandwidth_bps=0, window_seconds=100)
+    with pytest.raises(ValueError):
+        plan_waves([], bandwidth_bps=1, window_seconds=100, max_per_host=0)
+
+
+def test_save_and_load(tmp_path):
+    """ A saved plan loads back, and its waves are found by number """
+    path = str(tmp_path / "waves.json")
+    jobs = [_job("a", 10), _job("b", 95)]
+    plan = plan_waves(jobs, bandwidth_bps=1, window_seconds=100, max_concurrent=1)
+    save_wave_plan(path, plan)
+    loaded = load_wave_plan(path)
+    assert loaded == plan
+    assert _names(get_wave(loaded, 2)) == ["a"]
+    with pytest.raises(WavePlanError):
+        get_wave(loaded, 3)
+    (tmp_path / "bad.json").write_text("{}")
+    with pytest.raises(WavePlanError):
+        load_wave_plan(str(tmp_path / "bad.json"))
+    with pytest.raises(WavePlanError):
+        load_wave_plan(str(tmp_path / "missing.json"))
@@ -12,25 +12,35 @@ FORMATS = ["qcow2", "qed", "raw", "vdi", "vpc", "vmdk"]
 
 @click.option("--input-format", "-f", "input_format", help=f"Allowed={FORMATS}", required=True)
 @click.option("--output-format", "-O", "output_format", help=f"Allowed={FORMATS}", required=True)
+@click.option(
+    "--sparse/--no-sparse",
+    default=True,
+    help="--no-sparse writes all-zero blocks instead of leaving holes in the output",
+)
 @click.argument("output_path")
 @click.argument("input_path")
 @click.command(name="convert")
-def convert(input_format, output_format, input_path, output_path):
+def convert(input_format, output_format, input_path, output_path, sparse):
     """ Run: qemu-img -f <input-format> -O <output-format> <input-path> <output-path> """
     print(f"qemu-img -f {input_format} -O {output_format} {input_path} {output_path}")
     if input_format not in FORMATS or output_format not in FORMATS:
         error("ERROR - Invalid format provided. Valid formats: {FORMATS}", exit=True)
     if not Path(input_path).is_file():
         error(f"ERROR - File not found: {input_path}", exit=True)
-    qemu_img.convert(input_format, output_format, input_path, output_path)
+    qemu_img.convert(input_format, output_format, input_path, output_path, sparse=sparse)
 
 @click.argument("vol_path")
+@click.option(
+    "--docker/--native",
+    default=False,
+    help="--docker always runs containerized qemu-img, even for VMDK files",
+)
 @click.command(name="info")
-def info(vol_path):
-    """ Run: qemu-img show <vol_path> """
+def info(vol_path, docker):
+    """ Run: qemu-img show <vol_path> - VMDK headers are read natively """
     if not Path(vol_path).is_file():
         error("ERROR - File not found: {vol_path}", exit=True)
-    qemu_img.show(vol_path)
+    qemu_img.show(vol_path, docker=docker)
 
 
 def get_qemu_img_group():
@@ -3,6 +3,7 @@
 import click
 import os
 import voithos.lib.util.util as util
+import voithos.lib.util.manifest as manifest
 import voithos.lib.aws.s3 as s3
 import voithos.lib.aws.ses as ses
 import voithos.lib.config as config
@@ -97,6 +98,22 @@ def get_instances_cpu_usage():
     """Displays cpu utilization of all the VMs on host"""
     util.get_instances_cpu_usage()
 
+
+@click.argument("file_path")
+@click.command(name="verify-manifest")
+def verify_manifest(file_path):
+    """Re-hash a downloaded file and compare it to its <file>.manifest.json"""
+    if not os.path.isfile(file_path):
+        error(f"ERROR - File not found: {file_path}", exit=True)
+    try:
+        bad_blocks = manifest.verify_file(file_path)
+    except manifest.ManifestError as exc:
+        error(str(exc), exit=True)
+    if bad_blocks:
+        error(f"ERROR - {file_path}: {len(bad_blocks)} block(s) differ: {bad_blocks}", exit=True)
+    click.echo(f"{file_path}: OK")
+
+
 def get_util_group():
     """Return the util group"""
 
@@ -109,6 +126,7 @@ def get_util_group():
     util_group.add_command(export_offline_media)
     util_group.add_command(export_offline_single_image)
     util_group.add_command(get_instances_cpu_usage)
+    util_group.add_command(verify_manifest)
     if S3_DEV_MODE:
         util_group.add_command(create_and_upload_apt_tar)
         util_group.add_command(create_and_upload_voithos_tar)
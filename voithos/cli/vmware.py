@@ -1,69 +1,96 @@
 """ Commands for VMWare """
 
 import click
+import csv
 import json
-from pprint import pprint
+import os
+from datetime import datetime
 from voithos.lib.system import error
+from voithos.lib.util.images import IMAGE_FORMATS
+from voithos.lib.util.vmdk import VMDKParseError
 import voithos.lib.vmware.reports as reports
-from voithos.lib.vmware.mgr import VMWareMgr
-from voithos.lib.vmware.exporter import VMWareExporter, VMWareOnlineVMCantMigrate
-
-
-def _escape_csv(value):
-    """ Format a CSV value to be safe to use in a CSV (string, escape commas, quotes) """
-    str_val = str(value)
-    str_val = str_val.replace('"', '""')
-    str_val = str_val.replace(",", '","')
-    return str_val
-
-
-def _print_csv(vms):
-    """ Print the CSV format output of a list of VMs """
-    columns = [
-        "uuid",
-        "name",
-        "os",
-        "cores",
-        "ram_mb",
-        "num_disks",
-        "total_storage_gb",
-        "used_storage_gb",
-        "num_nics",
-        "net_list",
-        "shared_storage",
-    ]
-    columns_str = ",".join(columns)
-    print(columns_str)
-    for vm in vms:
-        line = []
-        line.append(_escape_csv(vm["uuid"]))
-        line.append(_escape_csv(vm["name"]))
-        line.append(_escape_csv(vm["guest_os"]))
-        line.append(_escape_csv(vm["num_cpu"]))
-        line.append(_escape_csv(vm["ram"]["total_mb"]))
-        line.append(_escape_csv(vm["storage"]["num_disks"]))
-        capacity_gb = sum(disk["capacity_gb"] for disk in vm["storage"]["disks"])
-        line.append(_escape_csv(capacity_gb))
-        used_gb = round(vm["storage"]["partitions"]["total_used_gb"], 2)
-        line.append(_escape_csv(used_gb))
-        line.append(_escape_csv(vm["network"]["num_interfaces"]))
-        net_list = []
-        for network in vm["network"]["networks"]:
-            net_list.append(network["vswitch_name"])
-        net_list_str = " ||| ".join(net_list)
-        line.append(net_list_str)
-        shared_storage = "no"
-        for disk in vm["storage"]["disks"]:
-            if disk["shared"]:
-                shared_storage = "yes"
-        line.append(shared_storage)
-        print(",".join(line))
+from voithos.lib.vmware.report_writers import REPORT_FORMATS, get_report_writer
+from voithos.lib.vmware.federation import FederatedInventory, get_ip_addrs
+from voithos.lib.vmware.cbt import CbtError, IncrementalSync
+from voithos.lib.vmware.datastore import DatastorePathError
+from voithos.lib.vmware.warm import (
+    DEFAULT_SHUTDOWN_TIMEOUT,
+    SHUTDOWN_MODES,
+    VMWareShutdownFailed,
+    WarmMigration,
+)
+from voithos.lib.vmware.exporter import (
+    EXPORT_BACKENDS,
+    VMWareExporter,
+    VMWareOnlineVMCantMigrate,
+)
+from voithos.lib.vmware.lease import NfcLeaseError, VMWareExportLeaseNotReady
+from voithos.lib.vmware.convert import DEFAULT_WORKERS as DEFAULT_CONVERT_WORKERS
+from voithos.lib.vmware.progress import DEFAULT_INTERVAL as DEFAULT_PROGRESS_INTERVAL
+from voithos.lib.vmware.progress import (
+    DEFAULT_STALL_SECONDS,
+    PROGRESS_FORMATS,
+    ProgressOutputError,
+)
+from voithos.lib.vmware.scheduler import (
+    DEFAULT_MAX_CONCURRENT,
+    DEFAULT_MAX_PER_HOST,
+    JOB_ORDERS,
+    ExportScheduler,
+    get_export_jobs,
+    order_jobs,
+)
+from voithos.lib.vmware.plan import (
+    CapacityPlan,
+    PlanInputError,
+    get_capacity_row,
+    load_flavors,
+    load_reports,
+)
+from voithos.lib.vmware.snapshots import DEFAULT_SNAPSHOT_PATH, SnapshotError, SnapshotStore
+from voithos.lib.vmware.transfer import DiskDownloadFailed
+import voithos.lib.vmware.waves as waves
+
+
+def _parse_disk_segments(values):
+    """ Return a {targetId: segments} dict from repeated <targetId>=<segments> options """
+    disk_segments = {}
+    for value in values:
+        target_id, _, count = value.rpartition("=")
+        if not target_id or not count.isdigit() or int(count) < 1:
+            error(f"ERROR: Invalid --disk-segments value: {value}", exit=True)
+        disk_segments[target_id] = int(count)
+    return disk_segments
+
+
+def _iter_tagged_reports(records, workers):
+    """ Yield the report of each inventory record's VM that could be read, tagged by its vCenter """
+    by_vm = {id(record["vm"]): record for record in records}
+    vms = [record["vm"] for record in records]
+    for vm, vm_report in reports.iter_vms_data(vms, workers=workers):
+        vm_report["vcenter"] = by_vm[id(vm)]["vcenter"]
+        yield vm_report
 
 
 @click.option(
     "--name", "-n", multiple=True, help="Repetable - names of VMs to display", required=True
 )
-@click.option("--format", "-f", "output", default="pprint", help="Output format: pprint,json,csv")
+@click.option(
+    "--format", "-f", "output", default="pprint", help="Output format: pprint,json,jsonl,csv"
+)
+@click.option(
+    "--output-file",
+    "-o",
+    "output_file",
+    default="-",
+    help="(optional) Write the output to this file instead of stdout",
+)
+@click.option(
+    "--workers",
+    default=reports.DEFAULT_REPORT_WORKERS,
+    type=int,
+    help="Batches of VMs read from vCenter at once",
+)
 @click.option(
     "--username",
     "-u",
@@ -80,28 +107,39 @@ def _print_csv(vms):
     "--ip-addr",
     "-i",
     "ip_addr",
-    default=None,
-    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
 )
 @click.command(name="show-vm")
-def show_vm(name, output, username, password, ip_addr):
-    """ Show data about provided VMs """
-    allowed_outputs = ["pprint", "json", "csv"]
-    if output not in allowed_outputs:
-        error(f"Invalid output format chosen. Supported outputs: {allowed_outputs}", exit=True)
-    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
-    vms = mgr.find_vms_by_name(name)
-    vm_reports = []
-    for vm in vms:
-        vm_report = reports.get_vm_data(vm)
-        vm_reports.append(vm_report)
-    if output == "pprint":
-        for vm in vm_reports:
-            pprint(vm)
-    elif output == "json":
-        print(json.dumps(vm_reports))
-    elif output == "csv":
-        _print_csv(vm_reports)
+def show_vm(name, output, output_file, workers, username, password, ip_addr, refresh):
+    """Show data about provided VMs
+
+    Each VM is written as soon as its data is read, a batch of VMs at a time with --workers
+    batches read at once
+    """
+    if output not in REPORT_FORMATS:
+        error(f"Invalid output format chosen. Supported outputs: {REPORT_FORMATS}", exit=True)
+    if workers < 1:
+        error("ERROR: --workers must be at least 1", exit=True)
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    records = inventory.find_records_by_name(name)
+    try:
+        writer = get_report_writer(output, output_file)
+    except OSError as exc:
+        error(f"ERROR: Failed to open {output_file}: {exc}", exit=True)
+    try:
+        for vm_report in _iter_tagged_reports(records, workers):
+            writer.write(vm_report)
+    finally:
+        writer.close()
 
 
 @click.argument("vm_uuid")
@@ -122,32 +160,935 @@ def show_vm(name, output, username, password, ip_addr):
     "--ip-addr",
     "-i",
     "ip_addr",
-    default=None,
-    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
 )
 @click.option(
-    "--interval", default="15", help="Optional CLI Print interval override - 0 disables updates"
+    "--interval",
+    default=15.0,
+    type=float,
+    help="Optional CLI Print interval override - 0 disables updates",
 )
 @click.option(
     "--auto/--manual",
     default=True,
-    help="--manual will not run wget. Instead, holds NFC lease open until Ctrl-C is passed",
+    help="--manual will not download. Instead, holds NFC lease open until Ctrl-C is passed",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(EXPORT_BACKENDS),
+    default="nfc",
+    help="nfc: export streamOptimized VMDKs through an NFC lease, datastore: download the raw "
+    "flat extents of the disks straight from their VMFS or NFS datastores",
+)
+@click.option(
+    "--segments",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Concurrent HTTP Range requests per disk, when the server supports Range",
+)
+@click.option(
+    "--disk-segments",
+    "disk_segments",
+    multiple=True,
+    help="Repeatable - override --segments for one disk: <file name>=<segments>, the file "
+    "name being the NFC targetId or disk-<key>.raw with --backend datastore",
+)
+@click.option(
+    "--resume/--restart",
+    default=True,
+    help="--restart ignores checkpoints left by an interrupted download and starts over",
+)
+@click.option(
+    "--convert-to",
+    "convert_to",
+    type=click.Choice(IMAGE_FORMATS),
+    default=None,
+    help="(optional) Write raw or qcow2 images while downloading instead of VMDK files",
+)
+@click.option(
+    "--convert-workers",
+    "convert_workers",
+    default=DEFAULT_CONVERT_WORKERS,
+    type=click.IntRange(min=1),
+    help="Decompression threads per disk when using --convert-to",
+)
+@click.option(
+    "--sparse/--no-sparse",
+    default=True,
+    help="--no-sparse preallocates files and writes all-zero blocks instead of leaving holes",
+)
+@click.option(
+    "--progress-format",
+    "progress_format",
+    type=click.Choice(PROGRESS_FORMATS),
+    default="text",
+    help="text: print every --interval seconds, json: emit JSON lines progress events",
+)
+@click.option(
+    "--progress-output",
+    "progress_output",
+    default="-",
+    help="Progress destination: - (stdout), a file path, tcp://host:port or unix:///path",
+)
+@click.option(
+    "--progress-interval",
+    "progress_interval",
+    default=DEFAULT_PROGRESS_INTERVAL,
+    type=float,
+    help="Seconds between progress samples, can be below 1",
+)
+@click.option(
+    "--stall-timeout",
+    "stall_seconds",
+    default=DEFAULT_STALL_SECONDS,
+    type=float,
+    help="Seconds without new bytes before a disk is reported as stalled",
+)
+@click.option(
+    "--manifest/--no-manifest",
+    default=True,
+    help="Hash the VMDKs while downloading and save a <file>.manifest.json next to each",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Sync raw disk images from the datastores, fetching only the blocks changed since the "
+    "last --incremental run (Changed Block Tracking)",
+)
+@click.option(
+    "--enable-cbt",
+    "enable_cbt",
+    is_flag=True,
+    help="With --incremental, turn on Changed Block Tracking if it is off for the VM",
+)
+@click.option(
+    "--allocated-only",
+    "allocated_only",
+    is_flag=True,
+    help="Only fetch the allocated extents of disks downloaded in full, leaving holes elsewhere. "
+    "Implies --incremental",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
 )
 @click.command(name="download-vm")
-def download_vm(vm_uuid, dest_dir, username, password, ip_addr, interval, auto):
+def download_vm(
+    vm_uuid,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    refresh,
+    interval,
+    auto,
+    backend,
+    segments,
+    disk_segments,
+    resume,
+    convert_to,
+    convert_workers,
+    sparse,
+    progress_format,
+    progress_output,
+    progress_interval,
+    stall_seconds,
+    manifest,
+    incremental,
+    enable_cbt,
+    allocated_only,
+):
     """ Download a VM with a given UUID """
-    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
-    vm = mgr.find_vm_by_uuid(vm_uuid)
-    if vm is None:
+    per_disk_segments = _parse_disk_segments(disk_segments)
+    incremental = incremental or allocated_only
+    if incremental and (convert_to is not None or not auto):
+        error("ERROR: --incremental writes raw images, without --convert-to or --manual", exit=True)
+    if backend == "datastore" and (convert_to is not None or not auto):
+        error(
+            "ERROR: --backend datastore writes raw images, without --convert-to or --manual",
+            exit=True,
+        )
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    record = inventory.find_record_by_uuid(vm_uuid)
+    if record is None:
         error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+    if incremental:
+        _sync_vm(
+            inventory.get_mgr(record),
+            record["vm"],
+            dest_dir,
+            enable_cbt=enable_cbt,
+            segments=segments,
+            sparse=sparse,
+            progress_format=progress_format,
+            progress_output=progress_output,
+            progress_interval=progress_interval,
+            stall_seconds=stall_seconds,
+            print_interval=interval,
+            allocated_only=allocated_only,
+        )
+        return
     try:
-        exporter = VMWareExporter(mgr, vm, base_dir=dest_dir, interval=int(interval))
+        exporter = VMWareExporter(
+            inventory.get_mgr(record),
+            record["vm"],
+            base_dir=dest_dir,
+            interval=interval,
+            backend=backend,
+        )
     except VMWareOnlineVMCantMigrate:
         error("ERROR: This VM is not offline", exit=True)
+    except (NfcLeaseError, VMWareExportLeaseNotReady) as exc:
+        error(str(exc), exit=True)
     if auto:
-        exporter.download()
+        try:
+            exporter.download(
+                segments=segments,
+                disk_segments=per_disk_segments,
+                resume=resume,
+                convert_to=convert_to,
+                convert_workers=convert_workers,
+                sparse=sparse,
+                progress_format=progress_format,
+                progress_output=progress_output,
+                progress_interval=progress_interval,
+                stall_seconds=stall_seconds,
+                manifest=manifest,
+            )
+        except (DiskDownloadFailed, DatastorePathError, VMDKParseError, ProgressOutputError) as exc:
+            error(str(exc), exit=True)
+    else:
+        try:
+            exporter.hold_nfc_lease()
+        except NfcLeaseError as exc:
+            error(str(exc), exit=True)
+
+
+def _sync_vm(mgr, vm, dest_dir, enable_cbt=False, **sync_args):
+    """ Sync the disks of a VM into raw images with Changed Block Tracking """
+    try:
+        IncrementalSync(mgr, vm, base_dir=dest_dir, enable=enable_cbt).sync(**sync_args)
+    except VMWareOnlineVMCantMigrate:
+        error("ERROR: This VM is not offline", exit=True)
+    except CbtError as exc:
+        error(f"{exc}, see --enable-cbt", exit=True)
+    except (DiskDownloadFailed, DatastorePathError, ProgressOutputError) as exc:
+        error(str(exc), exit=True)
+
+
+@click.argument("vm_uuid")
+@click.option("--output-dir", "-o", "dest_dir", default=".", help="Optional destination directory")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
+)
+@click.option(
+    "--interval",
+    default=15,
+    type=float,
+    help="Optional CLI Print interval override - 0 disables updates",
+)
+@click.option(
+    "--segments",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Concurrent HTTP Range requests per disk",
+)
+@click.option(
+    "--sparse/--no-sparse",
+    default=True,
+    help="--no-sparse preallocates files and writes all-zero blocks instead of leaving holes",
+)
+@click.option(
+    "--enable-cbt",
+    "enable_cbt",
+    is_flag=True,
+    help="Turn on Changed Block Tracking if it is off for the VM",
+)
+@click.option(
+    "--allocated-only",
+    "allocated_only",
+    is_flag=True,
+    help="Only fetch the allocated extents of the disks in the pre-copy, leaving holes elsewhere",
+)
+@click.option(
+    "--quiesce",
+    is_flag=True,
+    help="Quiesce the guest file systems for the pre-copy snapshot (needs VMware tools)",
+)
+@click.option(
+    "--shutdown",
+    type=click.Choice(SHUTDOWN_MODES),
+    default="guest",
+    help="guest: shut the guest OS down (needs VMware tools), hard: power off at once",
+)
+@click.option(
+    "--shutdown-timeout",
+    "shutdown_timeout",
+    default=DEFAULT_SHUTDOWN_TIMEOUT,
+    type=int,
+    help="Seconds to wait for the guest OS to shut down",
+)
+@click.option(
+    "--progress-format",
+    "progress_format",
+    type=click.Choice(PROGRESS_FORMATS),
+    default="text",
+    help="text: print every --interval seconds, json: emit JSON lines progress events",
+)
+@click.option(
+    "--progress-output",
+    "progress_output",
+    default="-",
+    help="Progress destination: - (stdout), a file path, tcp://host:port or unix:///path",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
+)
+@click.command(name="warm-migrate")
+def warm_migrate(
+    vm_uuid,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    interval,
+    segments,
+    sparse,
+    enable_cbt,
+    allocated_only,
+    quiesce,
+    shutdown,
+    shutdown_timeout,
+    progress_format,
+    progress_output,
+    refresh,
+):
+    """Export a running VM with little downtime, into raw disk images
+
+    The disks are copied from a snapshot while the VM runs. The VM is then POWERED OFF and only
+    the blocks changed since the snapshot are copied. Re-running resumes an interrupted export.
+    """
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    record = inventory.find_record_by_uuid(vm_uuid)
+    if record is None:
+        error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+    try:
+        migration = WarmMigration(
+            inventory.get_mgr(record), record["vm"], base_dir=dest_dir, enable=enable_cbt
+        )
+        migration.run(
+            quiesce=quiesce,
+            shutdown=shutdown,
+            shutdown_timeout=shutdown_timeout,
+            segments=segments,
+            sparse=sparse,
+            progress_format=progress_format,
+            progress_output=progress_output,
+            print_interval=interval,
+            allocated_only=allocated_only,
+        )
+    except CbtError as exc:
+        error(f"{exc}, see --enable-cbt", exit=True)
+    except (
+        DiskDownloadFailed,
+        DatastorePathError,
+        ProgressOutputError,
+        VMWareShutdownFailed,
+    ) as exc:
+        error(str(exc), exit=True)
+
+
+def _find_records(inventory, values):
+    """ Return the inventory records of VMs given as UUIDs or name patterns """
+    found = []
+    for value in values:
+        record = inventory.find_record_by_uuid(value)
+        matches = [record] if record is not None else inventory.find_records_by_name([value])
+        if not matches:
+            error(f"ERROR: Failed to find VM with UUID or name: {value}", exit=True)
+        found.extend(matches)
+    return found
+
+
+def _find_planned_records(inventory, planned_vms):
+    """ Return the inventory records of the VMs of a wave, in their order """
+    found = []
+    for planned_vm in planned_vms:
+        record = inventory.find_record_by_uuid(planned_vm["uuid"])
+        if record is None:
+            error(f"ERROR: Failed to find planned VM {planned_vm['name']}", exit=True)
+        found.append(record)
+    return found
+
+
+@click.argument("vms", nargs=-1)
+@click.option(
+    "--output-dir",
+    "-o",
+    "dest_dir",
+    default=".",
+    help="Optional destination directory, each VM is saved in a <uuid> subdirectory",
+)
+@click.option(
+    "--plan",
+    "plan_file",
+    default=None,
+    help="(optional) Wave plan from plan-waves, export the VMs of --wave instead of VMS",
+)
+@click.option("--wave", default=None, type=int, help="Wave of --plan to export")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
+)
+@click.option(
+    "--max-concurrent",
+    "max_concurrent",
+    default=None,
+    type=int,
+    help=f"Maximum number of VMs exported at once [default: {DEFAULT_MAX_CONCURRENT}, or the "
+    "plan's]",
+)
+@click.option(
+    "--max-per-host",
+    "max_per_host",
+    default=None,
+    type=int,
+    help="Maximum number of VMs exported at once from the same ESXi host "
+    f"[default: {DEFAULT_MAX_PER_HOST}, or the plan's]",
+)
+@click.option(
+    "--order",
+    type=click.Choice(JOB_ORDERS),
+    default="largest-first",
+    help="Start order: largest-first minimises the total time, smallest-first finishes VMs early."
+    " Waves of a plan keep their order",
+)
+@click.option(
+    "--dry-run", "dry_run", is_flag=True, help="Only print the VMs in the order they would start"
+)
+@click.option(
+    "--interval",
+    default=60.0,
+    type=float,
+    help="Optional CLI Print interval override - 0 disables updates",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(EXPORT_BACKENDS),
+    default="nfc",
+    help="nfc: export streamOptimized VMDKs through an NFC lease, datastore: download the raw "
+    "flat extents of the disks straight from their VMFS or NFS datastores",
+)
+@click.option(
+    "--segments",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Concurrent HTTP Range requests per disk, when the server supports Range",
+)
+@click.option(
+    "--resume/--restart",
+    default=True,
+    help="--restart ignores checkpoints left by an interrupted download and starts over",
+)
+@click.option(
+    "--convert-to",
+    "convert_to",
+    type=click.Choice(IMAGE_FORMATS),
+    default=None,
+    help="(optional) Write raw or qcow2 images while downloading instead of VMDK files",
+)
+@click.option(
+    "--convert-workers",
+    "convert_workers",
+    default=DEFAULT_CONVERT_WORKERS,
+    type=click.IntRange(min=1),
+    help="Decompression threads per disk when using --convert-to",
+)
+@click.option(
+    "--sparse/--no-sparse",
+    default=True,
+    help="--no-sparse preallocates files and writes all-zero blocks instead of leaving holes",
+)
+@click.option(
+    "--progress-format",
+    "progress_format",
+    type=click.Choice(PROGRESS_FORMATS),
+    default="text",
+    help="text: print every --interval seconds, json: emit JSON lines progress events",
+)
+@click.option(
+    "--progress-output",
+    "progress_output",
+    default="-",
+    help="Progress destination: - (stdout), a file path, tcp://host:port or unix:///path",
+)
+@click.option(
+    "--manifest/--no-manifest",
+    default=True,
+    help="Hash the VMDKs while downloading and save a <file>.manifest.json next to each",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
+)
+@click.command(name="download-vms")
+def download_vms(
+    vms,
+    dest_dir,
+    plan_file,
+    wave,
+    username,
+    password,
+    ip_addr,
+    refresh,
+    max_concurrent,
+    max_per_host,
+    order,
+    dry_run,
+    interval,
+    backend,
+    segments,
+    resume,
+    convert_to,
+    convert_workers,
+    sparse,
+    progress_format,
+    progress_output,
+    manifest,
+):
+    """Download many VMs, given as UUIDs or name patterns ("*" for all VMs), or a plan's wave
+
+    The VMs must be powered off. They are exported from a job queue, limited globally and per
+    ESXi host
+    """
+    if bool(vms) == (plan_file is not None) or (plan_file is None) != (wave is None):
+        error("ERROR: Give either VMS, or --plan and --wave", exit=True)
+    if backend == "datastore" and convert_to is not None:
+        error("ERROR: --backend datastore writes raw images, without --convert-to", exit=True)
+    planned_vms = None
+    limits = {"max_concurrent": DEFAULT_MAX_CONCURRENT, "max_per_host": DEFAULT_MAX_PER_HOST}
+    if plan_file is not None:
+        try:
+            wave_plan = waves.load_wave_plan(plan_file)
+            planned_vms = waves.get_wave(wave_plan, wave)["vms"]
+        except waves.WavePlanError as exc:
+            error(f"ERROR: {exc}", exit=True)
+        limits = {key: wave_plan[key] for key in limits}
+        order = "given"
+    max_concurrent = max_concurrent if max_concurrent is not None else limits["max_concurrent"]
+    max_per_host = max_per_host if max_per_host is not None else limits["max_per_host"]
+    if max_concurrent < 1 or max_per_host < 1:
+        error("ERROR: --max-concurrent and --max-per-host must be at least 1", exit=True)
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    if planned_vms is not None:
+        found = _find_planned_records(inventory, planned_vms)
+    else:
+        found = _find_records(inventory, vms)
+    jobs = order_jobs(get_export_jobs(found), order)
+    print(f"Exporting {len(jobs)} VM(s), {max_concurrent} at once, {max_per_host} per host:")
+    for job in jobs:
+        size_gb = reports.bytes_to_gb(job["size_bytes"])
+        print(f"  {job['name']} ({job['uuid']}) - {size_gb} GB on {job['host']}, {job['vcenter']}")
+    if dry_run:
+        return
+
+    def export_vm(job):
+        """ Export a single VM into its own directory """
+        base_dir = os.path.join(dest_dir, job["uuid"])
+        os.makedirs(base_dir, exist_ok=True)
+        mgr = inventory.mgrs[job["vcenter"]]
+        exporter = VMWareExporter(
+            mgr, job["vm"], base_dir=base_dir, interval=interval, backend=backend
+        )
+        exporter.download(
+            segments=segments,
+            resume=resume,
+            convert_to=convert_to,
+            convert_workers=convert_workers,
+            sparse=sparse,
+            progress_format=progress_format,
+            progress_output=progress_output,
+            manifest=manifest,
+            progress_label=job["name"],
+        )
+
+    scheduler = ExportScheduler(
+        jobs, export_vm, max_concurrent=max_concurrent, max_per_host=max_per_host
+    )
+    results = scheduler.run()
+    print("Export results:")
+    for job in results:
+        status = job["status"].upper()
+        reason = f" - {job['error']}" if job["error"] else ""
+        print(f"  {status}: {job['name']} ({job['uuid']}) in {job['elapsed_seconds']}s{reason}")
+    failed = [job for job in results if job["status"] != "done"]
+    if failed:
+        error(f"ERROR: {len(failed)}/{len(results)} VM export(s) failed", exit=True)
+
+
+@click.argument("vms", nargs=-1, required=True)
+@click.option(
+    "--bandwidth",
+    required=True,
+    type=float,
+    help="Measured speed of one VM export in MB/s, e.g. from a download-vm progress report",
+)
+@click.option("--window", required=True, type=float, help="Length of a change window in hours")
+@click.option(
+    "--max-concurrent",
+    "max_concurrent",
+    default=DEFAULT_MAX_CONCURRENT,
+    type=int,
+    help="Maximum number of VMs exported at once",
+)
+@click.option(
+    "--max-per-host",
+    "max_per_host",
+    default=DEFAULT_MAX_PER_HOST,
+    type=int,
+    help="Maximum number of VMs exported at once from the same ESXi host",
+)
+@click.option(
+    "--output-file",
+    "-o",
+    "output_file",
+    default="waves.json",
+    help="Wave plan file, to export a wave with download-vms --plan",
+)
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
+)
+@click.command(name="plan-waves")
+def plan_waves(
+    vms,
+    bandwidth,
+    window,
+    max_concurrent,
+    max_per_host,
+    output_file,
+    username,
+    password,
+    ip_addr,
+    refresh,
+):
+    """Split many VMs, given as UUIDs or name patterns ("*" for all VMs), into migration waves
+
+    Each wave is estimated to fit in one change window, given the export bandwidth and the
+    download-vms concurrency limits
+    """
+    if max_concurrent < 1 or max_per_host < 1:
+        error("ERROR: --max-concurrent and --max-per-host must be at least 1", exit=True)
+    if bandwidth <= 0 or window <= 0:
+        error("ERROR: --bandwidth and --window must be positive", exit=True)
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    jobs = get_export_jobs(_find_records(inventory, vms))
+    wave_plan = waves.plan_waves(
+        jobs,
+        bandwidth_bps=bandwidth * 1024 ** 2,
+        window_seconds=window * 3600,
+        max_concurrent=max_concurrent,
+        max_per_host=max_per_host,
+    )
+    waves.save_wave_plan(output_file, wave_plan)
+    print(f"Planned {len(jobs)} VM(s) in {len(wave_plan['waves'])} wave(s) of {window}h:")
+    for wave in wave_plan["waves"]:
+        size_gb = reports.bytes_to_gb(wave["size_bytes"])
+        hours = round(wave["estimated_seconds"] / 3600, 2)
+        over = " - OVER WINDOW" if wave["over_window"] else ""
+        print(f"  Wave {wave['wave']}: {len(wave['vms'])} VM(s), {size_gb} GB, ~{hours}h{over}")
+    print(f"Saved the plan to {output_file}, export a wave with download-vms --plan --wave")
+
+
+def _format_snapshot(snapshot):
+    """ Return a one line description of a snapshot dict """
+    created = datetime.fromtimestamp(snapshot["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{snapshot['name']} ({created}, {snapshot['vm_count']} VMs)"
+
+
+@click.option(
+    "--name", "-n", multiple=True, default=["*"], help="Repeatable - names of VMs to save (all)"
+)
+@click.option(
+    "--snapshot",
+    "-s",
+    "snapshot_name",
+    default=None,
+    help="(optional) Name of the new snapshot, defaults to the current date and time",
+)
+@click.option(
+    "--db",
+    "db_path",
+    default=DEFAULT_SNAPSHOT_PATH,
+    help="Snapshot database file",
+)
+@click.option(
+    "--workers",
+    default=reports.DEFAULT_REPORT_WORKERS,
+    type=int,
+    help="Batches of VMs read from vCenter at once",
+)
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    multiple=True,
+    help="(optional) Repeatable or comma separated vCenters, overrides environment variable "
+    "VMWARE_IP_ADDR",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Bring the cached VM inventory up to date from vCenter before using it",
+)
+@click.command(name="inventory-snapshot")
+def inventory_snapshot(name, snapshot_name, db_path, workers, username, password, ip_addr, refresh):
+    """Save the show-vm data of VMs as a snapshot, to compare with inventory-diff
+
+    Each VM, disk and NIC gets a row in a SQLite database
+    """
+    if workers < 1:
+        error("ERROR: --workers must be at least 1", exit=True)
+    if snapshot_name is None:
+        snapshot_name = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    store = SnapshotStore(db_path)
+    inventory = FederatedInventory(
+        get_ip_addrs(ip_addr), username=username, password=password, refresh=refresh
+    )
+    records = inventory.find_records_by_name(name)
+
+    try:
+        snapshot = store.create(snapshot_name, _iter_tagged_reports(records, workers))
+    except SnapshotError as exc:
+        error(f"ERROR: {exc}", exit=True)
+    print(f"Saved snapshot {_format_snapshot(snapshot)}")
+
+
+@click.argument("new", required=False)
+@click.argument("old", required=False)
+@click.option(
+    "--db",
+    "db_path",
+    default=DEFAULT_SNAPSHOT_PATH,
+    help="Snapshot database file",
+)
+@click.option(
+    "--format", "-f", "output", type=click.Choice(["text", "json"]), default="text", help="Output"
+)
+@click.command(name="inventory-diff")
+def inventory_diff(old, new, db_path, output):
+    """Show the VMs added, removed and changed between snapshots OLD and NEW
+
+    Compares the two latest snapshots when none are given, or OLD with the latest one
+    """
+    store = SnapshotStore(db_path)
+    snapshots = store.list()
+    if new is None:
+        if len(snapshots) < (1 if old else 2):
+            error("ERROR: Not enough snapshots to compare, see inventory-snapshot", exit=True)
+        new = snapshots[-1]["name"]
+        old = old or snapshots[-2]["name"]
+    try:
+        diff = store.diff(old, new)
+    except SnapshotError as exc:
+        available = ", ".join(snapshot["name"] for snapshot in snapshots)
+        error(f"ERROR: {exc}. Snapshots: {available}", exit=True)
+    if output == "json":
+        print(json.dumps(diff))
+        return
+    print(f"From {_format_snapshot(diff['old'])}")
+    print(f"  to {_format_snapshot(diff['new'])}")
+    for key, sign in (("added", "+"), ("removed", "-")):
+        print(f"{key.capitalize()} VMs: {len(diff[key])}")
+        for vm in diff[key]:
+            print(f"  {sign} {vm['name']} ({vm['uuid']}) on {vm['vcenter']}")
+    print(f"Changed VMs: {len(diff['changed'])}")
+    for vm in diff["changed"]:
+        changes = []
+        for column, (old_value, new_value) in vm["changes"].items():
+            if column in ("disks", "nics"):
+                changes.append(f"{column} changed ({len(old_value)} -> {len(new_value)})")
+            else:
+                changes.append(f"{column}: {old_value} -> {new_value}")
+        print(f"  ~ {vm['name']} ({vm['uuid']}) on {vm['vcenter']}: {'; '.join(changes)}")
+
+
+def _print_plan(summary):
+    """ Print a capacity plan summary for humans """
+    totals = summary["totals"]
+    storage = summary["storage"]
+    print(f"VMs: {summary['vms']}")
+    print(f"Total vCPUs: {totals['vcpus']}")
+    print(f"Total RAM: {round(totals['ram_mb'] / 1024, 2)} GB")
+    print(f"Storage, thick provisioned: {storage['thick_gb']} GB")
+    print(f"Storage, thin provisioned: {storage['thin_gb']} GB")
+    if storage["vms_without_guest_usage"]:
+        count = storage["vms_without_guest_usage"]
+        print(f"  ({count} VMs report no guest disk usage and count at full capacity)")
+    print("Per VM:")
+    for field, values in summary["percentiles"].items():
+        print(f"  {field}: " + ", ".join(f"{key} {value}" for key, value in values.items()))
+    if "flavors" not in summary:
+        return
+    print("Best-fit flavors:")
+    for name, count in sorted(summary["flavors"].items(), key=lambda item: -item[1]):
+        print(f"  {name}: {count}")
+    flavor_totals = summary["flavor_totals"]
+    print(
+        f"Flavor allocation: {flavor_totals['vcpus']} vCPUs, "
+        f"{round(flavor_totals['ram_mb'] / 1024, 2)} GB RAM, {flavor_totals['disk_gb']} GB disk"
+    )
+    if summary["unfit_vms"]:
+        print(f"VMs no flavor fits: {len(summary['unfit_vms'])}")
+        for name in summary["unfit_vms"]:
+            print(f"  {name}")
+
+
+@click.option(
+    "--snapshot",
+    "-s",
+    "snapshot_name",
+    default=None,
+    help="(optional) Inventory snapshot to plan from, defaults to the latest",
+)
+@click.option(
+    "--db",
+    "db_path",
+    default=DEFAULT_SNAPSHOT_PATH,
+    help="Snapshot database file",
+)
+@click.option(
+    "--input",
+    "input_file",
+    default=None,
+    help="(optional) Plan from a show-vm json or jsonl output file instead of a snapshot",
+)
+@click.option(
+    "--flavors",
+    "flavors_file",
+    default=None,
+    help="(optional) JSON list of flavors to fit the VMs to, e.g. openstack flavor list -f json",
+)
+@click.option(
+    "--vm-flavors",
+    "vm_flavors_file",
+    default=None,
+    help="(optional) Write the best-fit flavor of each VM to this CSV file",
+)
+@click.option(
+    "--format", "-f", "output", type=click.Choice(["text", "json"]), default="text", help="Output"
+)
+@click.command(name="plan")
+def plan(snapshot_name, db_path, input_file, flavors_file, vm_flavors_file, output):
+    """Summarise the capacity needed in OpenStack by an inventory
+
+    Totals, per-VM percentiles, thick and thin storage, and the best-fit flavor of each VM
+    """
+    try:
+        if input_file is not None:
+            rows = [get_capacity_row(report) for report in load_reports(input_file)]
+        else:
+            store = SnapshotStore(db_path)
+            snapshots = store.list()
+            if snapshot_name is None and not snapshots:
+                error("ERROR: No snapshots to plan from, see inventory-snapshot", exit=True)
+            rows = store.get_capacity_rows(snapshot_name or snapshots[-1]["name"])
+        flavors = load_flavors(flavors_file) if flavors_file is not None else None
+    except (PlanInputError, SnapshotError) as exc:
+        error(f"ERROR: {exc}", exit=True)
+    if vm_flavors_file is not None and not flavors:
+        error("ERROR: --vm-flavors requires --flavors", exit=True)
+    capacity_plan = CapacityPlan(rows)
+    summary = capacity_plan.summarize(flavors)
+    if vm_flavors_file is not None:
+        with open(vm_flavors_file, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            writer.writerow(["vcenter", "uuid", "name", "flavor"])
+            writer.writerows(capacity_plan.get_vm_flavors(flavors))
+    if output == "json":
+        print(json.dumps(summary))
     else:
-        exporter.hold_nfc_lease()
+        _print_plan(summary)
 
 
 def get_vmware_group():
@@ -159,4 +1100,10 @@ def get_vmware_group():
 
     vmware_group.add_command(show_vm)
     vmware_group.add_command(download_vm)
+    vmware_group.add_command(download_vms)
+    vmware_group.add_command(warm_migrate)
+    vmware_group.add_command(plan_waves)
+    vmware_group.add_command(inventory_snapshot)
+    vmware_group.add_command(inventory_diff)
+    vmware_group.add_command(plan)
     return vmware_group
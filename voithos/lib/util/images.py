@@ -0,0 +1,278 @@
+""" Disk image writers: build raw or qcow2 images from out-of-order writes, without qemu-img """
+import ctypes
+import os
+import struct
+from functools import lru_cache
+from threading import Lock
+
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_VERSION = 2
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size, crypt_method,
+# l1_size, l1_table_offset, refcount_table_offset, refcount_table_clusters, nb_snapshots,
+# snapshots_offset
+QCOW2_HEADER = struct.Struct(">4sIQIIQIIQQIIQ")
+QCOW2_COPIED = 1 << 63  # refcount of the cluster is exactly 1
+DEFAULT_CLUSTER_BITS = 16  # 64 KB, the same as a VMDK grain
+IMAGE_FORMATS = ["raw", "qcow2"]
+ZERO_BLOCK_SIZE = 1024 * 64  # granularity of zero detection
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+_ZEROS = bytes(ZERO_BLOCK_SIZE)
+
+
+def _write_all(fd, data, offset):
+    """ Positionally write all of data to fd at offset """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def is_zero(data, start, end):
+    """Return True if data[start:end] is all zero bytes, end - start <= ZERO_BLOCK_SIZE
+
+    bytes and bytearray are compared in place with startswith (a memcmp), memoryviews
+    through a copy of the block
+    """
+    zeros = _ZEROS if end - start == ZERO_BLOCK_SIZE else _ZEROS[: end - start]
+    if isinstance(data, (bytes, bytearray)):
+        return data.startswith(zeros, start)
+    return data[start:end].tobytes() == zeros
+
+
+def zero_runs(data, length, block_size=ZERO_BLOCK_SIZE):
+    """ Yield (start, end, is_zero) runs of whole blocks covering data[:length] """
+    run_start = 0
+    run_zero = None
+    for start in range(0, length, block_size):
+        zero = is_zero(data, start, min(start + block_size, length))
+        if run_zero is not None and zero != run_zero:
+            yield run_start, start, run_zero
+            run_start = start
+        run_zero = zero
+    if run_zero is not None:
+        yield run_start, length, run_zero
+
+
+@lru_cache(maxsize=None)
+def _get_fallocate():
+    """ Return libc's fallocate, or None where it is not available """
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (AttributeError, OSError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return fallocate
+
+
+def punch_hole(fd, offset, length):
+    """ Deallocate a region of fd so it reads as zeros, writing zeros if holes are unsupported """
+    fallocate = _get_fallocate()
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if fallocate is not None and fallocate(fd, mode, offset, length) == 0:
+        return
+    for start in range(0, length, ZERO_BLOCK_SIZE):
+        _write_all(fd, _ZEROS[: min(ZERO_BLOCK_SIZE, length - start)], offset + start)
+
+
+def write_sparse(fd, data, length, offset, punch=False):
+    """Write data[:length] to fd at offset, skipping blocks that are all zeros
+
+    Skipped blocks are left as they are, which reads as zeros in a new sparse file. With
+    punch=True they are deallocated instead, for regions that may hold older data.
+    Returns the number of bytes actually written.
+    """
+    view = memoryview(data)
+    written = 0
+    for start, end, zero in zero_runs(data, length):
+        if zero:
+            if punch:
+                punch_hole(fd, offset + start, end - start)
+            continue
+        _write_all(fd, view[start:end], offset + start)
+        written += end - start
+    return written
+
+
+class RawImageWriter:
+    """Write a raw image, regions that are never written stay as holes
+
+    With sparse=True, written blocks that are all zeros are skipped as well
+    """
+
+    def __init__(self, path, capacity_bytes, sparse=True):
+        """ Create (or truncate) path as a sparse file of capacity_bytes """
+        self.path = path
+        self.capacity_bytes = capacity_bytes
+        self.sparse = sparse
+        self.bytes_allocated = 0
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, capacity_bytes)
+        self._lock = Lock()
+
+    def write(self, offset, data):
+        """ Write data at the given guest offset. Safe to call from several threads """
+        if self.sparse:
+            written = write_sparse(self.fd, data, len(data), offset)
+        else:
+            _write_all(self.fd, data, offset)
+            written = len(data)
+        with self._lock:
+            self.bytes_allocated += written
+
+    def close(self):
+        """ Flush and close the image """
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+    def abort(self):
+        """ Close the image without finalizing it """
+        os.close(self.fd)
+
+
+class Qcow2ImageWriter:
+    """Write a qcow2 (version 2) image
+
+    Data clusters are appended in the order they are first written, the L2 tables, L1 table and
+    refcounts are appended and the header written when the image is closed. With sparse=True,
+    all-zero writes to clusters that are not allocated yet are skipped.
+    """
+
+    def __init__(self, path, capacity_bytes, cluster_bits=DEFAULT_CLUSTER_BITS, sparse=True):
+        """ Create (or truncate) path, reserving cluster 0 for the header """
+        self.path = path
+        self.capacity_bytes = capacity_bytes
+        self.sparse = sparse
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.l1_size = -(-capacity_bytes // (self.cluster_size * self.l2_entries))
+        self.clusters = {}  # guest cluster index: host offset
+        self.next_offset = self.cluster_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._lock = Lock()
+
+    @property
+    def bytes_allocated(self):
+        """ Bytes of guest data clusters allocated in the image """
+        return len(self.clusters) * self.cluster_size
+
+    def _host_offset(self, guest_cluster, zero=False):
+        """ Return the host offset of a guest cluster, allocating it unless zero is True """
+        with self._lock:
+            offset = self.clusters.get(guest_cluster)
+            if offset is None and zero:
+                return None
+            if offset is None:
+                offset = self.next_offset
+                self.next_offset += self.cluster_size
+                self.clusters[guest_cluster] = offset
+            return offset
+
+    def write(self, offset, data):
+        """ Write data at the given guest offset. Safe to call from several threads """
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            guest_cluster, in_cluster = divmod(offset + position, self.cluster_size)
+            length = min(len(view) - position, self.cluster_size - in_cluster)
+            zero = self.sparse and all(
+                is_zero(data, start, min(start + ZERO_BLOCK_SIZE, position + length))
+                for start in range(position, position + length, ZERO_BLOCK_SIZE)
+            )
+            host_offset = self._host_offset(guest_cluster, zero=zero)
+            end = position + length
+            if host_offset is not None:
+                _write_all(self.fd, view[position:end], host_offset + in_cluster)
+            position = end
+
+    def _allocate(self, num_clusters):
+        """ Reserve num_clusters contiguous clusters at the end of the file """
+        offset = self.next_offset
+        self.next_offset += num_clusters * self.cluster_size
+        return offset
+
+    def _write_tables(self):
+        """ Append the L2 tables and the L1 table, return the L1 table offset """
+        l2_tables = {}
+        for guest_cluster, host_offset in self.clusters.items():
+            l1_index, l2_index = divmod(guest_cluster, self.l2_entries)
+            l2_tables.setdefault(l1_index, [0] * self.l2_entries)[l2_index] = (
+                host_offset | QCOW2_COPIED
+            )
+        l1_table = [0] * self.l1_size
+        for l1_index in sorted(l2_tables):
+            l2_offset = self._allocate(1)
+            table = struct.pack(f">{self.l2_entries}Q", *l2_tables[l1_index])
+            _write_all(self.fd, table, l2_offset)
+            l1_table[l1_index] = l2_offset | QCOW2_COPIED
+        l1_clusters = max(1, -(-self.l1_size * 8 // self.cluster_size))
+        l1_offset = self._allocate(l1_clusters)
+        _write_all(self.fd, struct.pack(f">{self.l1_size}Q", *l1_table), l1_offset)
+        return l1_offset
+
+    def _write_refcounts(self):
+        """ Append refcount blocks covering every cluster, return the table offset and size """
+        per_block = self.cluster_size // 2  # 16 bit refcounts
+        used = self.next_offset // self.cluster_size
+        num_blocks = 0
+        table_clusters = 0
+        # The refcount structures must also count themselves
+        while True:
+            total = used + num_blocks + table_clusters
+            need_blocks = -(-total // per_block)
+            need_table = max(1, -(-need_blocks * 8 // self.cluster_size))
+            if (need_blocks, need_table) == (num_blocks, table_clusters):
+                break
+            num_blocks, table_clusters = need_blocks, need_table
+        table_offset = self._allocate(table_clusters)
+        blocks_offset = self._allocate(num_blocks)
+        total = self.next_offset // self.cluster_size
+        table = []
+        for block in range(num_blocks):
+            first = block * per_block
+            count = min(per_block, total - first)
+            refcounts = struct.pack(f">{count}H", *([1] * count))
+            block_offset = blocks_offset + block * self.cluster_size
+            _write_all(self.fd, refcounts, block_offset)
+            table.append(block_offset)
+        _write_all(self.fd, struct.pack(f">{len(table)}Q", *table), table_offset)
+        return table_offset, table_clusters
+
+    def close(self):
+        """ Write the metadata and header, then close the image """
+        l1_offset = self._write_tables()
+        refcount_offset, refcount_clusters = self._write_refcounts()
+        header = QCOW2_HEADER.pack(
+            QCOW2_MAGIC,
+            QCOW2_VERSION,
+            0,
+            0,
+            self.cluster_bits,
+            self.capacity_bytes,
+            0,
+            self.l1_size,
+            l1_offset,
+            refcount_offset,
+            refcount_clusters,
+            0,
+            0,
+        )
+        _write_all(self.fd, header, 0)
+        os.ftruncate(self.fd, self.next_offset)
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+    def abort(self):
+        """ Close the image without finalizing it """
+        os.close(self.fd)
+
+
+def get_image_writer(image_format, path, capacity_bytes, sparse=True):
+    """ Return a writer for image_format, one of IMAGE_FORMATS """
+    if image_format == "raw":
+        return RawImageWriter(path, capacity_bytes, sparse=sparse)
+    if image_format == "qcow2":
+        return Qcow2ImageWriter(path, capacity_bytes, sparse=sparse)
+    raise ValueError(f"Unsupported image format {image_format}. Supported: {IMAGE_FORMATS}")
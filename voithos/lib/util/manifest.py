@@ -0,0 +1,199 @@
+""" Integrity manifests: sha256 hash trees of fixed size blocks, built while files download """
+import hashlib
+import json
+import os
+from threading import Lock
+
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+HASH_ALGORITHM = "sha256"
+DEFAULT_BLOCK_SIZE = 1024 * 1024 * 64  # 64 MB
+READ_SIZE = 1024 * 1024 * 4
+
+
+class ManifestError(Exception):
+    """ The integrity manifest is missing, unreadable or does not describe the file """
+
+
+def get_manifest_path(file_path):
+    """ Return the path of the integrity manifest kept next to file_path """
+    return f"{file_path}{MANIFEST_SUFFIX}"
+
+
+def merkle_root(digests):
+    """Return the hex root of a binary hash tree over the hex block digests
+
+    Each level hashes the concatenated pairs of the level below, an odd digest out is carried
+    up unchanged. An empty file's root is the digest of no data.
+    """
+    level = [bytes.fromhex(digest) for digest in digests]
+    if not level:
+        return hashlib.sha256().hexdigest()
+    while len(level) > 1:
+        pairs = [level[slice(num, num + 2)] for num in range(0, len(level), 2)]
+        level = [
+            hashlib.sha256(b"".join(pair)).digest() if len(pair) == 2 else pair[0] for pair in pairs
+        ]
+    return level[0].hex()
+
+
+def hash_file_blocks(file_path, block_size, indexes):
+    """ Read and hash the given block indexes of file_path, return {index: hex digest} """
+    digests = {}
+    with open(file_path, "rb") as data_file:
+        for index in indexes:
+            data_file.seek(index * block_size)
+            block_hash = hashlib.sha256()
+            remaining = block_size
+            while remaining:
+                data = data_file.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                block_hash.update(data)
+                remaining -= len(data)
+            digests[index] = block_hash.hexdigest()
+    return digests
+
+
+class BlockHasher:
+    """Hash one sequential stream of a file, block by block, as its bytes arrive
+
+    Only blocks that the stream covers completely are hashed, plus the final short block when
+    the stream reaches the end of the file. Blocks split across streams are left to
+    IntegrityManifest.finish, which reads them back from disk.
+    """
+
+    def __init__(self, manifest, offset, whole_file=False):
+        """ Hash the bytes of manifest's file from offset on, and all of it if whole_file """
+        self.manifest = manifest
+        block_size = manifest.block_size
+        self.index = -(-offset // block_size)
+        self._skip = self.index * block_size - offset  # bytes before the first whole block
+        self._hash = hashlib.sha256()
+        self._filled = 0
+        self._file_hash = hashlib.sha256() if whole_file and offset == 0 else None
+
+    def update(self, data):
+        """ Hash the next bytes of the stream """
+        view = memoryview(data)
+        if self._file_hash is not None:
+            self._file_hash.update(view)
+        if self._skip:
+            skipped = min(self._skip, len(view))
+            self._skip -= skipped
+            view = view[skipped:]
+        block_size = self.manifest.block_size
+        while view:
+            take = min(block_size - self._filled, len(view))
+            self._hash.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == block_size:
+                self.manifest.add_block(self.index, self._hash.hexdigest())
+                self.index += 1
+                self._hash = hashlib.sha256()
+                self._filled = 0
+
+    def close(self, at_eof):
+        """ The stream completed, at_eof if it ended at the end of the file """
+        if not at_eof:
+            return
+        if self._filled:
+            self.manifest.add_block(self.index, self._hash.hexdigest())
+        if self._file_hash is not None:
+            self.manifest.sha256 = self._file_hash.hexdigest()
+
+
+class IntegrityManifest:
+    """Per-block sha256 digests, their hash tree root and (when known) the whole file sha256
+
+    The whole-file sha256 is only computed when the file arrived as one sequential stream,
+    the root covers the file either way and is what verify_file checks
+    """
+
+    def __init__(self, file_path, block_size=DEFAULT_BLOCK_SIZE):
+        """ Collect digests for file_path in blocks of block_size bytes """
+        self.file_path = file_path
+        self.path = get_manifest_path(file_path)
+        self.block_size = block_size
+        self.blocks = {}  # block index: hex digest
+        self.size = None
+        self.sha256 = None
+        self.root = None
+        self.rehashed_blocks = 0  # blocks that had to be read back from disk
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, file_path):
+        """ Return the manifest saved for file_path, raise ManifestError if there is none """
+        path = get_manifest_path(file_path)
+        try:
+            with open(path, encoding="utf-8") as manifest_file:
+                data = json.load(manifest_file)
+            if data.get("version") != MANIFEST_VERSION or data["algorithm"] != HASH_ALGORITHM:
+                raise ManifestError(f"Unsupported manifest {path}")
+            manifest = cls(file_path, int(data["block_size"]))
+            manifest.blocks = dict(enumerate(data["blocks"]))
+            manifest.size = int(data["size"])
+            manifest.sha256 = data["sha256"]
+            manifest.root = data["root"]
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            raise ManifestError(f"Failed to read manifest {path}: {exc}") from exc
+        return manifest
+
+    def stream(self, offset, whole_file=False):
+        """ Return a BlockHasher for a stream of the file starting at offset """
+        return BlockHasher(self, offset, whole_file=whole_file)
+
+    def add_block(self, index, digest):
+        """ Record the digest of a block """
+        with self._lock:
+            self.blocks[index] = digest
+
+    def finish(self, size):
+        """ Hash the blocks no stream covered by reading them back, then compute the root """
+        self.size = size
+        num_blocks = -(-size // self.block_size)
+        self.blocks = {index: digest for index, digest in self.blocks.items() if index < num_blocks}
+        missing = [index for index in range(num_blocks) if index not in self.blocks]
+        if missing:
+            self.blocks.update(hash_file_blocks(self.file_path, self.block_size, missing))
+        self.rehashed_blocks = len(missing)
+        self.root = merkle_root([self.blocks[index] for index in range(num_blocks)])
+
+    def save(self):
+        """ Atomically write the manifest next to the data file """
+        data = {
+            "version": MANIFEST_VERSION,
+            "file": os.path.basename(self.file_path),
+            "size": self.size,
+            "algorithm": HASH_ALGORITHM,
+            "block_size": self.block_size,
+            "blocks": [self.blocks[index] for index in sorted(self.blocks)],
+            "root": self.root,
+            "sha256": self.sha256,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(data, manifest_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """ Delete the saved manifest """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def verify_file(file_path, manifest=None):
+    """Re-hash file_path and compare it to its manifest, return the indexes of bad blocks
+
+    Raises ManifestError when there is no manifest or the file size differs from it
+    """
+    manifest = manifest if manifest is not None else IntegrityManifest.load(file_path)
+    size = os.path.getsize(file_path)
+    if size != manifest.size:
+        raise ManifestError(f"{file_path} is {size} bytes, its manifest says {manifest.size}")
+    num_blocks = -(-size // manifest.block_size)
+    digests = hash_file_blocks(file_path, manifest.block_size, range(num_blocks))
+    return [index for index in range(num_blocks) if digests[index] != manifest.blocks.get(index)]
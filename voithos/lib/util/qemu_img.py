@@ -2,10 +2,14 @@
 from pathlib import Path
 
 from voithos.lib.system import shell, assert_path_exists
+from voithos.lib.util.vmdk import get_vmdk_info, VMDKParseError
 
 
-def convert(input_format, output_format, input_path, output_path):
-    """ Execute qemu-img inside a container that mounts input_path and output_path to itself """
+def convert(input_format, output_format, input_path, output_path, sparse=True):
+    """Execute qemu-img inside a container that mounts input_path and output_path to itself
+
+    sparse=True skips writing 4k blocks of zeros, sparse=False writes every byte
+    """
     # mount the input file to /work/<filename> inside the container
     path_in = Path(input_path)
     input_abspath = path_in.absolute().__str__()
@@ -29,16 +33,29 @@ def convert(input_format, output_format, input_path, output_path):
         out_mount = f"-v {output_dir}:{internal_output_dir}"
     name = f"qemu-img_{path_in.name}"
     image = "breqwatr/qemu-img:latest"
+    sparse_size = "4k" if sparse else "0"
     run = (
-        f"qemu-img convert -f {input_format} -O {output_format} "
+        f"qemu-img convert -S {sparse_size} -f {input_format} -O {output_format} "
         f"{internal_input_path} {internal_output_path}"
     )
     cmd = f"docker run -it --name {name} --rm {in_mount} {out_mount} {image} {run}"
     shell(cmd)
 
 
-def show(vol_path):
-    """ Execute qemu-img show inside a container, direct mapping the volume """
+def show(vol_path, docker=False):
+    """Print qemu-img style info about a volume
+
+    VMDK files are read natively. Other formats, or docker=True, execute qemu-img show inside a
+    container, direct mapping the volume
+    """
+    if not docker:
+        try:
+            info = get_vmdk_info(vol_path)
+        except VMDKParseError:
+            info = None
+        if info is not None:
+            print_vmdk_info(vol_path, info)
+            return
     name = "qemu-img"
     image = "breqwatr/qemu-img:latest"
     path = Path(vol_path)
@@ -47,3 +64,21 @@ def show(vol_path):
     mount = f"-v {vol_abspath}:{vol_abspath}"
     cmd = f"docker run --rm -it --name {name} {mount} {image} {run}"
     shell(cmd)
+
+
+def print_vmdk_info(vol_path, info):
+    """ Print the output of vmdk.get_vmdk_info in the layout of qemu-img info """
+    capacity = info["capacity_bytes"]
+    print(f"image: {vol_path}")
+    print("file format: vmdk")
+    print(f"virtual size: {round(capacity / 1024 ** 3, 2)} GiB ({capacity} bytes)")
+    print(f"file size: {info['file_size_bytes']} bytes")
+    if info["grain_size_bytes"]:
+        print(f"cluster_size: {info['grain_size_bytes']}")
+    print("Format specific information:")
+    print(f"    create type: {info['format']}")
+    print(f"    compressed: {str(info['compressed']).lower()}")
+    if info["allocated_grains"] is not None:
+        print(f"    allocated grains: {info['allocated_grains']}")
+    if info["allocated_bytes"] is not None:
+        print(f"    allocated bytes: {info['allocated_bytes']}")
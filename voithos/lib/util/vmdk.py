@@ -0,0 +1,244 @@
+""" VMDK library: read disk geometry from VMDK headers and descriptors without qemu-img """
+import os
+import re
+import struct
+
+SECTOR_SIZE = 512
+SPARSE_MAGIC = b"KDMV"
+GD_AT_END = 0xFFFFFFFFFFFFFFFF
+COMPRESSION_DEFLATE = 1
+FLAG_COMPRESSED = 1 << 16
+FLAG_MARKERS = 1 << 17
+MARKER_EOS = 0
+GRAIN_MARKER = struct.Struct("<QI")  # lba, compressed size
+# SparseExtentHeader from the VMDK spec, the remainder of the 512 byte sector is padding
+SPARSE_HEADER = struct.Struct("<4sIIQQQQIQQQB4sH")
+MAX_DESCRIPTOR_SIZE = 1024 * 64
+EXTENT_LINE = re.compile(r'^(RW|RDONLY|NOACCESS)\s+(\d+)\s+(\w+)(?:\s+"([^"]*)")?', re.MULTILINE)
+CREATE_TYPE_LINE = re.compile(r'^createType\s*=\s*"([^"]*)"', re.MULTILINE)
+
+
+class VMDKParseError(Exception):
+    """ The file is not a VMDK this parser understands """
+
+
+def parse_sparse_header(data):
+    """ Return a dict of the fields of a 512 byte SparseExtentHeader """
+    if len(data) < SPARSE_HEADER.size or data[:4] != SPARSE_MAGIC:
+        raise VMDKParseError("Not a sparse VMDK extent header")
+    fields = SPARSE_HEADER.unpack_from(data)
+    return {
+        "version": fields[1],
+        "flags": fields[2],
+        "capacity": fields[3],  # sectors
+        "grain_size": fields[4],  # sectors
+        "descriptor_offset": fields[5],
+        "descriptor_size": fields[6],
+        "num_gtes_per_gt": fields[7],
+        "rgd_offset": fields[8],
+        "gd_offset": fields[9],
+        "overhead": fields[10],
+        "compress_algorithm": fields[13],
+    }
+
+
+def parse_descriptor(text):
+    """ Return the createType and extents of a VMDK text descriptor """
+    create_type = CREATE_TYPE_LINE.search(text)
+    extents = [
+        {"access": access, "sectors": int(sectors), "type": ext_type, "file": file_name}
+        for access, sectors, ext_type, file_name in EXTENT_LINE.findall(text)
+    ]
+    return {"create_type": create_type.group(1) if create_type else None, "extents": extents}
+
+
+def _count_allocated_grains(vmdk, header):
+    """ Walk the grain directory and tables, counting grains that hold data """
+    if header["gd_offset"] in (0, GD_AT_END) or not header["num_gtes_per_gt"]:
+        return None
+    num_grains = -(-header["capacity"] // header["grain_size"])
+    num_gts = -(-num_grains // header["num_gtes_per_gt"])
+    vmdk.seek(header["gd_offset"] * SECTOR_SIZE)
+    gd_data = vmdk.read(num_gts * 4)
+    if len(gd_data) != num_gts * 4:
+        return None
+    gt_format = struct.Struct(f"<{header['num_gtes_per_gt']}I")
+    allocated = 0
+    for gt_sector in struct.unpack(f"<{num_gts}I", gd_data):
+        if not gt_sector:
+            continue
+        vmdk.seek(gt_sector * SECTOR_SIZE)
+        gt_data = vmdk.read(gt_format.size)
+        if len(gt_data) != gt_format.size:
+            return None
+        # 0 is an unallocated grain, 1 is an explicitly zeroed grain
+        allocated += sum(1 for entry in gt_format.unpack(gt_data) if entry > 1)
+    return allocated
+
+
+def _get_sparse_info(vmdk, header_data):
+    """ Return the info dict of a sparse (monolithicSparse or streamOptimized) extent """
+    header = parse_sparse_header(header_data)
+    file_size = os.fstat(vmdk.fileno()).st_size
+    if header["gd_offset"] == GD_AT_END and file_size >= SECTOR_SIZE * 3:
+        # streamOptimized: the real grain directory offset is in the footer, 2 sectors from the end
+        vmdk.seek(file_size - SECTOR_SIZE * 2)
+        try:
+            header = parse_sparse_header(vmdk.read(SECTOR_SIZE))
+        except VMDKParseError:
+            pass  # An incomplete stream has no footer yet
+    descriptor = {"create_type": None, "extents": []}
+    if header["descriptor_offset"] and header["descriptor_size"]:
+        vmdk.seek(header["descriptor_offset"] * SECTOR_SIZE)
+        raw = vmdk.read(min(header["descriptor_size"] * SECTOR_SIZE, MAX_DESCRIPTOR_SIZE))
+        descriptor = parse_descriptor(raw.split(b"\0", 1)[0].decode("utf-8", "replace"))
+    grain_size_bytes = header["grain_size"] * SECTOR_SIZE
+    allocated_grains = _count_allocated_grains(vmdk, header)
+    allocated_bytes = None if allocated_grains is None else allocated_grains * grain_size_bytes
+    compressed = header["compress_algorithm"] == COMPRESSION_DEFLATE
+    return {
+        "format": descriptor["create_type"] or ("streamOptimized" if compressed else "sparse"),
+        "capacity_bytes": header["capacity"] * SECTOR_SIZE,
+        "grain_size_bytes": grain_size_bytes,
+        "allocated_grains": allocated_grains,
+        "allocated_bytes": allocated_bytes,
+        "compressed": compressed,
+        "version": header["version"],
+        "file_size_bytes": file_size,
+    }
+
+
+def _get_descriptor_info(path, text):
+    """ Return the info dict of a text descriptor file and its flat/sparse extents """
+    descriptor = parse_descriptor(text)
+    if not descriptor["extents"]:
+        raise VMDKParseError(f"No extents found in VMDK descriptor {path}")
+    allocated_bytes = 0
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for extent in descriptor["extents"]:
+        extent_path = os.path.join(base_dir, extent["file"] or "")
+        if not extent["file"] or not os.path.isfile(extent_path):
+            allocated_bytes = None
+            break
+        allocated_bytes += os.stat(extent_path).st_blocks * SECTOR_SIZE
+    return {
+        "format": descriptor["create_type"],
+        "capacity_bytes": sum(ext["sectors"] for ext in descriptor["extents"]) * SECTOR_SIZE,
+        "grain_size_bytes": None,
+        "allocated_grains": None,
+        "allocated_bytes": allocated_bytes,
+        "compressed": False,
+        "version": None,
+        "file_size_bytes": os.path.getsize(path),
+        "extents": descriptor["extents"],
+    }
+
+
+def get_vmdk_info(path):
+    """Return a dict describing a VMDK file: format, capacity, grain size and allocation
+
+    Sparse and streamOptimized extents are read from their binary headers, descriptor files
+    from their text extent list. Raises VMDKParseError for anything else.
+    """
+    with open(path, "rb") as vmdk:
+        header_data = vmdk.read(SECTOR_SIZE)
+        if header_data[:4] == SPARSE_MAGIC:
+            return _get_sparse_info(vmdk, header_data)
+        if os.fstat(vmdk.fileno()).st_size > MAX_DESCRIPTOR_SIZE:
+            raise VMDKParseError(f"{path} is neither a sparse VMDK nor a VMDK descriptor")
+        vmdk.seek(0)
+        raw = vmdk.read()
+    if b"\0" in raw or b"# Disk DescriptorFile" not in raw:
+        raise VMDKParseError(f"{path} is neither a sparse VMDK nor a VMDK descriptor")
+    return _get_descriptor_info(path, raw.decode("utf-8", "replace"))
+
+
+def is_vmdk(path):
+    """ Return True if path can be read by get_vmdk_info """
+    try:
+        get_vmdk_info(path)
+    except (VMDKParseError, OSError):
+        return False
+    return True
+
+
+class StreamOptimizedDecoder:
+    """Incrementally parse a streamOptimized VMDK as its bytes arrive
+
+    feed() returns the (byte offset, zlib-compressed data) of every complete grain in the data
+    seen so far. Grain tables, the grain directory and the footer are skipped, their content is
+    implied by the grain markers.
+    """
+
+    def __init__(self):
+        """ Start at the beginning of the stream """
+        self.header = None
+        self.finished = False
+        self._buf = bytearray()
+        self._skip = 0  # bytes to discard before the next marker
+
+    @property
+    def capacity_bytes(self):
+        """ Virtual size of the disk, once the header has been read """
+        return None if self.header is None else self.header["capacity"] * SECTOR_SIZE
+
+    @property
+    def grain_size_bytes(self):
+        """ Uncompressed size of a full grain, once the header has been read """
+        return None if self.header is None else self.header["grain_size"] * SECTOR_SIZE
+
+    def _read_header(self, offset):
+        """ Parse the header at offset, return the number of bytes before the first marker """
+        end = offset + SECTOR_SIZE
+        header = parse_sparse_header(bytes(self._buf[offset:end]))
+        needed_flags = FLAG_COMPRESSED | FLAG_MARKERS
+        has_markers = header["flags"] & needed_flags == needed_flags
+        if not has_markers or header["compress_algorithm"] != COMPRESSION_DEFLATE:
+            raise VMDKParseError("Not a streamOptimized VMDK: no compressed grain markers")
+        self.header = header
+        descriptor_end = header["descriptor_offset"] + header["descriptor_size"]
+        return max(header["overhead"], descriptor_end, 1) * SECTOR_SIZE
+
+    def feed(self, data):
+        """ Consume the next bytes of the stream, return a list of (offset, compressed) grains """
+        self._buf += data
+        grains = []
+        offset = 0
+        while not self.finished:
+            available = len(self._buf) - offset
+            if self._skip:
+                skipped = min(self._skip, available)
+                offset += skipped
+                self._skip -= skipped
+                if self._skip:
+                    break
+                continue
+            if self.header is None:
+                if available < SECTOR_SIZE:
+                    break
+                self._skip = self._read_header(offset)
+                continue
+            if available < GRAIN_MARKER.size + 4:
+                break
+            lba, size = GRAIN_MARKER.unpack_from(self._buf, offset)
+            if size:
+                # Grain marker: compressed data follows, padded to a sector
+                end = offset + GRAIN_MARKER.size + size
+                if end > len(self._buf):
+                    break
+                start = offset + GRAIN_MARKER.size
+                grains.append((lba * SECTOR_SIZE, self._buf[start:end]))
+                padded = -(-(GRAIN_MARKER.size + size) // SECTOR_SIZE) * SECTOR_SIZE
+                offset = end
+                self._skip = padded - GRAIN_MARKER.size - size
+                continue
+            # Metadata marker: one sector, then lba sectors of metadata
+            (marker_type,) = struct.unpack_from("<I", self._buf, offset + GRAIN_MARKER.size)
+            if marker_type == MARKER_EOS:
+                self.finished = True
+                offset = len(self._buf)
+                break
+            offset += GRAIN_MARKER.size + 4
+            self._skip = SECTOR_SIZE - GRAIN_MARKER.size - 4 + lba * SECTOR_SIZE
+        del self._buf[:offset]
+        return grains
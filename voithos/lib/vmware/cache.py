@@ -0,0 +1,141 @@
+""" On-disk SQLite cache of the VM inventory of each vCenter """
+import os
+import sqlite3
+from time import time
+
+from voithos.lib.system import get_absolute_path
+
+
+# ~/.voithos is the config file, so the cache gets its own directory
+DEFAULT_CACHE_PATH = "~/.voithos-cache/inventory.db"
+DEFAULT_TTL = 3600  # seconds a cached inventory is used without asking vCenter for changes
+SESSION_TTL = 8 * 3600  # seconds after its login a cached session is logged out, not resumed
+
+# Cached columns of each object table, besides vcenter and mo_id
+TABLE_COLUMNS = {
+    "vms": ["name", "uuid", "power_state", "host", "disk_bytes"],
+    "hosts": ["name"],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vcenters (
+    vcenter TEXT PRIMARY KEY,
+    refreshed_at REAL NOT NULL,
+    session_cookie TEXT,
+    api_version TEXT,
+    collector TEXT,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS vms (
+    vcenter TEXT NOT NULL,
+    mo_id TEXT NOT NULL,
+    name TEXT,
+    uuid TEXT,
+    power_state TEXT,
+    host TEXT,
+    disk_bytes INTEGER,
+    PRIMARY KEY (vcenter, mo_id)
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    vcenter TEXT NOT NULL,
+    mo_id TEXT NOT NULL,
+    name TEXT,
+    PRIMARY KEY (vcenter, mo_id)
+);
+"""
+
+
+class InventoryCache:
+    """The cached VMs and ESXi hosts of each vCenter, with the state needed to refresh them
+
+    A vCenter's state holds when it was last refreshed, the session cookie and API version to
+    resume its session, and the PropertyCollector and version to ask it for the changes since.
+    The database is only readable by its owner since the session cookie is a credential.
+    Callers key each vCenter by the user too, see VMWareMgr.cache_key, as both the session and
+    the VMs a user can see are their own.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        """ Open the cache database, creating it if needed """
+        self.path = get_absolute_path(path)
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        os.chmod(self.path, 0o600)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """ Close the database """
+        self.db.close()
+
+    def get_state(self, vcenter):
+        """ Return the refresh state dict of vcenter, or None when it was never cached """
+        row = self.db.execute("SELECT * FROM vcenters WHERE vcenter = ?", (vcenter,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_fresh(self, state, ttl=DEFAULT_TTL):
+        """ Return True when a state was refreshed less than ttl seconds ago """
+        return state is not None and time() - state["refreshed_at"] < ttl
+
+    def get_records(self, vcenter):
+        """Return the cached VMs of vcenter in the order they were added
+
+        Each record has mo_id, name, uuid, power_state, host (the ESXi host name) and disk_bytes
+        """
+        rows = self.db.execute(
+            "SELECT vms.mo_id, vms.name, vms.uuid, vms.power_state, hosts.name AS host,"
+            " vms.disk_bytes FROM vms LEFT JOIN hosts"
+            " ON hosts.vcenter = vms.vcenter AND hosts.mo_id = vms.host"
+            " WHERE vms.vcenter = ? ORDER BY vms.rowid",
+            (vcenter,),
+        )
+        return [dict(row) for row in rows]
+
+    def _apply(self, vcenter, table, kind, mo_id, values):
+        """ Apply one object change, values holding only the columns that changed """
+        if kind == "leave":
+            self.db.execute(
+                f"DELETE FROM {table} WHERE vcenter = ? AND mo_id = ?", (vcenter, mo_id)
+            )
+            return
+        columns = [column for column in TABLE_COLUMNS[table] if column in values]
+        params = [values[column] for column in columns]
+        if kind == "enter":
+            names = ", ".join(["vcenter", "mo_id"] + columns)
+            marks = ", ".join("?" * (len(columns) + 2))
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {table} ({names}) VALUES ({marks})",
+                [vcenter, mo_id] + params,
+            )
+        elif columns:
+            assignments = ", ".join(f"{column} = ?" for column in columns)
+            self.db.execute(
+                f"UPDATE {table} SET {assignments} WHERE vcenter = ? AND mo_id = ?",
+                params + [vcenter, mo_id],
+            )
+
+    def update(self, vcenter, state, changes=(), reset=False):
+        """Save the state of vcenter and apply changes to its objects, in one transaction
+
+        changes are (table, kind, mo_id, values) tuples: table is a TABLE_COLUMNS key, kind is
+        "enter", "modify" or "leave" as in a PropertyCollector ObjectUpdate, and values maps
+        columns to their new value. reset drops the cached objects of vcenter first.
+        """
+        with self.db:
+            if reset:
+                for table in TABLE_COLUMNS:
+                    self.db.execute(f"DELETE FROM {table} WHERE vcenter = ?", (vcenter,))
+            for table, kind, mo_id, values in changes:
+                self._apply(vcenter, table, kind, mo_id, values)
+            self.db.execute(
+                "INSERT OR REPLACE INTO vcenters (vcenter, refreshed_at, session_cookie,"
+                " api_version, collector, version) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    vcenter,
+                    state["refreshed_at"],
+                    state.get("session_cookie"),
+                    state.get("api_version"),
+                    state.get("collector"),
+                    state.get("version"),
+                ),
+            )
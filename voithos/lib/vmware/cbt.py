@@ -0,0 +1,313 @@
+""" Incremental disk syncs with vSphere Changed Block Tracking (CBT) """
+import json
+import os
+from threading import Thread
+
+from pyVim.task import WaitForTask
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.checkpoint import TransferCheckpoint, merge_ranges
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.datastore import get_datacenter, get_disk_url
+from voithos.lib.vmware.exporter import VMWareOnlineVMCantMigrate
+from voithos.lib.vmware.progress import DEFAULT_INTERVAL as DEFAULT_PROGRESS_INTERVAL
+from voithos.lib.vmware.progress import (
+    DEFAULT_STALL_SECONDS,
+    ProgressMonitor,
+    get_progress_writers,
+)
+from voithos.lib.vmware.transfer import (
+    DEFAULT_CHUNK_SIZE,
+    BufferPool,
+    DiskDownload,
+    DiskDownloadFailed,
+    get_session,
+    get_session_cookies,
+)
+
+
+CBT_SUFFIX = ".cbt.json"
+CBT_VERSION = 1
+
+POWERED_OFF = vim.VirtualMachine.PowerState.poweredOff
+
+# Keys of a CBT state that identify the disk an image was synced from
+DISK_KEYS = ["device_key", "backing_file", "capacity_bytes"]
+
+
+class CbtError(Exception):
+    """ Changed Block Tracking is off for a VM, or vCenter can't tell what changed """
+
+
+def get_cbt_path(file_path):
+    """ Return the path of the CBT state kept next to a disk image """
+    return f"{file_path}{CBT_SUFFIX}"
+
+
+def load_cbt_state(file_path):
+    """ Return the CBT state dict saved for a disk image, or None if there is no usable one """
+    path = get_cbt_path(file_path)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as state_file:
+            state = json.load(state_file)
+    except ValueError as exc:
+        debug(f"Ignoring unreadable CBT state {path}: {exc}")
+        return None
+    if not isinstance(state, dict) or state.get("version") != CBT_VERSION:
+        return None
+    return state
+
+
+def save_cbt_state(file_path, state):
+    """ Atomically write the CBT state dict of a disk image next to it """
+    path = get_cbt_path(file_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as state_file:
+        json.dump(dict(state, version=CBT_VERSION), state_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def enable_cbt(vm):
+    """ Turn Changed Block Tracking on for a VM, changes are tracked from its next power on """
+    WaitForTask(vm.ReconfigVM_Task(spec=vim.vm.ConfigSpec(changeTrackingEnabled=True)))
+
+
+def get_change_id(disk):
+    """ Return the CBT changeId of a VirtualDisk's current state, None if it is not tracked """
+    return getattr(disk.backing, "changeId", None) or None
+
+
+def query_changed_extents(vm, disk, change_id, snapshot=None):
+    """Return the (start, end) byte ranges of a VirtualDisk that changed since change_id
+
+    The changes are those of the disk in snapshot, or of the disk itself when snapshot is None,
+    which vCenter only allows for powered off VMs. Raises CbtError when the changes can't be
+    computed, for instance after CBT was reset.
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < disk.capacityInBytes:
+            info = vm.QueryChangedDiskAreas(
+                snapshot=snapshot, deviceKey=disk.key, startOffset=offset, changeId=change_id
+            )
+            extents.extend(
+                (area.start, area.start + area.length) for area in info.changedArea or []
+            )
+            if not info.length:
+                break
+            offset = info.startOffset + info.length
+    except vmodl.MethodFault as exc:
+        reason = getattr(exc, "msg", exc)
+        raise CbtError(f"Failed to query the changes of {disk.deviceInfo.label}: {reason}") from exc
+    return merge_ranges(extents)
+
+
+class IncrementalSync:
+    """Sync the disks of a VM into local raw images, fetching only what changed since last time
+
+    Each disk's flat extent is read from its datastore over HTTP, with Range requests. The first
+    sync fetches every byte. A <image>.cbt.json file next to each image keeps the CBT changeId
+    the image is in sync with, so later syncs ask vCenter which extents changed since then
+    (QueryChangedDiskAreas) and only fetch those, written in place into the image.
+
+    The unchanged ranges are saved as the image's download checkpoint, so DiskDownload fetches
+    the changed extents as the ranges missing from it, and an interrupted sync resumes.
+
+    A powered off VM is read as is. A running one is read through a snapshot passed to sync:
+    the VM writes to new delta disks while the disks frozen in the snapshot are its base disks.
+    Only those base disks have a flat extent, so the VM must not have other snapshots, whose
+    delta disks would be read instead (DatastorePathError).
+    """
+
+    def __init__(self, vmware_mgr, vm, base_dir=None, enable=False):
+        """Prepare to sync a VM into base_dir
+
+        Raises CbtError if CBT is off for the VM, unless enable=True turns it on
+        """
+        if not vm.config.changeTrackingEnabled:
+            if not enable:
+                raise CbtError("ERROR: Changed Block Tracking is off for this VM")
+            debug("Enabling Changed Block Tracking")
+            enable_cbt(vm)
+        self.vmware_mgr = vmware_mgr
+        self.vm = vm
+        self.base_dir = base_dir if base_dir is not None else os.getcwd()
+        self.datacenter_name = get_datacenter(vm).name
+
+    def get_disks(self, snapshot=None):
+        """ Return the VirtualDisks of the VM, or those frozen in one of its snapshots """
+        config = snapshot.config if snapshot is not None else self.vm.config
+        return [
+            device
+            for device in config.hardware.device
+            if isinstance(device, vim.vm.device.VirtualDisk)
+        ]
+
+    def get_image_path(self, disk):
+        """ Return the local raw image path of a VirtualDisk """
+        return os.path.join(self.base_dir, f"disk-{disk.key}.raw")
+
+    def _prepare_allocated(self, disk, file_path, snapshot=None):
+        """Leave only the allocated extents of a disk for a full sync to fetch, return its kind
+
+        The changes since changeId "*" are every allocated extent of the disk. The image is
+        emptied into a sparse file, the unallocated extents stay holes that read as zeros.
+        """
+        try:
+            extents = query_changed_extents(self.vm, disk, "*", snapshot=snapshot)
+        except CbtError as exc:
+            print(f"  {exc} - fetching every byte")
+            return "full"
+        with open(file_path, "wb") as image:
+            image.truncate(disk.capacityInBytes)
+        allocated = TransferCheckpoint(file_path, disk.capacityInBytes, extents)
+        TransferCheckpoint(file_path, disk.capacityInBytes, allocated.missing_ranges()).save()
+        return "allocated"
+
+    def _prepare(self, disk, file_path, snapshot=None, allocated_only=False):
+        """Save the CBT state and checkpoint of a disk's image for this sync, return its kind
+
+        "full" fetches the whole disk, "allocated" only its allocated extents (allocated_only),
+        "incremental" the extents changed since the last sync and "resume" what an interrupted
+        sync to the same changeId did not fetch yet.
+        """
+        previous = load_cbt_state(file_path)
+        state = {
+            "device_key": disk.key,
+            "backing_file": disk.backing.fileName,
+            "capacity_bytes": disk.capacityInBytes,
+            "change_id": None,
+            "pending_change_id": get_change_id(disk),
+        }
+        kind = "full"
+        same_keys = previous is not None and all(
+            previous.get(key) == state[key] for key in DISK_KEYS
+        )
+        same_size = os.path.isfile(file_path) and os.path.getsize(file_path) == disk.capacityInBytes
+        same_disk = same_keys and same_size
+        checkpoint = TransferCheckpoint.load(file_path) if same_disk else None
+        if same_disk and state["pending_change_id"] is not None:
+            state["change_id"] = previous.get("change_id")
+            resumable = checkpoint is not None and not checkpoint.complete
+            if previous.get("pending_change_id") == state["pending_change_id"] and resumable:
+                kind = "resume"
+            elif state["change_id"] is not None:
+                try:
+                    extents = query_changed_extents(
+                        self.vm, disk, state["change_id"], snapshot=snapshot
+                    )
+                    # The image is verified everywhere but on the changed extents
+                    changed = TransferCheckpoint(file_path, disk.capacityInBytes, extents)
+                    checkpoint = TransferCheckpoint(
+                        file_path, disk.capacityInBytes, changed.missing_ranges()
+                    )
+                    checkpoint.save()
+                    kind = "incremental"
+                except CbtError as exc:
+                    print(f"  {exc} - syncing the whole disk")
+        if kind == "full":
+            # Whatever the image holds is stale, its ranges must not be resumed
+            state["change_id"] = None
+            TransferCheckpoint(file_path, disk.capacityInBytes).remove()
+            if allocated_only:
+                kind = self._prepare_allocated(disk, file_path, snapshot=snapshot)
+        if state["pending_change_id"] is None:
+            print(f"  No CBT changeId for {file_path} yet, its next sync will be full too")
+        save_cbt_state(file_path, state)
+        return kind
+
+    def sync(
+        self,
+        segments=1,
+        sparse=True,
+        progress_format="text",
+        progress_output="-",
+        progress_interval=DEFAULT_PROGRESS_INTERVAL,
+        stall_seconds=DEFAULT_STALL_SECONDS,
+        print_interval=15,
+        snapshot=None,
+        allocated_only=False,
+    ):
+        """Bring the local image of every disk in sync with the VM
+
+        segments is the number of concurrent HTTP Range requests per disk, the other arguments
+        are those of VMWareExporter.download. The VM must be powered off, unless a snapshot of it
+        is given: its disks are then synced as they were when it was taken, from the base disk
+        files that the running VM no longer writes to.
+
+        With allocated_only, disks synced in full only get their allocated extents, which saves
+        fetching the zeros of thick provisioned disks.
+        """
+        if segments < 1:
+            raise ValueError(f"A sync needs at least 1 segment per disk, not {segments}")
+        if snapshot is None and self.vm.runtime.powerState != POWERED_OFF:
+            raise VMWareOnlineVMCantMigrate("ERROR: The VM is on. It must be offline")
+        writers = get_progress_writers(
+            progress_format, progress_output, print_interval=print_interval
+        )
+        syncs = []
+        monitor = None
+        try:
+            disks = self.get_disks(snapshot)
+            cookies = get_session_cookies(self.vmware_mgr.conn)
+            session = get_session(cookies=cookies, pool_size=segments * len(disks))
+            buffer_pool = BufferPool(segments * len(disks), DEFAULT_CHUNK_SIZE)
+            total_bytes = sum(disk.capacityInBytes for disk in disks)
+            print(f"Sync {len(disks)} disk(s):")
+            for disk in disks:
+                file_path = self.get_image_path(disk)
+                kind = self._prepare(
+                    disk, file_path, snapshot=snapshot, allocated_only=allocated_only
+                )
+                url = get_disk_url(self.vmware_mgr.ip_addr, self.datacenter_name, disk)
+                print(f"  {file_path} <-- {url} ({kind})")
+                transfer = DiskDownload(
+                    session,
+                    url,
+                    file_path,
+                    buffer_pool,
+                    segments=segments,
+                    resume=True,
+                    sparse=sparse,
+                )
+                thread = Thread(target=transfer.run)
+                thread.start()
+                syncs.append((file_path, transfer, thread, kind))
+            monitor = ProgressMonitor(
+                [(file_path, transfer) for file_path, transfer, _, _ in syncs],
+                total_bytes,
+                writers,
+                interval=progress_interval,
+                stall_seconds=stall_seconds,
+            )
+            monitor.start()
+        finally:
+            # When a later disk fails to start, the syncs of the earlier ones still run to the end
+            for _, _, thread, _ in syncs:
+                thread.join()
+            if monitor is not None:
+                monitor.stop()  # Closes the writers
+            else:
+                for writer in writers:
+                    writer.close()
+        failed = [transfer for _, transfer, _, _ in syncs if transfer.error is not None]
+        if failed:
+            errors = "; ".join(str(transfer.error) for transfer in failed)
+            raise DiskDownloadFailed(f"ERROR - {len(failed)} disk(s) failed to sync: {errors}")
+        skipped_total = 0
+        for file_path, transfer, _, kind in syncs:
+            state = load_cbt_state(file_path)
+            state["change_id"] = state["pending_change_id"]
+            state["pending_change_id"] = None
+            save_cbt_state(file_path, state)
+            fetched = transfer.bytes_written - transfer.resumed_bytes
+            print(f"  {file_path} - fetched {fetched} bytes, changeId {state['change_id']}")
+            if kind == "allocated":
+                # The unallocated extents were marked as on disk, they count as resumed
+                skipped_total += transfer.resumed_bytes
+                print(f"    skipped {transfer.resumed_bytes} unallocated bytes")
+        if allocated_only:
+            print(f"Skipped {skipped_total} unallocated bytes in total")
@@ -0,0 +1,107 @@
+""" On-disk checkpoint manifests that let interrupted disk downloads resume """
+import json
+import os
+from threading import Lock
+
+from voithos.lib.vmware.common import debug
+
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+def merge_ranges(ranges):
+    """ Return sorted (start, end) ranges with overlapping and touching ranges joined """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_checkpoint_path(file_path):
+    """ Return the path of the checkpoint manifest kept next to file_path """
+    return f"{file_path}{CHECKPOINT_SUFFIX}"
+
+
+class TransferCheckpoint:
+    """Byte ranges of a download that are known to be on disk
+
+    A range is only recorded after its data has been flushed with fdatasync, so the ranges in
+    the manifest never claim more than what survived a crash
+    """
+
+    def __init__(self, file_path, total_bytes, ranges=None):
+        """ Track the verified ranges of file_path, a file of total_bytes """
+        self.file_path = file_path
+        self.path = get_checkpoint_path(file_path)
+        self.total_bytes = total_bytes
+        self.ranges = merge_ranges(ranges or [])
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, file_path):
+        """ Return the checkpoint saved for file_path, or None if there is no usable one """
+        path = get_checkpoint_path(file_path)
+        if not os.path.isfile(path) or not os.path.isfile(file_path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as manifest:
+                data = json.load(manifest)
+            if data.get("version") != CHECKPOINT_VERSION:
+                return None
+            ranges = [(int(start), int(end)) for start, end in data["ranges"]]
+            return cls(file_path, int(data["total_bytes"]), ranges)
+        except (ValueError, KeyError, TypeError) as exc:
+            debug(f"Ignoring unreadable checkpoint {path}: {exc}")
+            return None
+
+    @property
+    def verified_bytes(self):
+        """ Number of bytes covered by the verified ranges """
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def complete(self):
+        """ True when every byte of the file is verified """
+        return self.ranges == [(0, self.total_bytes)]
+
+    def missing_ranges(self):
+        """ Return the (start, end) gaps that still need to be downloaded """
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start))
+            position = max(position, end)
+        if position < self.total_bytes:
+            missing.append((position, self.total_bytes))
+        return missing
+
+    def add_range(self, start, end):
+        """ Record [start, end) as flushed to disk and save the manifest """
+        if end <= start:
+            return
+        with self._lock:
+            self.ranges = merge_ranges(self.ranges + [(start, end)])
+            self.save()
+
+    def save(self):
+        """ Atomically write the manifest next to the data file """
+        data = {
+            "version": CHECKPOINT_VERSION,
+            "file": os.path.basename(self.file_path),
+            "total_bytes": self.total_bytes,
+            "ranges": self.ranges,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as manifest:
+            json.dump(data, manifest)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """ Delete the manifest """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,153 @@
+""" Bulk property retrieval and change tracking with ContainerViews and the PropertyCollector """
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.common import debug
+
+
+DEFAULT_BATCH_SIZE = 1000  # objects per RetrievePropertiesEx / ContinueRetrievePropertiesEx page
+REMOVED_OPS = ["remove", "indirectRemove"]  # PropertyChange ops that unset a property
+
+
+def _get_filter_spec(view, path_sets):
+    """ Return a FilterSpec selecting, in a ContainerView, the path_sets[obj_type] properties """
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name="traverseView", path="view", skip=False, type=vim.view.ContainerView
+    )
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=list(paths), all=False)
+        for obj_type, paths in path_sets.items()
+    ]
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+
+
+def _to_dicts(objects):
+    """ Convert ObjectContent results to {"obj": moref, <path>: value} dicts """
+    results = []
+    for content in objects:
+        props = {"obj": content.obj}
+        for prop in content.propSet:
+            props[prop.name] = prop.val
+        # Properties that could not be read (e.g. an inaccessible VM's config) are left out
+        for missing in content.missingSet or []:
+            debug(f"{content.obj}: could not read {missing.path}")
+        results.append(props)
+    return results
+
+
+def _retrieve(collector, filter_spec, batch_size):
+    """ Return the dicts of every object matched by filter_spec, reading batch_size per page """
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=batch_size)
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    results = []
+    while result is not None:
+        results.extend(_to_dicts(result.objects))
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return results
+
+
+def retrieve_properties(conn, obj_type, path_set, container=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Return a dict of the path_set properties for every obj_type object under container
+
+    All objects are read with RetrievePropertiesEx in pages of batch_size, instead of one round
+    trip per attribute. container defaults to the root folder. Each dict has the managed object
+    under "obj" and one key per property path that could be read.
+    """
+    content = conn.RetrieveContent()
+    container = container if container is not None else content.rootFolder
+    view = content.viewManager.CreateContainerView(container, [obj_type], True)
+    try:
+        filter_spec = _get_filter_spec(view, {obj_type: path_set})
+        results = _retrieve(content.propertyCollector, filter_spec, batch_size)
+    finally:
+        view.DestroyView()
+    debug(f"Retrieved {len(path_set)} properties of {len(results)} {obj_type.__name__} objects")
+    return results
+
+
+def retrieve_object_properties(conn, objs, path_set, batch_size=DEFAULT_BATCH_SIZE):
+    """Return a dict of the path_set properties of each managed object in objs, in their order
+
+    The objects must be of one type. They are read batch_size at a time, each batch with one
+    RetrievePropertiesEx call. Objects that returned nothing get a dict with only "obj".
+    """
+    collector = conn.RetrieveContent().propertyCollector
+    by_id = {}
+    for start in range(0, len(objs), batch_size):
+        end = start + batch_size
+        batch = objs[start:end]
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in batch]
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=type(batch[0]), pathSet=list(path_set), all=False
+        )
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=obj_specs, propSet=[prop_spec]
+        )
+        for props in _retrieve(collector, filter_spec, batch_size):
+            by_id[props["obj"]._moId] = props
+    debug(f"Retrieved {len(path_set)} properties of {len(by_id)}/{len(objs)} objects")
+    return [by_id.get(obj._moId, {"obj": obj}) for obj in objs]
+
+
+def create_update_collector(conn, path_sets, container=None):
+    """Return a new PropertyCollector with a filter on the path_sets[obj_type] properties
+
+    The collector, its filter and their ContainerView belong to the session and stay on the
+    server until it ends, so wait_for_updates can be called on the collector again later, even
+    from another process resuming the same session.
+    """
+    content = conn.RetrieveContent()
+    container = container if container is not None else content.rootFolder
+    view = content.viewManager.CreateContainerView(container, list(path_sets), True)
+    collector = content.propertyCollector.CreatePropertyCollector()
+    collector.CreateFilter(_get_filter_spec(view, path_sets), partialUpdates=False)
+    return collector
+
+
+def create_object_collector(conn, obj, path_set):
+    """Return a new PropertyCollector with a filter on the path_set properties of one object
+
+    Destroy it with DestroyPropertyCollector once done
+    """
+    collector = conn.RetrieveContent().propertyCollector.CreatePropertyCollector()
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=type(obj), pathSet=list(path_set), all=False
+    )
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=[prop_spec]
+    )
+    collector.CreateFilter(filter_spec, partialUpdates=False)
+    return collector
+
+
+def wait_for_updates(collector, version="", batch_size=DEFAULT_BATCH_SIZE, max_wait_seconds=0):
+    """Return the changes seen by collector since version, and the new version
+
+    An empty version returns every object, as "enter" updates. Waits up to max_wait_seconds for
+    new changes, by default it does not wait.
+    Each change is a (kind, props) tuple: kind is "enter", "modify" or "leave" and props is a
+    {"obj": moref, <path>: value} dict of the properties that changed, None when unset.
+    Raises vmodl.query.InvalidCollectorVersion when version is no longer known to the collector.
+    """
+    options = vmodl.query.PropertyCollector.WaitOptions(
+        maxWaitSeconds=max_wait_seconds, maxObjectUpdates=batch_size
+    )
+    changes = []
+    while True:
+        update_set = collector.WaitForUpdatesEx(version, options)
+        if update_set is None:
+            break
+        version = update_set.version
+        for filter_update in update_set.filterSet or []:
+            for update in filter_update.objectSet or []:
+                props = {"obj": update.obj}
+                for change in update.changeSet or []:
+                    props[change.name] = None if change.op in REMOVED_OPS else change.val
+                changes.append((update.kind, props))
+        if not update_set.truncated:
+            break
+    debug(f"Collected {len(changes)} object updates, now at version {version}")
+    return changes, version
@@ -0,0 +1,63 @@
+""" Direct HTTP access to the files of a datastore, through vCenter's /folder URLs """
+import re
+from urllib.parse import quote, urlencode
+
+from pyVmomi import vim
+
+
+DATASTORE_PATH_RE = re.compile(r"^\[(?P<datastore>[^\]]+)\]\s*(?P<path>.*)$")
+
+
+class DatastorePathError(Exception):
+    """ A disk backing file is not a "[datastore] path" that can be fetched over HTTP """
+
+
+def parse_datastore_path(datastore_path):
+    """ Return the (datastore name, file path) of a "[datastore] dir/file.vmdk" path """
+    match = DATASTORE_PATH_RE.match(datastore_path or "")
+    if match is None or not match.group("path"):
+        raise DatastorePathError(f"Unsupported datastore path: {datastore_path}")
+    return match.group("datastore"), match.group("path")
+
+
+def get_flat_path(vmdk_path):
+    """Return the path of the flat extent holding the data of a descriptor VMDK
+
+    "dir/disk.vmdk" keeps its data in "dir/disk-flat.vmdk" on VMFS and NFS datastores. vSAN and
+    vVol datastores have no flat extent file.
+    """
+    if not vmdk_path.endswith(".vmdk"):
+        raise DatastorePathError(f"Not a VMDK: {vmdk_path}")
+    return f"{vmdk_path[:-len('.vmdk')]}-flat.vmdk"
+
+
+def get_datacenter(obj):
+    """ Return the Datacenter a managed object (such as a VM) belongs to """
+    parent = obj.parent
+    while parent is not None and not isinstance(parent, vim.Datacenter):
+        parent = parent.parent
+    if parent is None:
+        raise DatastorePathError(f"{obj} is not in a datacenter")
+    return parent
+
+
+def get_datastore_url(ip_addr, datacenter_name, datastore_path):
+    """ Return the HTTPS URL of a "[datastore] path" file, see the vSphere datastore HTTP API """
+    datastore, path = parse_datastore_path(datastore_path)
+    query = urlencode({"dcPath": datacenter_name, "dsName": datastore})
+    return f"https://{ip_addr}/folder/{quote(path)}?{query}"
+
+
+def get_disk_url(ip_addr, datacenter_name, disk):
+    """Return the URL of the flat extent of a VirtualDisk, which serves byte ranges of the disk
+
+    Raises DatastorePathError for the delta disk of a snapshotted VM: its data is spread over the
+    delta files of the snapshot chain, none of them is a flat extent of the whole disk.
+    """
+    if getattr(disk.backing, "parent", None) is not None:
+        raise DatastorePathError(
+            f"{disk.backing.fileName} is a snapshot delta disk, reading disks from their "
+            "datastore needs a VM without snapshots"
+        )
+    datastore, path = parse_datastore_path(disk.backing.fileName)
+    return get_datastore_url(ip_addr, datacenter_name, f"[{datastore}] {get_flat_path(path)}")
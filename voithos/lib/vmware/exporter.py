@@ -1,24 +1,35 @@
 """ Handle exporting a VMWare VM """
 import os
-import requests
 import signal
 import sys
-from datetime import datetime
-from time import sleep, time
+from time import time
 from threading import Thread
-from pathlib import Path
 
-from hurry.filesize import size
 from pyVmomi import vim
 
-from voithos.lib.system import run
+from voithos.lib.util.manifest import IntegrityManifest
+from voithos.lib.util.vmdk import get_vmdk_info
+from voithos.lib.vmware.convert import DEFAULT_WORKERS as DEFAULT_CONVERT_WORKERS
+from voithos.lib.vmware.convert import StreamConverter
+from voithos.lib.vmware.datastore import get_datacenter, get_disk_url
+from voithos.lib.vmware.lease import KEEPALIVE_INTERVAL, NfcLeaseManager
+from voithos.lib.vmware.progress import DEFAULT_INTERVAL as DEFAULT_PROGRESS_INTERVAL
+from voithos.lib.vmware.progress import (
+    DEFAULT_STALL_SECONDS,
+    ProgressMonitor,
+    get_progress_writers,
+)
+from voithos.lib.vmware.transfer import (
+    BufferPool,
+    DiskDownload,
+    DiskDownloadFailed,
+    get_session,
+    get_session_cookies,
+)
 
-
-SLEEP_INTERVAL = 30  # seconds
-
-
-class VMWareExportLeaseNotReady(Exception):
-    """ After waiting some time, the NFC export lease did not become ready """
+# nfc: the disks are exported as streamOptimized VMDKs through an NFC lease
+# datastore: the flat extents of the disks are read from their datastores as raw data
+EXPORT_BACKENDS = ["nfc", "datastore"]
 
 
 class VMWareOnlineVMCantMigrate(Exception):
@@ -28,8 +39,15 @@ class VMWareOnlineVMCantMigrate(Exception):
 class VMWareExporter:
     """ Object used to wrangle VMWare exports """
 
-    def __init__(self, vmware_mgr, vm, base_dir=None, interval=15):
-        """ Construct the exporter around a VM """
+    def __init__(self, vmware_mgr, vm, base_dir=None, interval=15, backend="nfc"):
+        """Construct the exporter around a VM
+
+        backend: "nfc" exports the VM through an NFC lease, "datastore" downloads the flat extent
+            files of its disks straight from the datastore, which needs no lease but only works on
+            VMFS and NFS datastores
+        """
+        if backend not in EXPORT_BACKENDS:
+            raise ValueError(f"Unsupported export backend: {backend}")
         if vm.runtime.powerState != vim.VirtualMachine.PowerState.poweredOff:
             raise VMWareOnlineVMCantMigrate("ERROR: The VM is on. It must be offline")
         # progress tracking data
@@ -40,10 +58,13 @@ class VMWareExporter:
         self.transfered_bytes = 0
         # Download data
         self.vm = vm
-        self.lease = None
-        self.load_export_lease()
-        self.base_dir = base_dir if base_dir is not None else os.getcwd()
         self.vmware_mgr = vmware_mgr
+        self.backend = backend
+        self.lease_manager = None
+        if backend == "nfc":
+            self.lease_manager = NfcLeaseManager(vmware_mgr.conn, vm, vmware_mgr.ip_addr)
+            self.load_export_lease()
+        self.base_dir = base_dir if base_dir is not None else os.getcwd()
         self.chunk_size = 1024 * 1024 * 20  # 20 MB
         self.percent_transfered = 0
 
@@ -67,6 +88,11 @@ class VMWareExporter:
             size += dev.capacityInBytes
         return size
 
+    @property
+    def lease(self):
+        """ Return the current export NFC lease, it changes when a lost lease is re-acquired """
+        return self.lease_manager.lease if self.lease_manager is not None else None
+
     @property
     def lease_disks(self):
         """Return the disks presented by the export NFC lease
@@ -74,178 +100,259 @@ class VMWareExporter:
         Only count devices that can be downloaded (dev.targetId)
         and are not ISO files (dev.disk)
         """
-        return [dev for dev in self.lease.info.deviceUrl if dev.targetId and dev.disk]
+        return self.lease_manager.disks if self.lease_manager is not None else []
+
+    def get_disk_sources(self):
+        """Return a (file name, URL, refresh_url callback) tuple for each disk to download
+
+        The NFC backend names the files after the lease's targetId. The datastore backend names
+        them disk-<key>.raw after the device key, flat extents of different datastores often
+        share a file name. Their URLs don't expire so they have no refresh_url. Raises
+        DatastorePathError when a disk has no flat extent, for instance if the VM has snapshots.
+        """
+        if self.backend == "nfc":
+            urls = self.lease_manager.urls
+            refresh_url = self.lease_manager.refresh_url
+            return [(dev.targetId, urls[dev.targetId], refresh_url) for dev in self.lease_disks]
+        datacenter_name = get_datacenter(self.vm).name
+        sources = []
+        for disk in self.disks:
+            url = get_disk_url(self.vmware_mgr.ip_addr, datacenter_name, disk)
+            sources.append((f"disk-{disk.key}.raw", url, None))
+        return sources
 
     @property
     def cookies(self):
         """ Return cookies to initiate the HTTP-based VMDK transfer request """
-        stub = self.vmware_mgr.conn._stub.cookie
-        stub_list = stub.split(";")
-        vmware_soap_session = stub_list[0].split("=")[1]
-        path = stub_list[1].lstrip()
-        return {"vmware_soap_session": f"{vmware_soap_session}; ${path}"}
+        return get_session_cookies(self.vmware_mgr.conn)
 
     def load_export_lease(self):
-        """ Get an NFC lease (export the vm), wait until its ready to use before returning it """
-        self.lease = self.vm.ExportVm()
-        # Wait for the NFC lease to be ready
-        max_retries = 60
-        for attempt in range(1, (max_retries + 1)):
-            if self.lease.state == vim.HttpNfcLease.State.ready:
-                return
-            sleep(1)
-        raise VMWareExportLeaseNotReady(
-            f"ERROR - NFC lease state {self.lease.state} after {max_retries} retries"
-        )
+        """ Get an NFC lease (export the vm), wait until its ready to use before returning """
+        self.lease_manager.acquire()
 
-    def download(self):
-        """ Initiate the download process """
+    def download(
+        self,
+        segments=1,
+        disk_segments=None,
+        resume=True,
+        convert_to=None,
+        convert_workers=DEFAULT_CONVERT_WORKERS,
+        sparse=True,
+        progress_format="text",
+        progress_output="-",
+        progress_interval=DEFAULT_PROGRESS_INTERVAL,
+        stall_seconds=DEFAULT_STALL_SECONDS,
+        manifest=True,
+        progress_label=None,
+    ):
+        """Initiate the download process
+
+        segments: number of concurrent byte ranges per disk, when the server supports Range
+        disk_segments: optional dict of {file name: segments} overriding segments per disk, the
+            file names are the targetIds of the NFC backend or disk-<key>.raw
+        resume: continue from the checkpoint manifests left by an earlier interrupted download
+        convert_to: "raw" or "qcow2" to decode the streamOptimized VMDKs into images of that
+            format as they download, instead of saving the VMDKs. NFC backend only, the flat
+            extents of the datastore backend are raw images already
+        convert_workers: size of the decompression pool of each converted disk
+        sparse: skip writing all-zero blocks, leaving holes in the output files
+        progress_format: "text" prints every interval seconds, "json" emits JSON lines events
+        progress_output: "-" for stdout, a file path, "tcp://host:port" or "unix:///path"
+        progress_interval: seconds between progress samples, may be below 1
+        stall_seconds: report a disk as stalled after this many seconds without new bytes
+        manifest: hash the VMDKs as they download and save a <file>.manifest.json next to each
+        progress_label: prefix of the text progress lines, to tell concurrent exports apart
+        """
+        if convert_to is not None and self.backend != "nfc":
+            raise ValueError("Only the streamOptimized VMDKs of the NFC backend can be converted")
         downloads = []
-        # Start a thread running WGET for each vmdk in parralel
-        gb_total = bytes_to_gb(self.size_in_bytes)
-        print(f"Download {gb_total} GB:")
-        for dev in self.lease_disks:
-            # Collect the download paths and filenames
-            url = dev.url.replace("*/", f"{self.vmware_mgr.ip_addr}/")
-            file_path = os.path.join(self.base_dir, dev.targetId)
-            print(f"  {file_path} <-- {url}")
-            thread = Thread(target=download_thread, kwargs={"url": url, "file_path": file_path})
-            thread.start()
-            downloads.append(
-                {
-                    "url": url,
-                    "file_path": file_path,
-                    "thread": thread,
-                    "last_size": 0,
-                    "size": 0,
-                    "finished_size_thick": 0,
-                    "finished_size_thin": 0,
-                    "finshed_speed": 0,
-                    "done": False,
-                }
-            )
-        sleep(2)  # Give wget a second to get going
-        print(f"  Starting download ... Progress updates every {SLEEP_INTERVAL} seconds")
-        # Every x seconds, check the file sizes and provide a status update. Also update NFC lease
-        num_downloading_files = len(downloads)
-        elapsed_seconds = 0
-        while num_downloading_files >= 1:
-            # Count the alive threads, when the count is 0 this is the last iteration
-            num_downloading_files = len([dld for dld in downloads if dld["thread"].is_alive()])
-            if num_downloading_files == 0:
-                break  # no need to wait 30 seconds at the end
-            # wait 30 seconds (or whatever SLEEP_INTERVAL is) per check
-            print("")
-            sleep(SLEEP_INTERVAL)
-            elapsed_seconds += SLEEP_INTERVAL
-            print(f"Downloading files: {num_downloading_files}/{len(downloads)} remaining")
-            downloaded_bytes_thick = 0  # re-calc'd each 30 seconds
-            downloaded_bytes_thin = 0
-            for download in downloads:
-                if download["done"]:
-                    # This VMDK download's download completion tasks have been done
-                    # use its "thick size" instead
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    print_download_progress(download, download["finished_size_thick"])
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    continue
-                if not download["thread"].is_alive():
-                    # This download just finished, find its "finished size" and mark it done
-                    download["done"] = True
-                    download["finished_size_thick"] = get_vmdk_thick_size(download["file_path"])
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    download["finished_size_thin"] = Path(download["file_path"]).stat().st_size
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    download["finished_speed"] = round(
-                        downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2
+        # Open the progress output first, a bad socket address should fail before any download
+        writers = get_progress_writers(
+            progress_format,
+            progress_output,
+            print_interval=self.interval_seconds,
+            label=progress_label,
+        )
+        monitor = None
+        released = False
+        try:
+            sources = self.get_disk_sources()
+            disk_segments = disk_segments if disk_segments is not None else {}
+            seg_counts = [disk_segments.get(name, segments) for name, _, _ in sources]
+            if convert_to is not None:
+                # The grain stream has to be decoded in order, from a single connection
+                print(
+                    f"Converting to {convert_to} while downloading - segments and resume disabled"
+                )
+                seg_counts = [1 for _ in sources]
+            session = get_session(cookies=self.cookies, pool_size=sum(seg_counts))
+            buffer_pool = BufferPool(sum(seg_counts), self.chunk_size)
+            # Start a thread streaming each vmdk in parralel
+            gb_total = bytes_to_gb(self.size_in_bytes)
+            print(f"Download {gb_total} GB:")
+            for (name, url, refresh_url), seg_count in zip(sources, seg_counts):
+                # Collect the download paths and filenames
+                file_path = os.path.join(self.base_dir, name)
+                sink = None
+                if convert_to is not None:
+                    file_path = f"{os.path.splitext(file_path)[0]}.{convert_to}"
+                    sink = StreamConverter(
+                        convert_to, file_path, workers=convert_workers, sparse=sparse
                     )
-                    print_download_progress(download, download["finished_size_thick"])
-                    continue
-                # {download} is still downloading, find its current progress by checking file size
-                file_size = Path(download["file_path"]).stat().st_size  # (thin size)
-                downloaded_bytes_thick += file_size  # We don't know the real thick size yet
-                downloaded_bytes_thin += file_size
-                download["last_size"] = download["size"]
-                download["size"] = file_size
-                print_download_progress(download, file_size)  # use thin size for progress now
-            self.percent_transfered = int(downloaded_bytes_thick / self.size_in_bytes * 100)
-            self.lease.HttpNfcLeaseProgress(self.percent_transfered)
-            gb_down_thick = bytes_to_gb(downloaded_bytes_thick)
-            print(
-                f"\- Total Downloaded: \t{gb_down_thick} GB / {gb_total} GB - {self.percent_transfered}%"
+                print(f"  {file_path} <-- {url}")
+                # Converted images are written out of order, only the VMDK files get a manifest
+                disk_manifest = IntegrityManifest(file_path) if manifest and sink is None else None
+                transfer = DiskDownload(
+                    session,
+                    url,
+                    file_path,
+                    buffer_pool,
+                    segments=seg_count,
+                    resume=resume,
+                    sink=sink,
+                    sparse=sparse,
+                    manifest=disk_manifest,
+                    refresh_url=refresh_url,
+                )
+                thread = Thread(target=transfer.run)
+                thread.start()
+                downloads.append(
+                    {
+                        "url": url,
+                        "file_path": file_path,
+                        "thread": thread,
+                        "transfer": transfer,
+                        "raw": self.backend == "datastore",
+                        "finished_size_thick": 0,
+                        "finished_size_thin": 0,
+                        "finished_speed": 0,
+                        "done": False,
+                    }
+                )
+            if progress_format == "json":
+                print(f"  Starting download ... Progress events every {progress_interval} seconds")
+            elif self.interval_seconds:
+                every = self.interval_seconds
+                print(f"  Starting download ... Progress updates every {every} seconds")
+            else:
+                print("  Starting download ... Progress updates disabled")
+            if self.lease_manager is not None:
+                self.lease_manager.start()
+            monitor = ProgressMonitor(
+                [(dld["file_path"], dld["transfer"]) for dld in downloads],
+                self.size_in_bytes,
+                writers,
+                interval=progress_interval,
+                stall_seconds=stall_seconds,
+                on_sample=self._update_lease_progress if self.lease_manager is not None else None,
             )
-            thick_avg_speed_mbs = round(downloaded_bytes_thick / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thick): \t{thick_avg_speed_mbs} MB/s")
-            thin_avg_speed_mbs = round(downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thin): \t{thin_avg_speed_mbs} MB/s")
-        print("Finished download, closing NFC lease")
-        self.lease.HttpNfcLeaseProgress(100)
-        self.lease.HttpNfcLeaseComplete()
+            monitor.start()
+            for download in downloads:
+                download["thread"].join()
+                self._finish_download(download)
+            monitor.stop()
+            failed = [dld for dld in downloads if dld["transfer"].error is not None]
+            if failed and self.lease_manager is not None:
+                print("Download failed, aborting NFC lease")
+                self.lease_manager.abort()
+                released = True
+            if failed:
+                errors = "; ".join(str(dld["transfer"].error) for dld in failed)
+                raise DiskDownloadFailed(f"ERROR - {len(failed)} disk(s) failed: {errors}")
+            for download in downloads:
+                print_download_summary(download)
+            if self.lease_manager is None:
+                print("Finished download")
+                return
+            print("Finished download, closing NFC lease")
+            self.lease_manager.complete()
+            released = True
+        finally:
+            if not released and self.lease_manager is not None:
+                # The download failed before its end, release the lease rather than let it time
+                # out, which also ends the transfers of the downloads already started
+                self.lease_manager.abort()
+            for download in downloads:
+                download["thread"].join()
+            if monitor is not None:
+                monitor.stop()  # Closes the writers
+            else:
+                # Writers may hold a socket or a file, close them even if the download failed early
+                for writer in writers:
+                    writer.close()
+
+    def _update_lease_progress(self, total):
+        """ Progress callback: report the percent done at the next NFC lease renewal """
+        # 100% is only reported once the lease is completed
+        self.percent_transfered = min(total["percent"] or 0, 99)
+        self.lease_manager.set_progress(self.percent_transfered)
+
+    @staticmethod
+    def _finish_download(download):
+        """ A download thread just finished, find its "finished size" and mark it done """
+        transfer = download["transfer"]
+        download["done"] = True
+        download["finished_size_thin"] = transfer.bytes_allocated
+        if transfer.error is None and transfer.sink is not None:
+            download["finished_size_thick"] = transfer.sink.capacity_bytes
+        elif transfer.error is None and download["raw"]:
+            # A flat extent is the disk's raw data, its thick size is its length
+            download["finished_size_thick"] = os.path.getsize(download["file_path"])
+        elif transfer.error is None:
+            download["finished_size_thick"] = get_vmdk_thick_size(download["file_path"])
+        else:
+            download["finished_size_thick"] = transfer.bytes_written
+        elapsed = transfer.elapsed_seconds or 1
+        new_bytes = transfer.bytes_written - transfer.resumed_bytes
+        download["finished_speed"] = round(new_bytes / 1024 / 1024 / elapsed, 2)
 
     def hold_nfc_lease(self):
         """ Open and hold an NFC lease until ctrl-c is passed """
+        if self.lease_manager is None:
+            raise ValueError("Only the NFC backend holds a lease")
         print("Opening and holding NFC lease - Ctrl+C to close lease")
         gb_total = bytes_to_gb(self.size_in_bytes)
         print(f"Size: {gb_total} GB")
 
         def signal_handler(sig, frame):
             print("You pressed Ctrl+C - Closing NFC lease...")
-            self.lease.HttpNfcLeaseProgress(100)
-            self.lease.HttpNfcLeaseComplete()
+            self.lease_manager.complete()
             print("Gracefully closed NFC lease")
             sys.exit(0)
 
         signal.signal(signal.SIGINT, signal_handler)
         for dev in self.lease_disks:
             # Collect the download paths and filenames
-            url = dev.url.replace("*/", f"{self.vmware_mgr.ip_addr}/")
+            url = self.lease_manager.urls[dev.targetId]
             file_path = os.path.join(self.base_dir, dev.targetId)
             print(f"  {file_path} <-- {url}")
-        while True:
-            sleep(30)
-            self.percent_transfered = 50
-            self.lease.HttpNfcLeaseProgress(self.percent_transfered)
-            now = str(datetime.fromtimestamp((time())))
-            print(f"{now} - Renewed NFC lease")
-
-
-def print_download_progress(download, progress):
-    """ Print the progress of a download """
-    # last interval speed
-    # total speed
-    # path
-    if download["done"]:
-        done = "(DONE)"
-        speed = f"\t[AVG SPEED: {download['finished_speed']} MB/s]"
-    else:
-        done = ""
-        diff = download["size"] - download["last_size"]
-        current_speed = round(diff / 1024 / 1024 / SLEEP_INTERVAL, 2)
-        speed = f"\t[CUR SPEED: {current_speed} MB/s]"
-    size_gb = bytes_to_gb(progress)
-    print(f"  {download['file_path']} - {size_gb} GB {speed} {done}")
-
-
-def download_thread(url, file_path):
-    """ Start a thread to download the file """
-    run(f"wget --quiet --no-check-certificate {url} -O {file_path}")
+        self.percent_transfered = 50
+        self.lease_manager.set_progress(self.percent_transfered)
+        print(f"Renewing the NFC lease every {KEEPALIVE_INTERVAL} seconds")
+        self.lease_manager.start()
+        # Only returns if the lease was lost for good. A re-acquired lease has new URLs.
+        self.lease_manager.join()
+
+
+def print_download_summary(download):
+    """ Print the exact thick (virtual), received and allocated (thin) bytes of a finished disk """
+    transfer = download["transfer"]
+    thick = download["finished_size_thick"]
+    skipped = max(transfer.bytes_written - transfer.bytes_allocated, 0)
+    if transfer.sink is not None:
+        skipped = max(thick - transfer.bytes_allocated, 0)
+    print(
+        f"  {download['file_path']} - thick: {thick} bytes, "
+        f"received: {transfer.bytes_written} bytes, allocated (thin): {transfer.bytes_allocated} "
+        f"bytes, zeros skipped: {skipped} bytes"
+    )
+    if transfer.manifest is not None:
+        print(f"    sha256 hash tree root: {transfer.manifest.root}")
 
 
 def get_vmdk_thick_size(file_path):
-    """ Execute qemu-img show inside a container, direct mapping the volume """
-    name = "qemu-img-info"
-    image = "breqwatr/qemu-img:latest"
-    path = Path(file_path)
-    file_abspath = path.absolute().__str__()
-    run_cmd = f"qemu-img info {file_abspath}"
-    mount = f"-v {file_abspath}:{file_abspath}"
-    cmd = f"docker run --rm -it --name {name} {mount} {image} {run_cmd}"
-
-    # Return the 'thick' size of a VMDK file in bytes as an integer
-    qemu_img_lines = run(cmd)
-    vsize_line = next(line for line in qemu_img_lines if "virtual size" in line)
-    size_bytes = int(vsize_line.split(" ")[-2].replace("(", ""))
-    return size_bytes
+    """ Return the 'thick' (virtual) size of a VMDK file in bytes, read from its header """
+    return get_vmdk_info(file_path)["capacity_bytes"]
 
 
 def bytes_to_gb(qty_bytes):
@@ -0,0 +1,81 @@
+""" One VM inventory over several vCenters, connected and loaded in parallel """
+from concurrent.futures import ThreadPoolExecutor
+
+from voithos.lib.vmware.cache import DEFAULT_TTL, InventoryCache
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.index import InventoryIndex
+from voithos.lib.vmware.mgr import VMWareMgr, _environ
+
+
+def get_ip_addrs(values=None):
+    """Return the vCenter addresses in values, each of which may be a comma separated list
+
+    Defaults to the VMWARE_IP_ADDR environment variable, also comma separated. Duplicates are
+    dropped, the order is kept.
+    """
+    if not values:
+        values = [_environ("VMWARE_IP_ADDR")]
+    ip_addrs = []
+    for value in values:
+        for ip_addr in value.split(","):
+            ip_addr = ip_addr.strip()
+            if ip_addr and ip_addr not in ip_addrs:
+                ip_addrs.append(ip_addr)
+    return ip_addrs
+
+
+class FederatedInventory:
+    """The VMs of several vCenters, searched as one inventory
+
+    Each vCenter is connected and its inventory loaded on its own thread, so loading takes as
+    long as the slowest vCenter rather than the sum of all. The records are those of each
+    VMWareMgr, whose "vcenter" key is the address they were loaded from.
+    """
+
+    def __init__(
+        self, ip_addrs, username=None, password=None, cache=True, refresh=False, ttl=DEFAULT_TTL
+    ):
+        """Connect to every vCenter in ip_addrs, through the inventory cache unless cache=False
+
+        The same credentials are used for every vCenter
+        """
+        self.ip_addrs = list(ip_addrs)
+
+        def load(ip_addr):
+            """ Thread target: return the VMWareMgr of a vCenter """
+            # SQLite connections belong to the thread that opened them
+            inventory_cache = InventoryCache() if cache else None
+            mgr = VMWareMgr(
+                username=username,
+                password=password,
+                ip_addr=ip_addr,
+                cache=inventory_cache,
+                refresh=refresh,
+                ttl=ttl,
+            )
+            if inventory_cache is not None:
+                inventory_cache.close()
+            return mgr
+
+        with ThreadPoolExecutor(max_workers=len(self.ip_addrs)) as pool:
+            self.mgrs = dict(zip(self.ip_addrs, pool.map(load, self.ip_addrs)))
+        self.records = [record for mgr in self.mgrs.values() for record in mgr.vm_records.values()]
+        self.index = InventoryIndex(self.records)
+        debug(f"Loaded {len(self.records)} VMs from {len(self.mgrs)} vCenter(s)")
+
+    def get_mgr(self, record):
+        """ Return the VMWareMgr of the vCenter a record was loaded from """
+        return self.mgrs[record["vcenter"]]
+
+    def find_records_by_name(self, names):
+        """Return the records of the VMs whose names contain any element found in names
+
+        Return every record if "*" is an element in names
+        """
+        if "*" in names:
+            return list(self.records)
+        return self.index.search(names)
+
+    def find_record_by_uuid(self, uuid):
+        """ Return the record of the VM with a given UUID in any vCenter, or None """
+        return self.index.get_by_uuid(uuid)
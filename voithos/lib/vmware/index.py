@@ -0,0 +1,63 @@
+""" In-memory indexes over the VM inventory records for fast lookups """
+from collections import defaultdict
+
+
+NGRAM = 3
+
+
+def get_ngrams(text):
+    """ Return the set of NGRAM character substrings of text """
+    return {text[slice(num, num + NGRAM)] for num in range(len(text) - NGRAM + 1)}
+
+
+class InventoryIndex:
+    """Look up VM inventory records by UUID, exact name or name substring
+
+    Records are dicts with at least "name" and "uuid" keys, as built by VMWareMgr.load_vms.
+    Substrings of NGRAM or more characters are answered from a trigram index: the candidates
+    are the names holding every trigram of the pattern, which are then checked with "in".
+    Results keep the order of the records.
+    """
+
+    def __init__(self, records):
+        """ Build the indexes over records """
+        self.records = list(records)
+        self.by_uuid = {}
+        self.by_name = defaultdict(list)  # name: record positions
+        self.ngrams = defaultdict(set)  # trigram: record positions
+        for position, record in enumerate(self.records):
+            if record["uuid"] is not None:
+                self.by_uuid[record["uuid"]] = record
+            name = record["name"]
+            if name is None:
+                continue
+            self.by_name[name].append(position)
+            for ngram in get_ngrams(name):
+                self.ngrams[ngram].add(position)
+
+    def get_by_uuid(self, uuid):
+        """ Return the record with a given UUID, or None """
+        return self.by_uuid.get(uuid)
+
+    def get_by_name(self, name):
+        """ Return the records named exactly name """
+        return [self.records[position] for position in self.by_name.get(name, [])]
+
+    def _substring_positions(self, pattern):
+        """ Return the positions of the records whose name contains pattern """
+        if len(pattern) < NGRAM:
+            candidates = (pos for positions in self.by_name.values() for pos in positions)
+        else:
+            # Start from the rarest trigram so the intersections stay small
+            postings = sorted(
+                (self.ngrams.get(ngram, set()) for ngram in get_ngrams(pattern)), key=len
+            )
+            candidates = set.intersection(*postings)
+        return {pos for pos in candidates if pattern in self.records[pos]["name"]}
+
+    def search(self, patterns):
+        """ Return the records whose name contains any of patterns """
+        positions = set()
+        for pattern in set(patterns):
+            positions |= self._substring_positions(pattern)
+        return [self.records[position] for position in sorted(positions)]
@@ -0,0 +1,211 @@
+""" NFC export leases: wait until ready, keep alive in the background, re-acquire when lost """
+from threading import Event, RLock, Thread
+from time import time
+
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.collector import create_object_collector, wait_for_updates
+from voithos.lib.vmware.common import debug
+
+
+DEFAULT_READY_TIMEOUT = 300  # seconds for vCenter to prepare an export
+KEEPALIVE_INTERVAL = 30  # seconds between lease renewals, idle leases time out after 5 minutes
+DEFAULT_MAX_REACQUIRE = 3  # new leases taken after the first one is lost
+
+
+class VMWareExportLeaseNotReady(Exception):
+    """ After waiting some time, the NFC export lease did not become ready """
+
+
+class NfcLeaseError(Exception):
+    """ The NFC export lease was lost and could not be re-acquired """
+
+
+class NfcLeaseManager:
+    """The NFC export lease of a VM, kept alive for as long as its disks download
+
+    Readiness is awaited with PropertyCollector updates on the lease state rather than polled.
+    Once started, a keepalive thread renews the lease every keepalive_interval seconds with the
+    last progress given to set_progress, independently of the downloads. When a renewal fails
+    or the lease is in error, the lease is aborted and the VM exported again. The new lease has
+    new disk URLs: downloads whose requests fail call refresh_url to resume from them.
+    """
+
+    def __init__(
+        self,
+        conn,
+        vm,
+        ip_addr,
+        ready_timeout=DEFAULT_READY_TIMEOUT,
+        keepalive_interval=KEEPALIVE_INTERVAL,
+        max_reacquire=DEFAULT_MAX_REACQUIRE,
+    ):
+        """ Nothing is exported until acquire() """
+        self.conn = conn
+        self.vm = vm
+        self.ip_addr = ip_addr
+        self.ready_timeout = ready_timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_reacquire = max_reacquire
+        self.lease = None
+        self.disks = []  # deviceUrl entries of the current lease that can be downloaded
+        self.urls = {}  # targetId: URL of the current lease
+        self.percent = 0
+        self.reacquired = 0
+        self.last_renewed = None
+        self.error = None  # set when the keepalive thread stopped on a lost lease
+        self._url_targets = {}  # targetId of every URL of every lease
+        self._lock = RLock()
+        self._stop = Event()
+        self._thread = None
+
+    def acquire(self):
+        """ Export the VM, wait until the lease is ready and load its disk URLs """
+        lease = self.vm.ExportVm()
+        self._wait_ready(lease)
+        with self._lock:
+            self.lease = lease
+            # Only count devices that can be downloaded (targetId) and are not ISO files (disk)
+            self.disks = [dev for dev in lease.info.deviceUrl if dev.targetId and dev.disk]
+            self.urls = {
+                dev.targetId: dev.url.replace("*/", f"{self.ip_addr}/") for dev in self.disks
+            }
+            for target_id, url in self.urls.items():
+                self._url_targets[url] = target_id
+            self.last_renewed = time()
+
+    def _wait_ready(self, lease):
+        """ Block until the lease state is ready, raise if it fails or takes too long """
+        collector = create_object_collector(self.conn, lease, ["state", "error"])
+        try:
+            deadline = time() + self.ready_timeout
+            version = ""
+            state = None
+            while True:
+                changes, version = wait_for_updates(
+                    collector, version, max_wait_seconds=max(int(deadline - time()), 1)
+                )
+                for _, props in changes:
+                    state = props.get("state", state)
+                    if state == vim.HttpNfcLease.State.ready:
+                        return
+                    if state == vim.HttpNfcLease.State.error:
+                        fault = props.get("error")
+                        reason = fault.msg if fault is not None else "unknown error"
+                        raise VMWareExportLeaseNotReady(f"ERROR - NFC lease failed: {reason}")
+                if time() >= deadline:
+                    raise VMWareExportLeaseNotReady(
+                        f"ERROR - NFC lease state {state} after {self.ready_timeout} seconds"
+                    )
+        finally:
+            collector.DestroyPropertyCollector()
+
+    def set_progress(self, percent):
+        """ Set the percent done reported at the next renewal, 100% is only sent by complete() """
+        self.percent = min(int(percent or 0), 99)
+
+    def _is_alive(self):
+        """ Renew the lease, return False if it is lost or vCenter refused the renewal """
+        try:
+            self.lease.HttpNfcLeaseProgress(self.percent)
+            state = self.lease.state
+        except vmodl.MethodFault as exc:
+            reason = getattr(exc, "msg", exc)
+            debug(f"NFC lease of {self.vm} lost: {reason}")
+            return False
+        if state != vim.HttpNfcLease.State.ready:
+            debug(f"NFC lease of {self.vm} is {state}")
+            return False
+        self.last_renewed = time()
+        return True
+
+    def _reacquire(self):
+        """ Abort the lost lease and export the VM again, raise NfcLeaseError past max_reacquire """
+        if self.reacquired >= self.max_reacquire:
+            raise NfcLeaseError(f"ERROR - NFC lease lost {self.reacquired + 1} times, giving up")
+        try:
+            self.lease.HttpNfcLeaseAbort()
+        except vmodl.MethodFault:
+            pass  # Already expired or gone
+        self.reacquired += 1
+        print(f"  NFC lease lost, re-acquiring ({self.reacquired}/{self.max_reacquire})")
+        try:
+            self.acquire()
+        except VMWareExportLeaseNotReady as exc:
+            raise NfcLeaseError(f"ERROR - Failed to re-acquire the NFC lease: {exc}") from exc
+
+    def renew(self):
+        """ Renew the lease now, re-acquiring it if it was lost """
+        with self._lock:
+            if not self._is_alive():
+                self._reacquire()
+
+    def refresh_url(self, url):
+        """Return the URL to use instead of a URL whose download failed, None if it still applies
+
+        The lease is checked, and re-acquired if it was lost, unless another download already
+        did it. Raises NfcLeaseError if the lease can't be re-acquired.
+        """
+        with self._lock:
+            target_id = self._url_targets.get(url)
+            if target_id is None:
+                return None
+            if self.urls.get(target_id) == url:
+                if self._is_alive():
+                    return None  # The failure was not the lease's
+                self._reacquire()
+            return self.urls.get(target_id)
+
+    def _keepalive(self):
+        """ Thread target: renew the lease every keepalive_interval until stopped or lost """
+        while not self._stop.wait(self.keepalive_interval):
+            try:
+                self.renew()
+            except NfcLeaseError as exc:
+                debug(str(exc))
+                self.error = exc
+                return
+            except (vmodl.MethodFault, OSError) as exc:
+                # vCenter refused the new export, or could not be reached
+                reason = getattr(exc, "msg", exc)
+                debug(f"Failed to renew the NFC lease of {self.vm}: {reason}")
+                self.error = NfcLeaseError(f"ERROR - Failed to renew the NFC lease: {reason}")
+                self.error.__cause__ = exc
+                return
+
+    def start(self):
+        """ Start renewing the lease in the background """
+        self._stop.clear()
+        self._thread = Thread(target=self._keepalive, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the keepalive thread """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def join(self):
+        """ Wait for the keepalive thread, it only ends when stopped or when the lease is lost """
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def complete(self):
+        """ Stop the keepalive thread and release the lease as successful """
+        self.stop()
+        with self._lock:
+            self.lease.HttpNfcLeaseProgress(100)
+            self.lease.HttpNfcLeaseComplete()
+
+    def abort(self):
+        """ Stop the keepalive thread and release the lease as failed """
+        self.stop()
+        with self._lock:
+            try:
+                self.lease.HttpNfcLeaseAbort()
+            except vmodl.MethodFault as exc:
+                reason = getattr(exc, "msg", exc)
+                debug(f"Failed to abort the NFC lease of {self.vm}: {reason}")
@@ -2,12 +2,64 @@
 
 import os
 import ssl
+from time import time
 
 from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import SoapStubAdapter, vim, vmodl
 
 from voithos.lib.system import error
+from voithos.lib.vmware.cache import DEFAULT_TTL, SESSION_TTL
+from voithos.lib.vmware.collector import (
+    create_update_collector,
+    retrieve_properties,
+    wait_for_updates,
+)
 from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.index import InventoryIndex
+
+
+# VM properties loaded for the whole inventory, see VMWareMgr.load_vms
+VM_PROPERTIES = [
+    "name",
+    "config.uuid",
+    "runtime.powerState",
+    "runtime.host",
+    "config.hardware.device",
+]
+
+# Inventory cache column of each VM property
+VM_COLUMNS = {
+    "name": "name",
+    "config.uuid": "uuid",
+    "runtime.powerState": "power_state",
+    "runtime.host": "host",
+    "config.hardware.device": "disk_bytes",
+}
+
+
+def get_disk_bytes(devices):
+    """ Return the total capacity of the virtual disks among a VM's devices, its export size """
+    disks = [dev for dev in devices or [] if isinstance(dev, vim.vm.device.VirtualDisk)]
+    return sum(disk.capacityInBytes for disk in disks)
+
+
+def _get_cache_change(kind, props):
+    """ Convert a wait_for_updates change to an InventoryCache.update change """
+    obj = props["obj"]
+    if isinstance(obj, vim.HostSystem):
+        values = {"name": props["name"]} if "name" in props else {}
+        return "hosts", kind, obj._moId, values
+    values = {}
+    for path, column in VM_COLUMNS.items():
+        if path not in props:
+            continue
+        value = props[path]
+        if path == "runtime.host":
+            value = value._moId if value is not None else None
+        elif path == "config.hardware.device":
+            value = get_disk_bytes(value) if value is not None else None
+        values[column] = value
+    return "vms", kind, obj._moId, values
 
 
 def _environ(name, value=None):
@@ -24,6 +76,24 @@ def _environ(name, value=None):
     return os.environ[name]
 
 
+def _normalize_user(name):
+    """ Return a user name as lower case user@domain, vCenter reports DOMAIN\\user names """
+    name = name.lower()
+    if "\\" in name:
+        domain, user = name.split("\\", 1)
+        return f"{user}@{domain}"
+    return name
+
+
+def _is_same_user(session_user, username):
+    """ Return True when the userName of a vCenter session is the user who logged in as username """
+    session_user = _normalize_user(session_user)
+    username = _normalize_user(username)
+    if "@" not in username:
+        session_user = session_user.split("@", 1)[0]
+    return session_user == username
+
+
 def _get_ssl_error():
     """Different versions of Python (3.6 vs 3.8) throw different SSL exceptions"""
     if hasattr(ssl, "SSLCertVerificationError"):
@@ -32,24 +102,51 @@ def _get_ssl_error():
         return ssl.SSLError
 
 
+def _get_unverified_context():
+    """ Return an SSL context that does not verify the server certificate """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS)
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
 class VMWareMgr:
     """Object used to manage VMWare interactions"""
 
-    def __init__(self, username=None, password=None, ip_addr=None):
-        """Constructor the exporter, loading creds from env vars if needed"""
+    def __init__(
+        self, username=None, password=None, ip_addr=None, cache=None, refresh=False, ttl=DEFAULT_TTL
+    ):
+        """Constructor the exporter, loading creds from env vars if needed
+
+        With an InventoryCache as cache, the inventory is read from it, see load_cached_vms
+        """
         self.username = _environ("VMWARE_USERNAME", username)
         self.password = _environ("VMWARE_PASSWORD", password)
         self.ip_addr = _environ("VMWARE_IP_ADDR", ip_addr)
+        self.cache = cache
         self.conn = None
-        self.connect()
         self.vms = []
-        self.load_vms()
+        self.vm_records = {}
+        self.index = InventoryIndex([])
+        if cache is None:
+            self.connect()
+            self.load_vms()
+        else:
+            self.load_cached_vms(refresh=refresh, ttl=ttl)
 
     conn = None  # Required for __del__
+    cache = None
 
     def __del__(self):
         """Clean up the conenction when the object is GC'd"""
-        connect.Disconnect(self.conn)
+        # The session of a cached inventory stays open so the next command can resume it, it is
+        # logged out once older than SESSION_TTL, see resume_session
+        if self.cache is None:
+            connect.Disconnect(self.conn)
+
+    @property
+    def cache_key(self):
+        """ Key of the cached inventory and session of this user on this vCenter """
+        return f"{self.username}@{self.ip_addr}"
 
     def connect(self):
         """Connect to the configured VMWare service & set self.conn"""
@@ -62,8 +159,7 @@ class VMWareMgr:
                 )
             except SSLVerificationError:
                 try:
-                    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS)
-                    ctx.verify_mode = ssl.CERT_NONE
+                    ctx = _get_unverified_context()
                     debug("Connecting with SmartConnec - TLS and verify off")
                     self.conn = connect.SmartConnect(
                         host=self.ip_addr, user=self.username, pwd=self.password, sslContext=ctx
@@ -77,27 +173,160 @@ class VMWareMgr:
             error(f"ERROR: Invalid login for VMware server {self.ip_addr}", exit=True)
         debug("Connection successful")
 
-    def load_vms(self, entity=None):
-        """Return a list of each VM from all datacenters connected to self.conn
-        This function is recursive, since the VMs can be in a tree-like directory structure
+    def resume_session(self, cookie, api_version):
+        """Set self.conn to an existing session of the VMware service, by its cookie
+
+        Return False when the session has ended, belongs to another user than self.username or
+        was logged in more than SESSION_TTL seconds ago. Those last two are logged out, since
+        the cache forgets their cookie once a new session is saved.
         """
-        if entity is None:
-            debug("Starting recursive VM search")
-            self.load_vms(entity=self.conn.content.rootFolder)
-            return
-        if isinstance(entity, vim.VirtualMachine):
-            debug(f"VM:         {entity}  -  {entity.name}")
-            self.vms.append(entity)
-            return
-        if isinstance(entity, vim.Folder):
-            debug(f"FOLDER:     {entity}  -  {entity.name}")
-        if isinstance(entity, vim.Datacenter):
-            debug(f"DATACENTER: {entity}  -  {entity.name}")
-        if hasattr(entity, "vmFolder"):
-            self.load_vms(entity.vmFolder)
-        if hasattr(entity, "childEntity"):
-            for child in entity.childEntity:
-                self.load_vms(child)
+        SSLVerificationError = _get_ssl_error()
+        for ctx in (None, _get_unverified_context()):
+            stub = SoapStubAdapter(host=self.ip_addr, version=api_version, sslContext=ctx)
+            stub.cookie = cookie
+            conn = vim.ServiceInstance("ServiceInstance", stub)
+            try:
+                session_mgr = conn.RetrieveContent().sessionManager
+                session = session_mgr.currentSession
+                if session is None:
+                    return False
+                if not _is_same_user(session.userName, self.username):
+                    debug(f"The cached session is {session.userName}'s, logging it out")
+                    session_mgr.Logout()
+                    return False
+                age = (conn.CurrentTime() - session.loginTime).total_seconds()
+                if age > SESSION_TTL:
+                    debug(f"The cached session is {age:.0f} seconds old, logging it out")
+                    session_mgr.Logout()
+                    return False
+            except SSLVerificationError:
+                continue
+            except (vim.fault.NotAuthenticated, OSError) as exc:
+                debug(f"Could not resume the session: {exc}")
+                return False
+            debug("Resumed the cached session")
+            self.conn = conn
+            return True
+        return False
+
+    def load_vms(self):
+        """Load every VM from all datacenters connected to self.conn
+
+        The properties needed to find and export VMs are read for the whole inventory at once
+        through the PropertyCollector, see VM_PROPERTIES. Each VM gets a record in
+        self.vm_records, keyed by the VM's managed object id, and self.index is rebuilt.
+        """
+        debug("Loading the VM inventory with the PropertyCollector")
+        host_names = {
+            host["obj"]._moId: host.get("name")
+            for host in retrieve_properties(self.conn, vim.HostSystem, ["name"])
+        }
+        records = []
+        for props in retrieve_properties(self.conn, vim.VirtualMachine, VM_PROPERTIES):
+            host = props.get("runtime.host")
+            records.append(
+                {
+                    "vm": props["obj"],
+                    "name": props.get("name"),
+                    "uuid": props.get("config.uuid"),
+                    "power_state": props.get("runtime.powerState"),
+                    "host": host_names.get(host._moId) if host is not None else None,
+                    "disk_bytes": get_disk_bytes(props.get("config.hardware.device")),
+                    "vcenter": self.ip_addr,
+                }
+            )
+        self._set_records(records)
+
+    def load_cached_vms(self, refresh=False, ttl=DEFAULT_TTL):
+        """Load every VM from self.cache, bringing it up to date first when needed
+
+        The cached inventory is used as is when it was refreshed less than ttl seconds ago,
+        unless refresh is set. Otherwise only the changes since the last refresh are read with
+        WaitForUpdatesEx, from the PropertyCollector kept in the cached session. A full load is
+        only needed the first time, or once vCenter has ended that session.
+        """
+        state = self.cache.get_state(self.cache_key)
+        resumed = state is not None and self.resume_session(
+            state["session_cookie"], state["api_version"]
+        )
+        if not resumed:
+            self.connect()
+        if not refresh and self.cache.is_fresh(state, ttl):
+            debug("Using the cached VM inventory")
+            if not resumed:
+                # The cached collector ended with its session, the next refresh is a full load
+                state.update(self._get_cache_state(None, None), refreshed_at=state["refreshed_at"])
+                self.cache.update(self.cache_key, state)
+        else:
+            self.refresh_cache(state if resumed else None)
+        records = [
+            {
+                "vm": vim.VirtualMachine(row["mo_id"], self.conn._stub),
+                "name": row["name"],
+                "uuid": row["uuid"],
+                "power_state": row["power_state"],
+                "host": row["host"],
+                "disk_bytes": row["disk_bytes"] or 0,
+                "vcenter": self.ip_addr,
+            }
+            for row in self.cache.get_records(self.cache_key)
+        ]
+        self._set_records(records)
+
+    def _get_cache_state(self, collector, version):
+        """ Return the InventoryCache state of self.conn, collector and version """
+        return {
+            "refreshed_at": time(),
+            "session_cookie": self.conn._stub.cookie,
+            "api_version": self.conn._stub.version,
+            "collector": collector,
+            "version": version,
+        }
+
+    def refresh_cache(self, state=None):
+        """Update the cached inventory of self.cache_key through WaitForUpdatesEx
+
+        With the cached state of the current session, only the changes since its version are
+        read. Otherwise a new PropertyCollector is created and returns the whole inventory.
+        """
+        changes = None
+        if state is not None and state["collector"]:
+            collector = vmodl.query.PropertyCollector(state["collector"], self.conn._stub)
+            try:
+                changes, version = wait_for_updates(collector, state["version"])
+            except (vmodl.query.InvalidCollectorVersion, vmodl.fault.ManagedObjectNotFound):
+                debug("The cached PropertyCollector is gone, reloading the VM inventory")
+        reset = changes is None
+        if reset:
+            debug("Loading the VM inventory with a new PropertyCollector")
+            path_sets = {vim.VirtualMachine: VM_PROPERTIES, vim.HostSystem: ["name"]}
+            collector = create_update_collector(self.conn, path_sets)
+            changes, version = wait_for_updates(collector)
+        self.cache.update(
+            self.cache_key,
+            self._get_cache_state(collector._moId, version),
+            [_get_cache_change(kind, props) for kind, props in changes],
+            reset=reset,
+        )
+
+    def _set_records(self, records):
+        """ Set self.vms, self.vm_records and self.index from a list of VM records """
+        self.vms = []
+        self.vm_records = {}
+        for record in records:
+            debug(f"VM:         {record['vm']}  -  {record['name']}")
+            self.vms.append(record["vm"])
+            self.vm_records[record["vm"]._moId] = record
+        self.index = InventoryIndex(self.vm_records.values())
+        debug(f"Loaded {len(self.vms)} VMs")
+
+    def get_vm_record(self, vm):
+        """Return the inventory record of a VM: its name, uuid, power_state, host, disk_bytes and
+        the vcenter it was loaded from
+
+        Reading these from the record avoids a round trip to vCenter per attribute
+        """
+        return self.vm_records[vm._moId]
 
     def find_vms_by_name(self, names):
         """Return a list of VMs who's names contain any element found in names.
@@ -105,15 +334,13 @@ class VMWareMgr:
         """
         if "*" in names:
             return self.vms
-        return (vm for vm in self.vms if any(name in vm.name for name in names))
+        return [record["vm"] for record in self.index.search(names)]
+
+    def find_vms_by_exact_name(self, name):
+        """Return the list of VMs named exactly name"""
+        return [record["vm"] for record in self.index.get_by_name(name)]
 
     def find_vm_by_uuid(self, uuid):
         """Return a single VM with a given UUID, or None"""
-        return next(
-            (
-                vm
-                for vm in self.vms
-                if hasattr(vm, "config") and vm.config and vm.config.uuid == uuid
-            ),
-            None,
-        )
+        record = self.index.get_by_uuid(uuid)
+        return record["vm"] if record is not None else None
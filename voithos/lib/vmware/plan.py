@@ -0,0 +1,182 @@
+""" OpenStack capacity planning over a VM inventory, vectorized with NumPy """
+import json
+
+import numpy as np
+
+
+PERCENTILES = [50, 90, 95, 99]
+
+# Per-VM values of a capacity row, see get_capacity_row
+CAPACITY_FIELDS = ["num_cpu", "ram_mb", "disk_gb", "thin_disk_gb", "used_gb"]
+
+
+class PlanInputError(Exception):
+    """ An inventory or flavor file could not be read """
+
+
+def get_capacity_row(report):
+    """ Return the capacity row dict of a reports.get_vm_data dict """
+    disks = report["storage"]["disks"]
+    thin_disks = [disk for disk in disks if disk["thin_provisioned"] is True]
+    return {
+        "vcenter": report.get("vcenter"),
+        "uuid": report["uuid"],
+        "name": report["name"],
+        "num_cpu": report["num_cpu"] or 0,
+        "ram_mb": report["ram"]["total_mb"] or 0,
+        "disk_gb": sum(disk["capacity_gb"] for disk in disks),
+        "thin_disk_gb": sum(disk["capacity_gb"] for disk in thin_disks),
+        "used_gb": report["storage"]["partitions"]["total_used_gb"],
+    }
+
+
+def load_reports(path):
+    """Return the VM reports saved by show-vm in a json or jsonl file
+
+    Raises PlanInputError
+    """
+    try:
+        with open(path, encoding="utf-8") as report_file:
+            text = report_file.read()
+    except OSError as exc:
+        raise PlanInputError(f"Failed to read {path}: {exc}") from exc
+    try:
+        if text.lstrip().startswith("["):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError as exc:
+        raise PlanInputError(f"{path} is not show-vm json or jsonl output: {exc}") from exc
+
+
+def load_flavors(path):
+    """Return the flavors of a JSON list file as {"name", "vcpus", "ram_mb", "disk_gb"} dicts
+
+    Both this format and the output of `openstack flavor list -f json` (Name, VCPUs, RAM, Disk)
+    are accepted. Raises PlanInputError
+    """
+    try:
+        with open(path, encoding="utf-8") as flavor_file:
+            items = json.load(flavor_file)
+        if not isinstance(items, list):
+            raise TypeError("expected a list")
+        return [
+            {
+                "name": item.get("name", item.get("Name")),
+                "vcpus": int(item.get("vcpus", item.get("VCPUs"))),
+                "ram_mb": int(item.get("ram_mb", item.get("RAM"))),
+                "disk_gb": int(item.get("disk_gb", item.get("Disk"))),
+            }
+            for item in items
+        ]
+    except OSError as exc:
+        raise PlanInputError(f"Failed to read {path}: {exc}") from exc
+    except (ValueError, TypeError, AttributeError) as exc:
+        raise PlanInputError(f"{path} is not a JSON list of flavors: {exc}") from exc
+
+
+def _array(rows, field):
+    """ Return the values of a CAPACITY_FIELDS field of capacity rows as a float array """
+    return np.fromiter((row[field] or 0 for row in rows), float, count=len(rows))
+
+
+class CapacityPlan:
+    """The capacity rows of an inventory as NumPy arrays, and the summaries computed from them
+
+    Each CAPACITY_FIELDS field is an array attribute with one value per VM, so every summary is
+    computed in a few array operations whatever the size of the inventory.
+    """
+
+    def __init__(self, rows):
+        """ rows are capacity row dicts, see get_capacity_row """
+        rows = list(rows)
+        self.names = [row["name"] for row in rows]
+        self.uuids = [row["uuid"] for row in rows]
+        self.vcenters = [row.get("vcenter") for row in rows]
+        self.num_cpu = _array(rows, "num_cpu")
+        self.ram_mb = _array(rows, "ram_mb")
+        self.disk_gb = _array(rows, "disk_gb")
+        self.thin_disk_gb = _array(rows, "thin_disk_gb")
+        self.used_gb = _array(rows, "used_gb")
+
+    def get_storage(self):
+        """Return the storage needed in GB, thick and thin provisioned
+
+        Thick needs the capacity of every disk. Thin needs what the guests use, or the full
+        capacity of VMs that report no guest disk usage (no VMware tools or powered off).
+        """
+        reported = self.used_gb > 0
+        thin = np.where(reported, np.minimum(self.used_gb, self.disk_gb), self.disk_gb)
+        return {
+            "thick_gb": round(float(self.disk_gb.sum()), 2),
+            "thin_gb": round(float(thin.sum()), 2),
+            "thin_provisioned_disks_gb": round(float(self.thin_disk_gb.sum()), 2),
+            "vms_without_guest_usage": int((~reported).sum()),
+        }
+
+    def get_percentiles(self):
+        """ Return the PERCENTILES and max of the vCPUs, RAM and disk of a VM """
+        summary = {}
+        for field in ["num_cpu", "ram_mb", "disk_gb"]:
+            values = getattr(self, field)
+            if values.size == 0:
+                summary[field] = {}
+                continue
+            percentiles = np.percentile(values, PERCENTILES)
+            summary[field] = {
+                f"p{pct}": round(float(val), 2) for pct, val in zip(PERCENTILES, percentiles)
+            }
+            summary[field]["max"] = float(values.max())
+        return summary
+
+    def get_best_flavors(self, flavors):
+        """Return the index in flavors of the smallest flavor fitting each VM, -1 if none fits
+
+        Flavors are ranked by RAM, then vCPUs, then disk. A flavor with a 0 GB disk boots from a
+        volume, so it fits any disk.
+        """
+        if not flavors:
+            return np.full(len(self.names), -1)
+        ranks = [(flavor["ram_mb"], flavor["vcpus"], flavor["disk_gb"]) for flavor in flavors]
+        order = sorted(range(len(flavors)), key=ranks.__getitem__)
+        vcpus = np.array([flavors[num]["vcpus"] for num in order])
+        ram_mb = np.array([flavors[num]["ram_mb"] for num in order])
+        disk_gb = np.array([flavors[num]["disk_gb"] for num in order])
+        # VMs x flavors
+        fits_disk = (disk_gb == 0) | (disk_gb >= np.ceil(self.disk_gb)[:, None])
+        fits = (vcpus >= self.num_cpu[:, None]) & (ram_mb >= self.ram_mb[:, None]) & fits_disk
+        first = fits.argmax(axis=1)
+        return np.where(fits.any(axis=1), np.array(order)[first], -1)
+
+    def summarize(self, flavors=None):
+        """ Return the totals, percentiles, storage and flavor counts of the inventory """
+        summary = {
+            "vms": len(self.names),
+            "totals": {
+                "vcpus": int(self.num_cpu.sum()),
+                "ram_mb": int(self.ram_mb.sum()),
+                "disk_gb": round(float(self.disk_gb.sum()), 2),
+            },
+            "percentiles": self.get_percentiles(),
+            "storage": self.get_storage(),
+        }
+        if flavors:
+            best = self.get_best_flavors(flavors)
+            counts = np.bincount(best[best >= 0], minlength=len(flavors))
+            summary["flavors"] = {
+                flavor["name"]: int(count) for flavor, count in zip(flavors, counts) if count
+            }
+            # What the fitted VMs will be allocated once running on their flavors
+            summary["flavor_totals"] = {
+                key: int(np.dot(counts, [flavor[key] for flavor in flavors]))
+                for key in ["vcpus", "ram_mb", "disk_gb"]
+            }
+            summary["unfit_vms"] = [self.names[num] for num in np.flatnonzero(best < 0)]
+        return summary
+
+    def get_vm_flavors(self, flavors):
+        """ Return a (vcenter, uuid, name, flavor name or None) tuple per VM """
+        best = self.get_best_flavors(flavors)
+        return [
+            (vcenter, uuid, name, flavors[num]["name"] if num >= 0 else None)
+            for vcenter, uuid, name, num in zip(self.vcenters, self.uuids, self.names, best)
+        ]
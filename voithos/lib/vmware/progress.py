@@ -0,0 +1,281 @@
+""" Event-driven progress reporting for disk downloads, driven by their byte counters """
+import json
+import socket
+import sys
+from threading import Event, Thread
+from time import time
+
+
+DEFAULT_INTERVAL = 1.0  # seconds between samples
+DEFAULT_STALL_SECONDS = 60
+EWMA_ALPHA = 0.3
+PROGRESS_FORMATS = ["text", "json"]
+BYTES_IN_MB = 1024 * 1024
+BYTES_IN_GB = 1024 * 1024 * 1024
+
+
+class ProgressOutputError(Exception):
+    """ The progress output could not be opened """
+
+
+def _ewma(average, rate):
+    """ Return the exponentially weighted moving average updated with a new rate """
+    if average is None:
+        return rate
+    return EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * average
+
+
+def _eta(remaining, rate):
+    """ Seconds until remaining bytes are done at rate bytes/s, None when unknown """
+    if remaining is None or not rate:
+        return None
+    return round(max(remaining, 0) / rate, 1)
+
+
+class DiskProgress:
+    """ Rate, ETA and stall tracking for one download """
+
+    def __init__(self, name, transfer, now):
+        """ Track transfer (a DiskDownload or anything with the same counters) under name """
+        self.name = name
+        self.transfer = transfer
+        self.last_bytes = transfer.bytes_written
+        self.last_ts = now
+        self.last_change_ts = now
+        self.ewma_bps = None
+        self.stalled = False
+        self.done_reported = False
+
+    def sample(self, now, stall_seconds):
+        """ Return this disk's progress event, plus a stall or done event when one happens """
+        transfer = self.transfer
+        written = transfer.bytes_written
+        elapsed = max(now - self.last_ts, 1e-6)
+        rate = (written - self.last_bytes) / elapsed
+        self.ewma_bps = _ewma(self.ewma_bps, rate)
+        events = []
+        idle = now - self.last_change_ts
+        if written != self.last_bytes:
+            self.last_change_ts = now
+            self.stalled = False
+        elif not transfer.done and not self.stalled and idle >= stall_seconds:
+            self.stalled = True
+            events.append(
+                {"event": "stall", "ts": now, "disk": self.name, "idle_seconds": round(idle, 1)}
+            )
+        self.last_bytes = written
+        self.last_ts = now
+        total = transfer.total_bytes
+        error = None if transfer.error is None else str(transfer.error)
+        event = {
+            "event": "disk",
+            "ts": now,
+            "disk": self.name,
+            "bytes": written,
+            "allocated_bytes": transfer.bytes_allocated,
+            "total_bytes": total,
+            "rate_bps": round(rate),
+            "ewma_bps": round(self.ewma_bps),
+            "eta_seconds": _eta(None if total is None else total - written, self.ewma_bps),
+            "stalled": self.stalled,
+            "done": transfer.done,
+            "error": error,
+        }
+        events.insert(0, event)
+        if transfer.done and not self.done_reported:
+            self.done_reported = True
+            events.append({"event": "done", "ts": now, "disk": self.name, "error": error})
+        return events
+
+
+class ProgressMonitor:
+    """Sample download byte counters on a background thread and hand events to writers
+
+    Every interval seconds each writer gets a list of events: one "disk" event per download, a
+    "total" event and any "stall"/"done" events. A final "finished" event is sent on stop().
+    on_sample, if given, is called with the "total" event after each sample.
+    """
+
+    def __init__(
+        self,
+        transfers,
+        total_bytes,
+        writers,
+        interval=DEFAULT_INTERVAL,
+        stall_seconds=DEFAULT_STALL_SECONDS,
+        on_sample=None,
+    ):
+        """ transfers is a list of (name, transfer) tuples, total_bytes the expected total """
+        self.start_ts = time()
+        self.disks = [DiskProgress(name, transfer, self.start_ts) for name, transfer in transfers]
+        self.total_bytes = total_bytes
+        self.writers = writers
+        self.interval = interval
+        self.stall_seconds = stall_seconds
+        self.on_sample = on_sample
+        self.total_ewma_bps = None
+        self._last_total = sum(disk.last_bytes for disk in self.disks)
+        self._last_ts = self.start_ts
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """ Start sampling """
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling, send the final events and close the writers, once """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        events = self.sample()
+        total = dict(events[-1], event="finished")
+        for writer in self.writers:
+            writer.write_events(events + [total])
+            writer.close()
+
+    def _run(self):
+        """ Thread target: sample every interval until stopped """
+        while not self._stop.wait(self.interval):
+            events = self.sample()
+            for writer in self.writers:
+                writer.write_events(events)
+            if self.on_sample is not None:
+                self.on_sample(events[-1])
+
+    def sample(self):
+        """ Return the events for the current state of every download, the "total" event last """
+        now = time()
+        events = []
+        for disk in self.disks:
+            events.extend(disk.sample(now, self.stall_seconds))
+        written = sum(disk.last_bytes for disk in self.disks)
+        rate = (written - self._last_total) / max(now - self._last_ts, 1e-6)
+        self.total_ewma_bps = _ewma(self.total_ewma_bps, rate)
+        self._last_total = written
+        self._last_ts = now
+        percent = int(written / self.total_bytes * 100) if self.total_bytes else None
+        events.append(
+            {
+                "event": "total",
+                "ts": now,
+                "elapsed_seconds": round(now - self.start_ts, 1),
+                "bytes": written,
+                "allocated_bytes": sum(disk.transfer.bytes_allocated for disk in self.disks),
+                "total_bytes": self.total_bytes,
+                "percent": percent,
+                "rate_bps": round(rate),
+                "ewma_bps": round(self.total_ewma_bps),
+                "eta_seconds": _eta(self.total_bytes - written, self.total_ewma_bps),
+                "active": len([disk for disk in self.disks if not disk.transfer.done]),
+                "stalled": len([disk for disk in self.disks if disk.stalled]),
+            }
+        )
+        return events
+
+
+class JsonLinesProgressWriter:
+    """ Write each progress event as one line of JSON """
+
+    def __init__(self, stream, close_stream=False):
+        """ stream is any text file-like object, closed by close() if close_stream is True """
+        self.stream = stream
+        self.close_stream = close_stream
+
+    def write_events(self, events):
+        """ Write and flush the events """
+        for event in events:
+            self.stream.write(json.dumps(event) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        """ Close the stream if it is owned by this writer """
+        if self.close_stream:
+            self.stream.close()
+
+
+class TextProgressWriter:
+    """Print human readable progress at most every print_interval seconds
+
+    A label, such as the VM name, prefixes every line so the progress of concurrent exports
+    sharing a stream can be told apart
+    """
+
+    def __init__(self, print_interval, stream=None, label=None):
+        """ print_interval=0 only prints the final summary """
+        self.print_interval = print_interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.prefix = f"[{label}] " if label else ""
+        self.last_print = time()
+
+    def write_events(self, events):
+        """ Print the disk and total events if print_interval has passed, or when finished """
+        total = events[-1]
+        now = total["ts"]
+        finished = total["event"] == "finished"
+        if not finished and (
+            not self.print_interval or now - self.last_print < self.print_interval
+        ):
+            return
+        self.last_print = now
+        lines = [""]
+        disks = [event for event in events if event["event"] == "disk"]
+        lines.append(f"Downloading files: {total['active']}/{len(disks)} remaining")
+        for disk in disks:
+            size_gb = round(disk["bytes"] / BYTES_IN_GB, 2)
+            speed = round(disk["ewma_bps"] / BYTES_IN_MB, 2)
+            status = " (DONE)" if disk["done"] else (" (STALLED)" if disk["stalled"] else "")
+            lines.append(f"  {disk['disk']} - {size_gb} GB \t[SPEED: {speed} MB/s]{status}")
+        total_gb = round((total["total_bytes"] or 0) / BYTES_IN_GB, 2)
+        down_gb = round(total["bytes"] / BYTES_IN_GB, 2)
+        lines.append(f"\\- Total Downloaded: \t{down_gb} GB / {total_gb} GB - {total['percent']}%")
+        elapsed = max(total["elapsed_seconds"], 1)
+        thick_avg_mbs = round(total["bytes"] / BYTES_IN_MB / elapsed, 2)
+        lines.append(f"\\- Avg Speed (thick): \t{thick_avg_mbs} MB/s")
+        thin_avg_mbs = round(total["allocated_bytes"] / BYTES_IN_MB / elapsed, 2)
+        lines.append(f"\\- Avg Speed (thin): \t{thin_avg_mbs} MB/s")
+        if total["eta_seconds"] is not None and not finished:
+            lines.append(f"\\- ETA: \t{int(total['eta_seconds'])} seconds")
+        lines = [f"{self.prefix}{line}" if line else line for line in lines]
+        self.stream.write("\n".join(lines) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        """ Nothing to release """
+
+
+def open_progress_output(target):
+    """Return (stream, owned) for a progress target
+
+    "-" is stdout, "tcp://host:port" and "unix:///path" are sockets, anything else a file
+    that is appended to
+    """
+    if target in (None, "-"):
+        return sys.stdout, False
+    address = target.partition("://")[2]
+    try:
+        if target.startswith("tcp://"):
+            host, _, port = address.rpartition(":")
+            sock = socket.create_connection((host, int(port)))
+            return sock.makefile("w"), True
+        if target.startswith("unix://"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(address)
+            return sock.makefile("w"), True
+        return open(target, "a", encoding="utf-8"), True
+    except (OSError, ValueError) as exc:
+        raise ProgressOutputError(f"ERROR: Failed to open progress output {target}: {exc}") from exc
+
+
+def get_progress_writers(progress_format="text", target="-", print_interval=15, label=None):
+    """Return the writers for a progress format and target, as used by the CLI options
+
+    label prefixes the lines of the text format, see TextProgressWriter
+    """
+    if progress_format not in PROGRESS_FORMATS:
+        raise ValueError(f"Unsupported progress format {progress_format}")
+    stream, owned = open_progress_output(target)
+    if progress_format == "json":
+        return [JsonLinesProgressWriter(stream, close_stream=owned)]
+    return [TextProgressWriter(print_interval, stream=stream, label=label)]
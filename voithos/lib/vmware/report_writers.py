@@ -0,0 +1,144 @@
+""" Write VM reports as they are built, in the show-vm output formats """
+import csv
+import json
+import sys
+from pprint import pprint
+
+
+REPORT_FORMATS = ["pprint", "json", "jsonl", "csv"]
+
+CSV_COLUMNS = [
+    "uuid",
+    "name",
+    "os",
+    "cores",
+    "ram_mb",
+    "num_disks",
+    "total_storage_gb",
+    "used_storage_gb",
+    "num_nics",
+    "net_list",
+    "shared_storage",
+    "vcenter",
+]
+
+
+def get_csv_row(report):
+    """ Return the CSV_COLUMNS values of a VM report """
+    disks = report["storage"]["disks"]
+    net_list = [network["vswitch_name"] for network in report["network"]["networks"]]
+    return [
+        report["uuid"],
+        report["name"],
+        report["guest_os"],
+        report["num_cpu"],
+        report["ram"]["total_mb"],
+        report["storage"]["num_disks"],
+        sum(disk["capacity_gb"] for disk in disks),
+        round(report["storage"]["partitions"]["total_used_gb"], 2),
+        report["network"]["num_interfaces"],
+        " ||| ".join(net_list),
+        "yes" if any(disk["shared"] for disk in disks) else "no",
+        report.get("vcenter"),
+    ]
+
+
+class ReportWriter:
+    """Write reports to a stream one at a time, flushing each so it shows up at once
+
+    Subclasses implement _write and may write a header in __init__ and a footer in _finish
+    """
+
+    def __init__(self, stream, close_stream=False):
+        """ stream is any text file-like object, closed by close() if close_stream is True """
+        self.stream = stream
+        self.close_stream = close_stream
+        self.count = 0
+
+    def _write(self, report):
+        """ Write one report """
+        raise NotImplementedError
+
+    def _finish(self):
+        """ Write anything that follows the last report """
+
+    def write(self, report):
+        """ Write and flush one report """
+        self._write(report)
+        self.count += 1
+        self.stream.flush()
+
+    def close(self):
+        """ Finish the output, and close the stream if it is owned by this writer """
+        self._finish()
+        self.stream.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+class PprintReportWriter(ReportWriter):
+    """ Pretty print each report """
+
+    def _write(self, report):
+        """ Pretty print one report """
+        pprint(report, stream=self.stream)
+
+
+class JsonReportWriter(ReportWriter):
+    """ Write the reports as one JSON list, the same as json.dumps of the whole list """
+
+    def _write(self, report):
+        """ Write one list item, opening the list before the first """
+        self.stream.write(", " if self.count else "[")
+        self.stream.write(json.dumps(report))
+
+    def _finish(self):
+        """ Close the list """
+        self.stream.write("]\n" if self.count else "[]\n")
+
+
+class JsonLinesReportWriter(ReportWriter):
+    """ Write each report as one line of JSON (JSON Lines / NDJSON) """
+
+    def _write(self, report):
+        """ Write one JSON line """
+        self.stream.write(json.dumps(report) + "\n")
+
+
+class CsvReportWriter(ReportWriter):
+    """ Write a CSV_COLUMNS header, then one properly quoted CSV row per report """
+
+    def __init__(self, stream, close_stream=False):
+        """ Write the header row """
+        super().__init__(stream, close_stream=close_stream)
+        self.csv = csv.writer(stream, lineterminator="\n")
+        self.csv.writerow(CSV_COLUMNS)
+
+    def _write(self, report):
+        """ Write one CSV row """
+        self.csv.writerow(get_csv_row(report))
+
+
+WRITERS = {
+    "pprint": PprintReportWriter,
+    "json": JsonReportWriter,
+    "jsonl": JsonLinesReportWriter,
+    "csv": CsvReportWriter,
+}
+
+
+def get_report_writer(report_format="pprint", output_file="-"):
+    """Return the writer of a report format, writing to stdout for "-" or else to output_file
+
+    Raises OSError when output_file can't be opened
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Unsupported report format {report_format}")
+    if output_file == "-":
+        return WRITERS[report_format](sys.stdout)
+    newline = "" if report_format == "csv" else None
+    # The writer owns the file and closes it in close()
+    stream = open(  # pylint: disable=consider-using-with
+        output_file, "w", encoding="utf-8", newline=newline
+    )
+    return WRITERS[report_format](stream, close_stream=True)
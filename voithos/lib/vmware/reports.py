@@ -1,6 +1,28 @@
 """ Generate reports from VMWare VM data """
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from pyVmomi import vim
 
+from voithos.lib.vmware.collector import retrieve_object_properties
+
+
+DEFAULT_REPORT_BATCH_SIZE = 100  # VMs read per PropertyCollector call, see iter_vms_data
+DEFAULT_REPORT_WORKERS = 4  # PropertyCollector calls in flight at once
+
+# VM properties read to build a report, see iter_vms_data
+REPORT_PROPERTIES = [
+    "name",
+    "summary.config",
+    "summary.quickStats.uptimeSeconds",
+    "summary.overallStatus",
+    "config.createDate",
+    "runtime.powerState",
+    "guest.disk",
+    "config.hardware.device",
+]
+
 
 def bytes_to_gb(bytes_val):
     """ Convert bytes to GB, rounded to 2 decimal places """
@@ -11,8 +33,13 @@ def bytes_to_gb(bytes_val):
 
 def get_disk_data(vm):
     """ Return a list of dictionaries showing useful disk-related data """
+    return _get_disk_data(vm.config.hardware.device)
+
+
+def _get_disk_data(devices):
+    """ Return the get_disk_data list of the VirtualDisks among devices """
     disk_data = []
-    for dev in vm.config.hardware.device:
+    for dev in devices:
         if not isinstance(dev, vim.vm.device.VirtualDisk):
             continue
         shared = dev.backing.sharing != "sharingNone"
@@ -31,7 +58,11 @@ def get_disk_data(vm):
 
 def get_partition_data(vm):
     """ Return a dictionary of this VMs available useful partition data """
-    partitions = vm.guest.disk
+    return _get_partition_data(vm.guest.disk)
+
+
+def _get_partition_data(partitions):
+    """ Return the get_partition_data dictionary of a VM's guest.disk partitions """
     total_used_gb = 0
     # Partition info is only available when the VM is on & has vmware tools
     part_data = []
@@ -55,8 +86,13 @@ def get_partition_data(vm):
 
 def get_network_data(vm):
     """ return a list of dictionaries showing useful network data """
+    return _get_network_data(vm.config.hardware.device)
+
+
+def _get_network_data(devices):
+    """ Return the get_network_data list of the network cards among devices """
     net_data = []
-    for dev in vm.config.hardware.device:
+    for dev in devices:
         if not hasattr(dev, "macAddress"):
             continue
         pci_slot_num = dev.slotInfo.pciSlotNumber if dev.slotInfo is not None else ""
@@ -75,28 +111,91 @@ def get_network_data(vm):
     return net_data
 
 
-def get_vm_data(vm):
-    """ Return a dictionary of useful data about an entire VM """
+def build_vm_data(props):
+    """Return a dictionary of useful data about an entire VM, from its REPORT_PROPERTIES
+
+    Returns None when the VM's properties could not be read, for instance if it was deleted
+    """
+    config = props.get("summary.config")
+    if config is None:
+        return None
+    devices = props.get("config.hardware.device") or []
     return {
-        "name": vm.name,
-        "uuid": vm.summary.config.uuid,
-        "create_date": str(vm.config.createDate),
-        "guest_os": vm.summary.config.guestFullName,
-        "uptime_seconds": vm.summary.quickStats.uptimeSeconds,
-        "power_state": vm.runtime.powerState,
-        "status": vm.summary.overallStatus,
-        "num_cpu": vm.summary.config.numCpu,
+        "name": props.get("name"),
+        "uuid": config.uuid,
+        "create_date": str(props.get("config.createDate")),
+        "guest_os": config.guestFullName,
+        "uptime_seconds": props.get("summary.quickStats.uptimeSeconds"),
+        "power_state": props.get("runtime.powerState"),
+        "status": props.get("summary.overallStatus"),
+        "num_cpu": config.numCpu,
         "ram": {
-            "total_mb": vm.summary.config.memorySizeMB,
-            "used_mb": vm.summary.config.memorySizeMB,
+            "total_mb": config.memorySizeMB,
+            "used_mb": config.memorySizeMB,
         },
         "storage": {
-            "num_disks": vm.summary.config.numVirtualDisks,
-            "partitions": get_partition_data(vm),
-            "disks": get_disk_data(vm),
+            "num_disks": config.numVirtualDisks,
+            "partitions": _get_partition_data(props.get("guest.disk") or []),
+            "disks": _get_disk_data(devices),
         },
         "network": {
-            "num_interfaces": vm.summary.config.numEthernetCards,
-            "networks": get_network_data(vm),
+            "num_interfaces": config.numEthernetCards,
+            "networks": _get_network_data(devices),
         },
     }
+
+
+def _get_batch_data(batch, batch_size):
+    """Return a (vm, get_vm_data dictionary) pair per VM of a batch, one PropertyCollector call
+    per vCenter
+
+    VMs whose properties could not be read are left out, with a warning
+    """
+    by_stub = {}
+    for vm in batch:
+        by_stub.setdefault(vm._stub, []).append(vm)
+    reports = {}
+    for stub, stub_vms in by_stub.items():
+        conn = vim.ServiceInstance("ServiceInstance", stub)
+        results = retrieve_object_properties(conn, stub_vms, REPORT_PROPERTIES, batch_size)
+        for vm, props in zip(stub_vms, results):
+            reports[id(vm)] = build_vm_data(props)
+            if reports[id(vm)] is None:
+                sys.stderr.write(f"WARN: Skipping VM {vm._moId}, its properties were not read\n")
+    return [(vm, reports[id(vm)]) for vm in batch if reports[id(vm)] is not None]
+
+
+def iter_vms_data(vms, batch_size=DEFAULT_REPORT_BATCH_SIZE, workers=DEFAULT_REPORT_WORKERS):
+    """Yield a (vm, get_vm_data dictionary) pair for each VM that could be read, in their order
+
+    VMs that could not be read are skipped, so the pairs tell which VM each report is about. The
+    report properties of batch_size VMs are read with each PropertyCollector call, instead
+    of a round trip per attribute of each VM. Up to workers batches are read at once, over the
+    shared vCenter connections, and at most 2 * workers batches are read ahead of the one being
+    yielded, so memory stays bounded. VMs may come from several vCenters.
+    """
+    vms = list(vms)
+    batches = [vms[slice(start, start + batch_size)] for start in range(0, len(vms), batch_size)]
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for batch in batches:
+                pending.append(pool.submit(_get_batch_data, batch, batch_size))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # Do not read the rest when the consumer stops early or a batch failed
+            for future in pending:
+                future.cancel()
+
+
+def get_vms_data(vms, batch_size=DEFAULT_REPORT_BATCH_SIZE, workers=DEFAULT_REPORT_WORKERS):
+    """ Return the get_vm_data dictionary of each VM, in their order, see iter_vms_data """
+    return [report for _, report in iter_vms_data(vms, batch_size, workers)]
+
+
+def get_vm_data(vm):
+    """ Return a dictionary of useful data about an entire VM, None if it can't be read """
+    return next((report for _, report in _get_batch_data([vm], 1)), None)
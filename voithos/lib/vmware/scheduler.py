@@ -0,0 +1,123 @@
+""" Run many VM exports from a job queue with global and per-ESXi-host concurrency limits """
+from collections import Counter
+from threading import Condition, Thread
+from time import time
+
+from voithos.lib.vmware.common import debug
+
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_PER_HOST = 2
+JOB_ORDERS = ["largest-first", "smallest-first", "given"]
+UNKNOWN_HOST = "unknown"
+
+
+def get_export_jobs(records):
+    """Return a job dict for each VM inventory record (see VMWareMgr.get_vm_record)
+
+    Duplicates and VMs whose config could not be read are skipped
+    """
+    jobs = []
+    seen = set()
+    for record in records:
+        key = (record["vcenter"], record["uuid"])
+        if record["uuid"] is None or key in seen:
+            continue
+        seen.add(key)
+        jobs.append(
+            {
+                "vm": record["vm"],
+                "vcenter": record["vcenter"],
+                "name": record["name"],
+                "uuid": record["uuid"],
+                "host": record["host"] or UNKNOWN_HOST,
+                "size_bytes": record["disk_bytes"],
+                "status": "pending",
+                "error": None,
+                "elapsed_seconds": None,
+            }
+        )
+    return jobs
+
+
+def order_jobs(jobs, order="largest-first"):
+    """Return the jobs in the order they should start
+
+    largest-first starts the longest exports first (the LPT rule), which keeps the makespan of a
+    wave close to optimal. smallest-first finishes the most VMs early. given keeps the order.
+    """
+    if order not in JOB_ORDERS:
+        raise ValueError(f"Unsupported job order {order}. Supported: {JOB_ORDERS}")
+    if order == "given":
+        return list(jobs)
+    return sorted(jobs, key=lambda job: job["size_bytes"], reverse=order == "largest-first")
+
+
+class ExportScheduler:
+    """Run export jobs on threads, at most max_concurrent at once and max_per_host per ESXi host
+
+    Jobs start in their list order. When the next job's host is at its limit, the first job
+    that fits is started instead, so one busy host does not hold up the others.
+    """
+
+    def __init__(
+        self,
+        jobs,
+        run_job,
+        max_concurrent=DEFAULT_MAX_CONCURRENT,
+        max_per_host=DEFAULT_MAX_PER_HOST,
+    ):
+        """ run_job is called with each job dict, an exception marks the job as failed """
+        if max_concurrent < 1 or max_per_host < 1:
+            raise ValueError("Concurrency limits must be at least 1")
+        self.jobs = jobs
+        self.run_job = run_job
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        self._running = Counter()  # host: running jobs
+        self._cond = Condition()
+
+    def _next_job(self, pending):
+        """ Return the first pending job that fits within the limits, or None """
+        if sum(self._running.values()) >= self.max_concurrent:
+            return None
+        return next(
+            (job for job in pending if self._running[job["host"]] < self.max_per_host), None
+        )
+
+    def _run(self, job):
+        """ Thread target: run one job and release its slot """
+        start = time()
+        try:
+            self.run_job(job)
+            job["status"] = "done"
+        except (Exception, SystemExit) as exc:
+            # One failed VM must not stop the rest of the wave
+            job["status"] = "failed"
+            job["error"] = str(exc) or type(exc).__name__
+        finally:
+            job["elapsed_seconds"] = round(time() - start, 1)
+            with self._cond:
+                self._running[job["host"]] -= 1
+                self._cond.notify_all()
+
+    def run(self):
+        """ Run every job, return them with their status, error and elapsed_seconds set """
+        pending = list(self.jobs)
+        threads = []
+        with self._cond:
+            while pending:
+                job = self._next_job(pending)
+                if job is None:
+                    self._cond.wait()
+                    continue
+                pending.remove(job)
+                self._running[job["host"]] += 1
+                job["status"] = "running"
+                debug(f"Starting export of {job['name']} ({job['uuid']}) on {job['host']}")
+                thread = Thread(target=self._run, args=(job,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self.jobs
@@ -0,0 +1,242 @@
+""" SQLite snapshots of VM reports, with one row per VM, disk and NIC, and diffs between them """
+import hashlib
+import json
+import os
+import sqlite3
+from time import time
+
+from voithos.lib.system import get_absolute_path
+
+
+DEFAULT_SNAPSHOT_PATH = "~/.voithos-cache/snapshots.db"
+
+# VM columns of a snapshot, by how they are read from a reports.get_vm_data dict
+VM_COLUMNS = {
+    "name": lambda report: report["name"],
+    "guest_os": lambda report: report["guest_os"],
+    "power_state": lambda report: report["power_state"],
+    "status": lambda report: report["status"],
+    "create_date": lambda report: report["create_date"],
+    "uptime_seconds": lambda report: report["uptime_seconds"],
+    "num_cpu": lambda report: report["num_cpu"],
+    "ram_mb": lambda report: report["ram"]["total_mb"],
+    "num_disks": lambda report: report["storage"]["num_disks"],
+    "num_nics": lambda report: report["network"]["num_interfaces"],
+    "used_gb": lambda report: report["storage"]["partitions"]["total_used_gb"],
+}
+DISK_COLUMNS = ["label", "uuid", "thin_provisioned", "shared", "capacity_gb"]
+NIC_COLUMNS = ["label", "nic_type", "vswitch_name", "connected", "pci_slot_num"]
+
+# Columns compared by diff. Uptime, status and guest disk usage change all the time.
+DIFF_COLUMNS = [
+    "name",
+    "guest_os",
+    "power_state",
+    "create_date",
+    "num_cpu",
+    "ram_mb",
+    "num_disks",
+    "num_nics",
+    "disks_digest",
+    "nics_digest",
+]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    vm_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS snapshot_vms (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    vcenter TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    {", ".join(VM_COLUMNS)},
+    disks_digest TEXT,
+    nics_digest TEXT,
+    PRIMARY KEY (snapshot_id, vcenter, uuid)
+);
+CREATE TABLE IF NOT EXISTS snapshot_disks (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    vcenter TEXT NOT NULL,
+    vm_uuid TEXT NOT NULL,
+    {", ".join(DISK_COLUMNS)}
+);
+-- A VM's device labels are unique, a VM listed twice replaces its rows instead of doubling them
+CREATE UNIQUE INDEX IF NOT EXISTS snapshot_disks_key
+    ON snapshot_disks (snapshot_id, vcenter, vm_uuid, label);
+CREATE TABLE IF NOT EXISTS snapshot_nics (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    vcenter TEXT NOT NULL,
+    vm_uuid TEXT NOT NULL,
+    {", ".join(NIC_COLUMNS)}
+);
+CREATE UNIQUE INDEX IF NOT EXISTS snapshot_nics_key
+    ON snapshot_nics (snapshot_id, vcenter, vm_uuid, label);
+"""
+
+
+class SnapshotError(Exception):
+    """ A snapshot is missing or already exists """
+
+
+def _get_digest(rows):
+    """ Return a digest of a list of rows, to compare the disks or NICs of a VM at once """
+    return hashlib.sha256(json.dumps(rows, sort_keys=True).encode()).hexdigest()
+
+
+class SnapshotStore:
+    """Inventory snapshots saved in a SQLite database
+
+    Each snapshot holds a row per VM in snapshot_vms and a row per disk and NIC in snapshot_disks
+    and snapshot_nics, keyed by vCenter and VM UUID. A digest of the disks and of the NICs of
+    each VM is kept with it, so diff finds changed VMs with one indexed join. The database is only
+    readable by its owner, like the inventory cache.
+    """
+
+    def __init__(self, path=DEFAULT_SNAPSHOT_PATH):
+        """ Open the snapshot database, creating it if needed """
+        self.path = get_absolute_path(path)
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        os.chmod(self.path, 0o600)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """ Close the database """
+        self.db.close()
+
+    def list(self):
+        """ Return every snapshot dict (id, name, created_at, vm_count), oldest first """
+        rows = self.db.execute("SELECT * FROM snapshots ORDER BY created_at, id")
+        return [dict(row) for row in rows]
+
+    def get(self, name):
+        """ Return the snapshot dict with a given name, raise SnapshotError if there is none """
+        row = self.db.execute("SELECT * FROM snapshots WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise SnapshotError(f"No snapshot named {name}")
+        return dict(row)
+
+    def _add_vm(self, snapshot_id, report):
+        """ Insert the rows of one VM report """
+        key = [snapshot_id, report.get("vcenter") or "", report["uuid"]]
+        disks = [[disk[column] for column in DISK_COLUMNS] for disk in report["storage"]["disks"]]
+        nics = [[nic[column] for column in NIC_COLUMNS] for nic in report["network"]["networks"]]
+        values = [read(report) for read in VM_COLUMNS.values()]
+        marks = ", ".join("?" * (len(VM_COLUMNS) + 5))
+        self.db.execute(
+            f"INSERT OR REPLACE INTO snapshot_vms VALUES ({marks})",
+            key + values + [_get_digest(disks), _get_digest(nics)],
+        )
+        for table, rows in (("snapshot_disks", disks), ("snapshot_nics", nics)):
+            if rows:
+                marks = ", ".join("?" * (len(rows[0]) + 3))
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO {table} VALUES ({marks})", [key + row for row in rows]
+                )
+
+    def create(self, name, reports):
+        """Save the VM reports (an iterable, see reports.iter_vms_data) as a new snapshot
+
+        Reports need a "vcenter" key when VMs come from several vCenters. VMs without a UUID
+        can't be told apart between snapshots and are skipped. Return the snapshot dict.
+        """
+        with self.db:
+            try:
+                cursor = self.db.execute(
+                    "INSERT INTO snapshots (name, created_at) VALUES (?, ?)", (name, time())
+                )
+            except sqlite3.IntegrityError:
+                raise SnapshotError(f"A snapshot named {name} already exists") from None
+            snapshot_id = cursor.lastrowid
+            for report in reports:
+                if report["uuid"] is not None:
+                    self._add_vm(snapshot_id, report)
+            self.db.execute(
+                "UPDATE snapshots SET vm_count ="
+                " (SELECT COUNT(*) FROM snapshot_vms WHERE snapshot_id = ?) WHERE id = ?",
+                (snapshot_id, snapshot_id),
+            )
+        return self.get(name)
+
+    def get_capacity_rows(self, name):
+        """Return a dict per VM of a snapshot with its vcenter, uuid, name, num_cpu, ram_mb,
+        used_gb, and the capacity of its disks as disk_gb and of its thin ones as thin_disk_gb
+        """
+        snapshot = self.get(name)
+        rows = self.db.execute(
+            "SELECT v.vcenter, v.uuid, v.name, v.num_cpu, v.ram_mb, v.used_gb,"
+            " COALESCE(SUM(d.capacity_gb), 0) AS disk_gb,"
+            " COALESCE(SUM(CASE WHEN d.thin_provisioned = 1 THEN d.capacity_gb END), 0)"
+            " AS thin_disk_gb"
+            " FROM snapshot_vms v LEFT JOIN snapshot_disks d ON d.snapshot_id = v.snapshot_id"
+            " AND d.vcenter = v.vcenter AND d.vm_uuid = v.uuid"
+            " WHERE v.snapshot_id = ? GROUP BY v.vcenter, v.uuid",
+            (snapshot["id"],),
+        )
+        return [dict(row) for row in rows]
+
+    def _get_vms(self, query, params):
+        """ Return the (vcenter, uuid, name) dicts of a query on snapshot_vms """
+        return [dict(row) for row in self.db.execute(query, params)]
+
+    def _get_devices(self, table, snapshot_id, vcenter, vm_uuid):
+        """ Return the disk or NIC dicts of a VM in a snapshot """
+        rows = self.db.execute(
+            f"SELECT * FROM {table} WHERE snapshot_id = ? AND vcenter = ? AND vm_uuid = ?",
+            (snapshot_id, vcenter, vm_uuid),
+        )
+        skip = ["snapshot_id", "vcenter", "vm_uuid"]
+        return [{key: row[key] for key in row.keys() if key not in skip} for row in rows]
+
+    def diff(self, old_name, new_name):
+        """Return the VMs added, removed and changed from snapshot old_name to new_name
+
+        Added and removed VMs are dicts of their vcenter, uuid and name. Changed VMs also have
+        a changes dict mapping each changed DIFF_COLUMNS column to its [old, new] values. When
+        the disks or NICs differ, "disks" or "nics" map to the [old, new] lists of their rows.
+        """
+        old = self.get(old_name)
+        new = self.get(new_name)
+        only_in = (
+            "SELECT a.vcenter, a.uuid, a.name FROM snapshot_vms a LEFT JOIN snapshot_vms b"
+            " ON b.snapshot_id = ? AND b.vcenter = a.vcenter AND b.uuid = a.uuid"
+            " WHERE a.snapshot_id = ? AND b.uuid IS NULL ORDER BY a.vcenter, a.name"
+        )
+        differs = " OR ".join(f"a.{column} IS NOT b.{column}" for column in DIFF_COLUMNS)
+        old_columns = ", ".join(f"a.{column} AS old_{column}" for column in DIFF_COLUMNS)
+        new_columns = ", ".join(f"b.{column} AS new_{column}" for column in DIFF_COLUMNS)
+        changed_rows = self.db.execute(
+            f"SELECT b.vcenter, b.uuid, b.name, {old_columns}, {new_columns}"
+            " FROM snapshot_vms a JOIN snapshot_vms b"
+            " ON b.snapshot_id = ? AND b.vcenter = a.vcenter AND b.uuid = a.uuid"
+            f" WHERE a.snapshot_id = ? AND ({differs}) ORDER BY b.vcenter, b.name",
+            (new["id"], old["id"]),
+        )
+        device_tables = {"disks_digest": "snapshot_disks", "nics_digest": "snapshot_nics"}
+        changed = []
+        for row in changed_rows:
+            changes = {}
+            for column in DIFF_COLUMNS:
+                if row[f"old_{column}"] == row[f"new_{column}"]:
+                    continue
+                if column in device_tables:
+                    changes[column.replace("_digest", "")] = [
+                        self._get_devices(device_tables[column], snapshot["id"], *row[:2])
+                        for snapshot in (old, new)
+                    ]
+                else:
+                    changes[column] = [row[f"old_{column}"], row[f"new_{column}"]]
+            vm = {"vcenter": row["vcenter"], "uuid": row["uuid"], "name": row["name"]}
+            changed.append(dict(vm, changes=changes))
+        return {
+            "old": old,
+            "new": new,
+            "added": self._get_vms(only_in, (old["id"], new["id"])),
+            "removed": self._get_vms(only_in, (new["id"], old["id"])),
+            "changed": changed,
+        }
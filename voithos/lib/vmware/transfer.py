@@ -0,0 +1,490 @@
+""" Native HTTP transfer of VMware disk files """
+import os
+import queue
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from voithos.lib.util.images import write_sparse
+from voithos.lib.util.manifest import IntegrityManifest, ManifestError
+from voithos.lib.vmware.checkpoint import TransferCheckpoint
+from voithos.lib.vmware.common import debug
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024 * 20  # 20 MB
+CACHE_DROP_BYTES = 1024 * 1024 * 256  # flush, checkpoint & drop written pages every 256 MB
+MIN_SEGMENT_BYTES = 1024 * 1024 * 64  # Don't split disks into ranges smaller than 64 MB
+SEGMENT_ALIGN = 1024 * 1024  # Range boundaries fall on 1 MB multiples
+CONNECT_TIMEOUT = 30  # seconds
+READ_TIMEOUT = 300  # seconds
+
+
+class DiskDownloadFailed(Exception):
+    """ A disk download did not complete """
+
+
+class BufferPool:
+    """A fixed set of reusable read buffers shared by the download threads
+
+    Each buffer is allocated once, data is read straight into it with readinto
+    """
+
+    def __init__(self, count, buffer_size=DEFAULT_CHUNK_SIZE):
+        """ Allocate count buffers of buffer_size bytes """
+        if count < 1:
+            raise ValueError(f"A buffer pool needs at least 1 buffer, not {count}")
+        self.buffer_size = buffer_size
+        self._buffers = queue.Queue()
+        for _ in range(count):
+            self._buffers.put(bytearray(buffer_size))
+
+    @contextmanager
+    def buffer(self):
+        """ Borrow a buffer as a memoryview, blocking until one is free """
+        buf = self._buffers.get()
+        try:
+            yield memoryview(buf)
+        finally:
+            self._buffers.put(buf)
+
+
+def get_session_cookies(conn):
+    """ Return the cookies of a vCenter connection's session, to authenticate HTTP transfers """
+    stub_list = conn._stub.cookie.split(";")
+    vmware_soap_session = stub_list[0].split("=")[1]
+    path = stub_list[1].lstrip()
+    return {"vmware_soap_session": f"{vmware_soap_session}; ${path}"}
+
+
+def get_session(cookies=None, pool_size=10):
+    """ Return a requests session with a connection pool sized for pool_size concurrent streams """
+    session = requests.Session()
+    session.verify = False
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+
+def preallocate(fd, num_bytes):
+    """ Reserve num_bytes on disk for fd, falling back to a plain resize when unsupported """
+    try:
+        os.posix_fallocate(fd, 0, num_bytes)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, num_bytes)
+
+
+def flush(fd, offset, length):
+    """ Flush a written region of fd to disk and ask the kernel to evict it from the page cache """
+    os.fdatasync(fd)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def write_all(fd, view, offset):
+    """ Positionally write the whole memoryview to fd at offset """
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _get_reader(raw):
+    """Return a readinto function for a streamed urllib3 response
+
+    urllib3's own readinto copies through a temporary bytes object. When the body is not
+    content-encoded, read from the underlying http.client response so data lands directly
+    in the pooled buffer.
+    """
+    fp = getattr(raw, "_fp", None)
+    encoding = raw.headers.get("content-encoding", "identity").lower()
+    if fp is not None and hasattr(fp, "readinto") and encoding == "identity":
+        return fp.readinto
+    return raw.readinto
+
+
+def probe_range_support(session, url):
+    """Return the size of the file at url if the server honours HTTP Range requests, else None
+
+    A one-byte range is requested: a 206 reply with a Content-Range total means the file can
+    be fetched in segments
+    """
+    headers = {"Range": "bytes=0-0"}
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code != 206:
+            return None
+        content_range = resp.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        if not total.isdigit():
+            return None
+        return int(total)
+
+
+def split_ranges(total_bytes, segments, min_segment=MIN_SEGMENT_BYTES, align=SEGMENT_ALIGN):
+    """Split total_bytes into at most segments contiguous (start, end) ranges, end exclusive
+
+    Segment boundaries are aligned to align bytes and no segment is smaller than min_segment,
+    except for the last
+    """
+    segments = max(1, min(segments, total_bytes // min_segment or 1))
+    seg_size = -(-total_bytes // segments)  # ceiling division
+    seg_size = -(-seg_size // align) * align
+    ranges = []
+    start = 0
+    while start < total_bytes:
+        end = min(start + seg_size, total_bytes)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class DiskDownload:
+    """Stream one disk URL into a local file, counting the bytes as they land
+
+    With segments > 1 and a server that supports HTTP Range, the file is split into byte
+    ranges that are fetched concurrently and written positionally into the same output file.
+    Flushed ranges are recorded in a checkpoint manifest next to the file, so a later run with
+    resume=True only fetches the ranges that are missing.
+
+    When a sink (such as convert.StreamConverter) is given, the body is fed to it as one
+    sequential stream instead of being written to file_path.
+
+    With sparse=True the file is not preallocated and all-zero blocks are skipped (or punched
+    out when resuming) instead of written, bytes_allocated counts what was really written.
+
+    When an IntegrityManifest is given, the data is hashed as it streams in and the manifest is
+    saved next to the file once the download completes. Ranges are aligned to its blocks.
+
+    refresh_url, such as lease.NfcLeaseManager.refresh_url, is called with the URL when the
+    download fails. If it returns a new URL, the download resumes from there.
+    """
+
+    def __init__(
+        self,
+        session,
+        url,
+        file_path,
+        buffer_pool,
+        segments=1,
+        resume=True,
+        sink=None,
+        sparse=False,
+        manifest=None,
+        refresh_url=None,
+    ):
+        """ Prepare the download, nothing is fetched until run() """
+        if segments < 1:
+            raise ValueError(f"A download needs at least 1 segment, not {segments}")
+        self.session = session
+        self.url = url
+        self.file_path = file_path
+        self.buffer_pool = buffer_pool
+        self.segments = segments
+        self.resume = resume
+        self.sink = sink
+        self.sparse = sparse
+        self.manifest = manifest
+        self.refresh_url = refresh_url
+        self.checkpoint = None
+        self.ranges = []  # (start, end) byte ranges requested with HTTP Range
+        self.total_bytes = None  # from Content-Length or Content-Range, when the server sends it
+        self.bytes_written = 0  # includes resumed_bytes
+        self._bytes_allocated = 0  # bytes_written minus the zero blocks that were skipped
+        self._punch = False  # deallocate zero blocks, the file may hold stale data
+        self.resumed_bytes = 0  # bytes already on disk from a previous run
+        self.start_ts = None
+        self.end_ts = None
+        self.error = None
+        self._lock = Lock()
+
+    @property
+    def bytes_allocated(self):
+        """ Bytes that really landed on disk, the 'thin' size of the output """
+        if self.sink is not None:
+            return self.sink.bytes_allocated
+        return self._bytes_allocated
+
+    @property
+    def done(self):
+        """ True once the download has stopped, successfully or not """
+        return self.end_ts is not None
+
+    @property
+    def elapsed_seconds(self):
+        """ Seconds spent downloading so far """
+        if self.start_ts is None:
+            return 0
+        end = self.end_ts if self.end_ts is not None else time()
+        return end - self.start_ts
+
+    def run(self):
+        """ Download the file. Intended to be the target of a Thread - errors are kept in .error """
+        self.start_ts = time()
+        try:
+            while True:
+                url = self.url
+                try:
+                    self._run()
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    if not self._switch_url(url):
+                        raise
+            if self.manifest is not None and self.sink is None:
+                self._save_manifest()
+        except Exception as exc:  # pylint: disable=broad-except
+            debug(f"Download of {self.url} failed: {exc}")
+            self.error = exc
+        finally:
+            self.end_ts = time()
+
+    def _switch_url(self, url):
+        """Move on to the URL given by refresh_url after url failed, return False if there is none
+
+        What was already flushed is resumed from the checkpoint. A sink can't be resumed.
+        """
+        if self.refresh_url is None or self.sink is not None:
+            return False
+        new_url = self.refresh_url(url)
+        if new_url is None:
+            return False
+        debug(f"{self.file_path}: resuming from {new_url}")
+        self.url = new_url
+        self.resume = True
+        self.bytes_written = self._bytes_allocated = 0
+        return True
+
+    def _run(self):
+        """ Pick between skipping, resuming, a segmented download and a single stream """
+        if self.sink is not None:
+            self._download_to_sink()
+            return
+        checkpoint = TransferCheckpoint.load(self.file_path) if self.resume else None
+        complete = checkpoint is not None and checkpoint.complete
+        if complete and os.path.getsize(self.file_path) == checkpoint.total_bytes:
+            debug(f"{self.file_path} is already complete, skipping")
+            self.checkpoint = checkpoint
+            self.total_bytes = checkpoint.total_bytes
+            self.bytes_written = self.resumed_bytes = checkpoint.total_bytes
+            self._bytes_allocated = self._allocated_on_disk(checkpoint.total_bytes)
+            return
+        if self.manifest is not None:
+            self.manifest.remove()  # It describes an older copy of the file
+        total_bytes = None
+        if checkpoint is not None or self.segments > 1:
+            total_bytes = probe_range_support(self.session, self.url)
+        if not total_bytes:
+            if checkpoint is not None:
+                debug(f"{self.url} does not support Range, restarting {self.file_path}")
+            self._download()
+            return
+        fresh = checkpoint is None or checkpoint.total_bytes != total_bytes
+        if fresh:
+            checkpoint = TransferCheckpoint(self.file_path, total_bytes)
+        self._download_ranges(checkpoint, fresh)
+
+    def _save_manifest(self):
+        """ Hash whatever the streams did not cover, then write the manifest """
+        if self.resumed_bytes == self.total_bytes:
+            try:
+                existing = IntegrityManifest.load(self.file_path)
+            except ManifestError:
+                existing = None
+            if existing is not None and existing.size == self.total_bytes:
+                self.manifest = existing  # Skipped as complete, the saved manifest still applies
+                return
+        self.manifest.finish(os.path.getsize(self.file_path))
+        if self.manifest.rehashed_blocks:
+            debug(f"{self.file_path}: read back {self.manifest.rehashed_blocks} blocks to hash")
+        self.manifest.save()
+
+    def _hasher(self, offset, whole_file=False):
+        """ Return a BlockHasher for a stream starting at offset, or None without a manifest """
+        if self.manifest is None:
+            return None
+        return self.manifest.stream(offset, whole_file=whole_file)
+
+    def _add_bytes(self, num_bytes, num_allocated):
+        """ Count bytes landed by any of this download's streams """
+        with self._lock:
+            self.bytes_written += num_bytes
+            self._bytes_allocated += num_allocated
+
+    def _allocated_on_disk(self, limit):
+        """ Return the bytes allocated to file_path by the filesystem, at most limit """
+        return min(os.stat(self.file_path).st_blocks * 512, limit)
+
+    def _reserve(self, fd, num_bytes):
+        """ Size a new output file: preallocated, or left as a hole in sparse mode """
+        if self.sparse:
+            os.ftruncate(fd, num_bytes)
+        else:
+            preallocate(fd, num_bytes)
+
+    def _download(self):
+        """ Fetch the URL into file_path as one stream """
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        with self.session.get(self.url, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            self.total_bytes = int(length) if length else None
+            fd = os.open(self.file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if self.total_bytes:
+                    self._reserve(fd, self.total_bytes)
+                    self.checkpoint = TransferCheckpoint(self.file_path, self.total_bytes)
+                    self.checkpoint.save()
+                hasher = self._hasher(0, whole_file=True)
+                self._stream(resp, fd, 0, hasher)
+                os.ftruncate(fd, self.bytes_written)
+            finally:
+                os.close(fd)
+            # The body was read to EOF, so the connection can go back to the pool
+            resp.raw.release_conn()
+        if self.total_bytes is not None and self.bytes_written != self.total_bytes:
+            raise DiskDownloadFailed(
+                f"{self.url}: received {self.bytes_written} of {self.total_bytes} bytes"
+            )
+        if hasher is not None:
+            hasher.close(at_eof=True)
+
+    def _download_to_sink(self):
+        """ Feed the URL's body to self.sink as one stream """
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        with self.session.get(self.url, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            self.total_bytes = int(length) if length else None
+            readinto = _get_reader(resp.raw)
+            try:
+                with self.buffer_pool.buffer() as buf:
+                    while True:
+                        num_read = readinto(buf)
+                        if not num_read:
+                            break
+                        self.sink.feed(buf[:num_read])
+                        self._add_bytes(num_read, 0)
+            except BaseException:
+                self.sink.abort()
+                raise
+            self.sink.close()
+            resp.raw.release_conn()
+
+    def _download_ranges(self, checkpoint, fresh):
+        """ Fetch the ranges missing from checkpoint as concurrent HTTP Range requests """
+        self.checkpoint = checkpoint
+        self.total_bytes = checkpoint.total_bytes
+        self.bytes_written = self.resumed_bytes = checkpoint.verified_bytes
+        self._punch = not fresh
+        if not fresh:
+            self._bytes_allocated = self._allocated_on_disk(self.resumed_bytes)
+            print(f"  Resuming {self.file_path}: {self.resumed_bytes} bytes already downloaded")
+        self.ranges = []
+        align = SEGMENT_ALIGN if self.manifest is None else self.manifest.block_size
+        for gap_start, gap_end in checkpoint.missing_ranges():
+            for start, end in split_ranges(gap_end - gap_start, self.segments, align=align):
+                self.ranges.append((gap_start + start, gap_start + end))
+        debug(f"{self.url}: {len(self.ranges)} ranges of {self.total_bytes} bytes")
+        work = queue.Queue()
+        for byte_range in self.ranges:
+            work.put(byte_range)
+        errors = []
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if fresh else 0)
+        fd = os.open(self.file_path, flags, 0o644)
+        try:
+            if fresh:
+                self._reserve(fd, self.total_bytes)
+                checkpoint.save()
+            elif os.fstat(fd).st_size != self.total_bytes:
+                os.ftruncate(fd, self.total_bytes)
+            threads = [
+                Thread(target=self._range_worker, args=(fd, work, errors))
+                for _ in range(min(self.segments, len(self.ranges)))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(fd)
+        if errors:
+            raise errors[0]
+        if not checkpoint.complete:
+            raise DiskDownloadFailed(
+                f"{self.url}: verified {checkpoint.verified_bytes} of {self.total_bytes} bytes"
+            )
+
+    def _range_worker(self, fd, work, errors):
+        """ Thread target: fetch queued byte ranges until none are left or one fails """
+        while True:
+            try:
+                start, end = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._fetch_range(fd, start, end)
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+                return
+
+    def _fetch_range(self, fd, start, end):
+        """ Fetch bytes [start, end) of the URL and write them at the same offset of fd """
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        with self.session.get(self.url, headers=headers, stream=True, timeout=timeout) as resp:
+            if resp.status_code != 206:
+                raise DiskDownloadFailed(f"{self.url}: range {start}-{end} got {resp.status_code}")
+            hasher = self._hasher(start, whole_file=end - start == self.total_bytes)
+            received = self._stream(resp, fd, start, hasher)
+            resp.raw.release_conn()
+        if received != end - start:
+            raise DiskDownloadFailed(
+                f"{self.url}: range {start}-{end} received {received} of {end - start} bytes"
+            )
+        if hasher is not None:
+            hasher.close(at_eof=end == self.total_bytes)
+
+    def _stream(self, resp, fd, offset, hasher=None):
+        """Copy the response body into fd from offset through a pooled buffer, return its size
+
+        Every CACHE_DROP_BYTES, and when the stream ends or breaks, the new data is flushed and
+        recorded in the checkpoint. The data is also fed to hasher, if one is given.
+        """
+        readinto = _get_reader(resp.raw)
+        position = offset
+        flush_mark = offset
+        try:
+            with self.buffer_pool.buffer() as buf:
+                while True:
+                    num_read = readinto(buf)
+                    if not num_read:
+                        break
+                    if hasher is not None:
+                        hasher.update(buf[:num_read])
+                    if self.sparse:
+                        # Pooled views start at offset 0 of their bytearray, compare it in place
+                        allocated = write_sparse(fd, buf.obj, num_read, position, self._punch)
+                    else:
+                        write_all(fd, buf[:num_read], position)
+                        allocated = num_read
+                    position += num_read
+                    self._add_bytes(num_read, allocated)
+                    if position - flush_mark >= CACHE_DROP_BYTES:
+                        self._flush(fd, flush_mark, position)
+                        flush_mark = position
+        finally:
+            self._flush(fd, flush_mark, position)
+        return position - offset
+
+    def _flush(self, fd, start, end):
+        """ Flush [start, end) of fd to disk and record it as verified """
+        if end <= start:
+            return
+        flush(fd, start, end - start)
+        if self.checkpoint is not None:
+            self.checkpoint.add_range(start, end)
@@ -0,0 +1,128 @@
+""" Warm migration: pre-copy a running VM's disks from a snapshot, then sync the rest offline """
+from time import time
+
+from pyVim.task import WaitForTask
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.cbt import POWERED_OFF, CbtError, IncrementalSync, get_change_id
+from voithos.lib.vmware.collector import create_object_collector, wait_for_updates
+
+
+DEFAULT_SHUTDOWN_TIMEOUT = 600  # seconds for the guest OS to shut down
+SHUTDOWN_MODES = ["guest", "hard"]
+SNAPSHOT_NAME = "voithos-precopy"
+POWERED_ON = vim.VirtualMachine.PowerState.poweredOn
+
+
+class VMWareShutdownFailed(Exception):
+    """ The VM did not power off """
+
+
+def create_snapshot(vm, name=SNAPSHOT_NAME, quiesce=False):
+    """ Snapshot a VM's disks, without its memory, and return the snapshot """
+    description = "Pre-copy of a warm migration, removed once copied"
+    task = vm.CreateSnapshot_Task(name=name, description=description, memory=False, quiesce=quiesce)
+    WaitForTask(task)
+    return task.info.result
+
+
+def remove_snapshot(snapshot):
+    """ Delete a snapshot, merging its changes back into the VM's disks """
+    WaitForTask(snapshot.RemoveSnapshot_Task(removeChildren=False, consolidate=True))
+
+
+def wait_for_power_off(conn, vm, timeout):
+    """ Wait for PropertyCollector updates until the VM is off, return False after timeout """
+    collector = create_object_collector(conn, vm, ["runtime.powerState"])
+    try:
+        deadline = time() + timeout
+        version = ""
+        while True:
+            changes, version = wait_for_updates(
+                collector, version, max_wait_seconds=max(int(deadline - time()), 1)
+            )
+            if any(props.get("runtime.powerState") == POWERED_OFF for _, props in changes):
+                return True
+            if time() >= deadline:
+                return False
+    finally:
+        collector.DestroyPropertyCollector()
+
+
+def power_off(conn, vm, mode="guest", timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+    """Power a VM off, by shutting its guest OS down or a hard power off
+
+    Raises VMWareShutdownFailed when a guest shutdown can't be started or takes over timeout
+    seconds
+    """
+    if vm.runtime.powerState == POWERED_OFF:
+        return
+    if mode == "hard":
+        WaitForTask(vm.PowerOffVM_Task())
+        return
+    try:
+        vm.ShutdownGuest()
+    except vmodl.MethodFault as exc:
+        reason = getattr(exc, "msg", exc)
+        raise VMWareShutdownFailed(
+            f"ERROR - Guest shutdown failed (VMware tools?): {reason}"
+        ) from exc
+    if not wait_for_power_off(conn, vm, timeout):
+        raise VMWareShutdownFailed(f"ERROR - The VM was still on after {timeout} seconds")
+
+
+class WarmMigration:
+    """Export a running VM with a short downtime
+
+    1. The VM is snapshotted and the base disks, frozen by the snapshot, are copied while the
+       VM keeps running. Images already copied by an earlier pass only get the changes since.
+    2. The snapshot is removed, then the VM is powered off.
+    3. Only the blocks changed since the snapshot are copied, which is all the downtime needed.
+
+    Both copies are IncrementalSync syncs, so Changed Block Tracking must be on for the VM, and
+    it must not have snapshots of its own: only the base disks of the pre-copy snapshot are read.
+    """
+
+    def __init__(self, vmware_mgr, vm, base_dir=None, enable=False):
+        """ Raises CbtError if CBT is off for the VM, unless enable=True turns it on """
+        self.vmware_mgr = vmware_mgr
+        self.vm = vm
+        self.syncer = IncrementalSync(vmware_mgr, vm, base_dir=base_dir, enable=enable)
+        self.downtime_seconds = None
+
+    def precopy(self, quiesce=False, **sync_args):
+        """ Copy the disks of the running VM from a snapshot, removed afterwards """
+        print("Pre-copy: snapshotting the running VM")
+        snapshot = create_snapshot(self.vm, quiesce=quiesce)
+        try:
+            disks = self.syncer.get_disks(snapshot)
+            if not all(get_change_id(disk) for disk in disks):
+                # Without a changeId the final sync could not tell what changed since
+                raise CbtError("ERROR: Changed Block Tracking is not active for the VM's disks")
+            self.syncer.sync(snapshot=snapshot, **sync_args)
+        finally:
+            print("Pre-copy: removing the snapshot")
+            remove_snapshot(snapshot)
+
+    def cutover(self, shutdown="guest", shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT, **sync_args):
+        """ Power the VM off and copy what changed since the pre-copy """
+        print(f"Cutover: powering the VM off ({shutdown})")
+        start = time()
+        power_off(self.vmware_mgr.conn, self.vm, mode=shutdown, timeout=shutdown_timeout)
+        self.syncer.sync(**sync_args)
+        self.downtime_seconds = round(time() - start, 1)
+        print(f"Cutover done, the VM has been down for {self.downtime_seconds} seconds")
+
+    def run(
+        self,
+        quiesce=False,
+        shutdown="guest",
+        shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT,
+        **sync_args,
+    ):
+        """ Pre-copy the running VM, then cut over. sync_args are those of IncrementalSync.sync """
+        if self.vm.runtime.powerState == POWERED_ON:
+            self.precopy(quiesce=quiesce, **sync_args)
+        else:
+            print("The VM is not running, skipping the pre-copy")
+        self.cutover(shutdown=shutdown, shutdown_timeout=shutdown_timeout, **sync_args)
@@ -0,0 +1,137 @@
+""" Plan migration waves: VM exports packed into change windows of a fixed length """
+import json
+import os
+
+from voithos.lib.vmware.scheduler import DEFAULT_MAX_CONCURRENT, DEFAULT_MAX_PER_HOST
+
+
+WAVE_PLAN_VERSION = 1
+
+
+class WavePlanError(Exception):
+    """ A wave plan could not be read or does not have the requested wave """
+
+
+class _Wave:
+    """A wave being packed: its export lanes and those of each ESXi host
+
+    Lanes only hold the end time of their last export, since exports are only ever appended.
+    An export can then start once both a global lane and a lane of its host are free.
+    """
+
+    def __init__(self, max_concurrent, max_per_host):
+        """ Start an empty wave """
+        self.lanes = [0.0] * max_concurrent
+        self.host_lanes = {}
+        self.max_per_host = max_per_host
+        self.exports = []
+
+    def get_start(self, host):
+        """ Return when an export on host could start """
+        host_lanes = self.host_lanes.get(host, [0.0] * self.max_per_host)
+        return max(min(self.lanes), min(host_lanes))
+
+    def add(self, job, start, seconds):
+        """ Append an export of job starting at start """
+        end = start + seconds
+        self.lanes[self.lanes.index(min(self.lanes))] = end
+        host_lanes = self.host_lanes.setdefault(job["host"], [0.0] * self.max_per_host)
+        host_lanes[host_lanes.index(min(host_lanes))] = end
+        self.exports.append((job, start, seconds))
+
+
+def _get_wave_dict(number, wave, window_seconds):
+    """ Return the plan dict of a packed wave """
+    ends = [start + seconds for _, start, seconds in wave.exports]
+    estimated_seconds = round(max(ends, default=0.0), 1)
+    return {
+        "wave": number,
+        "estimated_seconds": estimated_seconds,
+        "over_window": estimated_seconds > window_seconds,
+        "size_bytes": sum(job["size_bytes"] for job, _, _ in wave.exports),
+        "vms": [
+            {
+                "vcenter": job.get("vcenter"),
+                "uuid": job["uuid"],
+                "name": job["name"],
+                "host": job["host"],
+                "size_bytes": job["size_bytes"],
+                "estimated_start": round(start, 1),
+                "estimated_seconds": round(seconds, 1),
+            }
+            for job, start, seconds in sorted(wave.exports, key=lambda export: export[1])
+        ],
+    }
+
+
+def plan_waves(
+    jobs,
+    bandwidth_bps,
+    window_seconds,
+    max_concurrent=DEFAULT_MAX_CONCURRENT,
+    max_per_host=DEFAULT_MAX_PER_HOST,
+):
+    """Pack export jobs (see scheduler.get_export_jobs) into as few waves as possible
+
+    Each export is estimated to take size_bytes / bandwidth_bps seconds, bandwidth_bps being
+    the measured speed of one VM export. Jobs are placed largest first, each into the first
+    wave where it finishes within window_seconds, given the concurrency limits of the
+    ExportScheduler: a first-fit decreasing bin packing whose bins are simulated schedules. A
+    VM too large for any window gets a wave of its own, marked over_window. Within a wave, VMs
+    are listed in the order they should start.
+    """
+    if bandwidth_bps <= 0 or window_seconds <= 0:
+        raise ValueError("The bandwidth and window length must be positive")
+    if max_concurrent < 1 or max_per_host < 1:
+        raise ValueError("Concurrency limits must be at least 1")
+    waves = []
+    for job in sorted(jobs, key=lambda job: job["size_bytes"], reverse=True):
+        seconds = job["size_bytes"] / bandwidth_bps
+        for wave in waves:
+            start = wave.get_start(job["host"])
+            if start + seconds <= window_seconds:
+                wave.add(job, start, seconds)
+                break
+        else:
+            wave = _Wave(max_concurrent, max_per_host)
+            wave.add(job, 0.0, seconds)
+            waves.append(wave)
+    return {
+        "version": WAVE_PLAN_VERSION,
+        "bandwidth_bps": bandwidth_bps,
+        "window_seconds": window_seconds,
+        "max_concurrent": max_concurrent,
+        "max_per_host": max_per_host,
+        "waves": [
+            _get_wave_dict(number, wave, window_seconds)
+            for number, wave in enumerate(waves, start=1)
+        ],
+    }
+
+
+def save_wave_plan(path, plan):
+    """ Write a wave plan to a JSON file """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_wave_plan(path):
+    """ Return the wave plan saved in a JSON file, raise WavePlanError if it can't be read """
+    try:
+        with open(path, encoding="utf-8") as plan_file:
+            plan = json.load(plan_file)
+    except (OSError, ValueError) as exc:
+        raise WavePlanError(f"Failed to read wave plan {path}: {exc}") from exc
+    if not isinstance(plan, dict) or plan.get("version") != WAVE_PLAN_VERSION:
+        raise WavePlanError(f"{path} is not a version {WAVE_PLAN_VERSION} wave plan")
+    return plan
+
+
+def get_wave(plan, number):
+    """ Return the dict of wave number of a plan, raise WavePlanError if there is none """
+    for wave in plan["waves"]:
+        if wave["wave"] == number:
+            return wave
+    raise WavePlanError(f"The plan has no wave {number}, it has {len(plan['waves'])} waves")